@@ -0,0 +1,164 @@
+"""
+วิเคราะห์ภาพจำนวนมากแบบ offline ด้วย pipeline เดียวกับ /analyze (YOLO + อายุ)
+
+รันจากโฟลเดอร์ backend (ที่มี best.pt และ mobilenetv2.tflite):
+    python batch_infer.py --input /data/shelter_photos --output results/ --processes 4
+    python batch_infer.py --input manifest.txt --output results/ --format parquet
+
+- input เป็นโฟลเดอร์ (ค้นหาภาพทุกโฟลเดอร์ย่อย) หรือ manifest (.txt หนึ่ง path ต่อบรรทัด / .jsonl ที่มี "path")
+- แบ่งภาพเป็น shard ละ --shard-size รูป, แต่ละ process รับทีละ shard
+- ภายใน process มี thread pool อ่าน + ถอดรหัสภาพล่วงหน้า ขณะที่โมเดลประมวลผลรอบก่อนหน้า
+- ผลของแต่ละ shard เขียนเป็น shard_XXXXX.jsonl (หรือ .parquet) เมื่อ shard เสร็จเท่านั้น
+  รันซ้ำด้วยคำสั่งเดิมจะข้าม shard ที่มีไฟล์ผลแล้ว (resume)
+"""
+import os
+import json
+import time
+import argparse
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+def list_images(input_path):
+    """รายการ path ของภาพ (เรียงลำดับคงที่ เพื่อให้ shard เหมือนเดิมทุกครั้งที่รัน)"""
+    if os.path.isdir(input_path):
+        paths = []
+        for root, _, files in os.walk(input_path):
+            for name in files:
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    paths.append(os.path.join(root, name))
+        return sorted(paths)
+
+    base = os.path.dirname(os.path.abspath(input_path))
+    paths = []
+    with open(input_path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            path = json.loads(line)["path"] if input_path.endswith(".jsonl") else line
+            paths.append(path if os.path.isabs(path) else os.path.join(base, path))
+    return paths
+
+def shard_filename(output_dir, shard_id, fmt):
+    return os.path.join(output_dir, f"shard_{shard_id:05d}.{fmt}")
+
+# =========================
+# Worker process
+# =========================
+_pipeline = None
+
+def init_worker(threads_per_process):
+    """โหลดโมเดลหนึ่งชุดต่อ process (ใช้โค้ดเดียวกับ backend/main.py)"""
+    global _pipeline
+    # ปิดส่วนของ server ที่ไม่ใช้ (job store / แคชผลลัพธ์) และแบ่ง core ระหว่าง process
+    # run_inference รันใน thread หลักของ process จึงต้องมี inference worker เดียวที่ใช้โมเดลหลัก
+    os.environ.setdefault("JOBS_ENABLED", "0")
+    os.environ.setdefault("RESULT_CACHE_SIZE", "0")
+    os.environ.setdefault("INFERENCE_WORKERS", "1")
+    os.environ.setdefault("AGE_NUM_THREADS", str(threads_per_process))
+    os.environ.setdefault("OMP_NUM_THREADS", str(threads_per_process))
+    import main
+    main.load_main_yolo()
+    main.load_main_age_model()
+    main.result_cache.set_version(main.model_version())
+    _pipeline = main
+
+def _read_and_decode(path):
+    try:
+        with open(path, "rb") as f:
+            return _pipeline.decode_for_detection(f.read())
+    except OSError:
+        return None
+
+def process_shard(task):
+    """
+    วิเคราะห์ภาพทั้งหมดของ shard หนึ่ง แล้วเขียนไฟล์ผล (เขียนไฟล์ชั่วคราวก่อนแล้วค่อย rename)
+    - task: (shard_id, paths, output_dir, fmt, batch_size, prefetch_threads)
+    """
+    shard_id, paths, output_dir, fmt, batch_size, prefetch_threads = task
+    start = time.perf_counter()
+    rows = []
+
+    # ถอดรหัสล่วงหน้าไม่เกิน 2 รอบ เพื่อไม่ให้ภาพทั้ง shard ค้างอยู่ในหน่วยความจำ
+    prefetch_depth = batch_size * 2
+    with ThreadPoolExecutor(max_workers=prefetch_threads) as decode_pool:
+        pending = deque()
+        next_idx = 0
+        batch = []
+        while pending or next_idx < len(paths):
+            while next_idx < len(paths) and len(pending) < prefetch_depth:
+                pending.append((next_idx, decode_pool.submit(_read_and_decode, paths[next_idx])))
+                next_idx += 1
+            idx, future = pending.popleft()
+            img = future.result()
+            # ภาพที่อ่านไม่ได้ส่ง bytes ว่าง ให้ run_inference คืน error ตามรูปแบบเดิม
+            batch.append((idx, os.path.basename(paths[idx]), img if img is not None else b""))
+            if len(batch) == batch_size or (not pending and next_idx >= len(paths)):
+                results = _pipeline.run_inference(batch)
+                for i, _, _ in batch:
+                    rows.append({"path": paths[i], **results[i]})
+                batch = []
+
+    final_path = shard_filename(output_dir, shard_id, fmt)
+    tmp_path = final_path + ".tmp"
+    if fmt == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.table({
+            "path": [r["path"] for r in rows],
+            "original_file": [r.get("original_file") for r in rows],
+            "result": [json.dumps(r, ensure_ascii=False) for r in rows],
+        })
+        pq.write_table(table, tmp_path)
+    else:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for r in rows:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, final_path)
+    return shard_id, len(rows), time.perf_counter() - start
+
+# =========================
+# Main
+# =========================
+def main():
+    parser = argparse.ArgumentParser(description="Offline batch inference (YOLO + TFLite age)")
+    parser.add_argument("--input", required=True, help="โฟลเดอร์ภาพ หรือ manifest (.txt / .jsonl)")
+    parser.add_argument("--output", required=True, help="โฟลเดอร์เก็บไฟล์ผลของแต่ละ shard")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+    parser.add_argument("--processes", type=int, default=max(1, (os.cpu_count() or 1) // 2))
+    parser.add_argument("--shard-size", type=int, default=1000, help="จำนวนภาพต่อ shard")
+    parser.add_argument("--batch-size", type=int, default=32, help="จำนวนภาพต่อรอบ run_inference")
+    parser.add_argument("--prefetch-threads", type=int, default=4, help="thread อ่าน/ถอดรหัสภาพต่อ process")
+    args = parser.parse_args()
+
+    paths = list_images(args.input)
+    os.makedirs(args.output, exist_ok=True)
+    shards = [paths[i:i + args.shard_size] for i in range(0, len(paths), args.shard_size)]
+
+    # resume: ข้าม shard ที่มีไฟล์ผลสมบูรณ์แล้ว
+    tasks = [
+        (shard_id, shard, args.output, args.format, args.batch_size, args.prefetch_threads)
+        for shard_id, shard in enumerate(shards)
+        if not os.path.exists(shard_filename(args.output, shard_id, args.format))
+    ]
+    print(f"{len(paths)} ภาพ, {len(shards)} shard (เหลือ {len(tasks)}), {args.processes} process")
+    if not tasks:
+        return
+
+    threads_per_process = max(1, (os.cpu_count() or 1) // args.processes)
+    start = time.perf_counter()
+    done_images = 0
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(args.processes, initializer=init_worker, initargs=(threads_per_process,)) as pool:
+        for shard_id, n_images, elapsed in pool.imap_unordered(process_shard, tasks):
+            done_images += n_images
+            rate = done_images / (time.perf_counter() - start)
+            print(f"shard {shard_id:05d}: {n_images} ภาพ ใน {elapsed:.1f}s (รวม {rate:.1f} ภาพ/วินาที)")
+
+    print(f"✅ เสร็จแล้ว ผลอยู่ที่ {args.output}")
+
+if __name__ == "__main__":
+    main()
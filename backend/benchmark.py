@@ -0,0 +1,333 @@
+"""
+Benchmark ของ /analyze แบบ end-to-end
+
+รันจากโฟลเดอร์ backend (ที่มี best.pt และ mobilenetv2.tflite):
+    python benchmark.py                              # รัน app ใน process เดียวกันผ่าน TestClient
+    python benchmark.py --url http://127.0.0.1:8000  # ยิง server ที่รันอยู่แล้ว
+    python benchmark.py --output bench.json --baseline bench_old.json
+
+วัด throughput, latency p50/p95/p99 (เฉพาะ response 200) และ RSS ของ server แยกตามชุดภาพ (0/1/หลายตัว),
+จำนวนภาพต่อ request และจำนวน client พร้อมกัน แล้วบันทึกผลเป็น JSON
+request ที่ได้ status อื่น (เช่น 503 ตอนคิวเต็ม) นับแยกใน "errors" ไม่รวมใน latency/throughput
+RSS อ่านจาก /metrics ของ server ระหว่างรันแต่ละระดับ (ค่าสูงสุดที่ sample ได้ ไม่ใช่ peak สะสมของ process)
+ถ้าให้ --baseline จะเทียบ p95/throughput และ exit code 1 เมื่อช้าลงเกิน --tolerance
+
+ชุดภาพวนใช้ payload เดิมซ้ำ: ถ้า server เปิดแคชผลลัพธ์ไว้ จะวัดได้แค่ cache hit ไม่ใช่ YOLO/TFLite
+จึงอ่าน /cache ก่อนเริ่มและหยุดทันทีถ้าแคชเปิดอยู่ (รัน server ด้วย RESULT_CACHE_SIZE=0)
+สถานะแคชของ server ถูกบันทึกไว้ใน report ("server_cache")
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+# ภาพตัวอย่างที่มีสัตว์หนึ่งตัว (ผลลัพธ์ของ model/mobilenetv2/detect.py)
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "..", "model", "mobilenetv2", "ผลลัพธ์", "train3")
+
+def _encode_jpeg(img):
+    ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    if not ok:
+        raise RuntimeError("encode JPEG ไม่สำเร็จ")
+    return buf.tobytes()
+
+def load_fixture_images():
+    """อ่านภาพตัวอย่าง pred_*.jpg (สัตว์หนึ่งตัวต่อภาพ) เป็น BGR"""
+    images = []
+    if os.path.isdir(FIXTURE_DIR):
+        for name in sorted(os.listdir(FIXTURE_DIR)):
+            if name.startswith("pred_") and name.endswith(".jpg"):
+                img = cv2.imread(os.path.join(FIXTURE_DIR, name))
+                if img is not None:
+                    images.append(img)
+    return images
+
+def build_image_sets(size):
+    """
+    ชุดภาพสำหรับ benchmark (bytes JPEG):
+    - none: ภาพสังเคราะห์ไม่มีสัตว์ (gradient + noise, seed คงที่)
+    - single: ภาพตัวอย่างหนึ่งตัว
+    - many: ภาพตัวอย่างหลายรูปเรียงเป็น grid 2x2 ในภาพเดียว
+    """
+    rng = np.random.default_rng(0)
+    w, h = size
+    gradient = np.tile(np.linspace(0, 255, w, dtype=np.float32), (h, 1))
+    synthetic = np.stack([gradient, gradient[::-1], np.full_like(gradient, 128)], axis=-1)
+    synthetic = np.clip(synthetic + rng.normal(0, 12, synthetic.shape), 0, 255).astype(np.uint8)
+    sets = {"none": [_encode_jpeg(synthetic)]}
+
+    fixtures = load_fixture_images()
+    if fixtures:
+        sets["single"] = [_encode_jpeg(cv2.resize(img, (w, h))) for img in fixtures]
+        tiles = [cv2.resize(fixtures[i % len(fixtures)], (w // 2, h // 2)) for i in range(4)]
+        grid = np.vstack([np.hstack(tiles[:2]), np.hstack(tiles[2:])])
+        sets["many"] = [_encode_jpeg(grid)]
+    else:
+        print(f"ไม่พบภาพตัวอย่างใน {FIXTURE_DIR} ใช้เฉพาะภาพสังเคราะห์")
+    return sets
+
+def server_rss_mb(client):
+    """RSS ปัจจุบันของ server (MB) จาก gauge ใน /metrics หรือ None ถ้า server ไม่รายงาน"""
+    try:
+        text = client.get("/metrics").text
+    except Exception:
+        return None
+    for line in text.splitlines():
+        if line.startswith("petbreed_process_resident_memory_bytes "):
+            return float(line.split()[1]) / (1024 * 1024)
+    return None
+
+class RssSampler:
+    """sample RSS ของ server เป็นระยะใน thread แยก ระหว่างรันหนึ่งระดับ แล้วเก็บค่าสูงสุด"""
+
+    def __init__(self, client, interval=0.25):
+        self.client = client
+        self.interval = interval
+        self.peak = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        rss = server_rss_mb(self.client)
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+        self._sample()
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+class InProcessClient:
+    """รัน app ใน process เดียวกันผ่าน FastAPI TestClient (รวม lifespan โหลดโมเดล)"""
+
+    def __init__(self, ready_timeout):
+        from fastapi.testclient import TestClient
+        # ปิดแคชผลลัพธ์ (ถ้าไม่ได้ตั้งเอง) ไม่เช่นนั้นภาพที่ส่งซ้ำจะไม่ผ่านโมเดลจริง
+        os.environ.setdefault("RESULT_CACHE_SIZE", "0")
+        import main
+        self.client = TestClient(main.app)
+        self.client.__enter__()
+        deadline = time.time() + ready_timeout
+        while self.client.get("/readyz").status_code != 200:
+            if time.time() > deadline:
+                raise RuntimeError("โมเดลไม่พร้อมภายในเวลาที่กำหนด (/readyz)")
+            time.sleep(0.2)
+
+    def post(self, files):
+        return self.client.post("/analyze", files=files)
+
+    def get(self, path):
+        return self.client.get(path)
+
+    def close(self):
+        self.client.__exit__(None, None, None)
+
+class RemoteClient:
+    """ยิง server ที่รันอยู่แล้วผ่าน HTTP (httpx)"""
+
+    def __init__(self, url, ready_timeout):
+        import httpx
+        self.client = httpx.Client(base_url=url, timeout=300.0)
+        deadline = time.time() + ready_timeout
+        while True:
+            try:
+                if self.client.get("/readyz").status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            if time.time() > deadline:
+                raise RuntimeError(f"server {url} ไม่พร้อมภายในเวลาที่กำหนด (/readyz)")
+            time.sleep(0.5)
+
+    def post(self, files):
+        return self.client.post("/analyze", files=files)
+
+    def get(self, path):
+        return self.client.get(path)
+
+    def close(self):
+        self.client.close()
+
+def check_cache_disabled(client):
+    """
+    อ่านสถานะแคชผลลัพธ์ของ server จาก /cache
+    คืนค่า dict สถานะ; หยุดโปรแกรมถ้าแคชเปิดอยู่ เพราะภาพที่ส่งซ้ำจะไม่ผ่านโมเดลจริง
+    """
+    cache = client.get("/cache").json()
+    if cache.get("enabled"):
+        print(f"แคชผลลัพธ์ของ server เปิดอยู่ ({cache}) ผลที่วัดจะเป็น cache hit ไม่ใช่ inference จริง\n"
+              "ให้รัน server ด้วย RESULT_CACHE_SIZE=0 แล้วลองใหม่")
+        sys.exit(2)
+    return cache
+
+def _ms(seconds):
+    return seconds * 1000.0 if seconds is not None else None
+
+def run_level(client, images, batch_size, concurrency, requests_per_client):
+    """
+    ยิง /analyze พร้อมกัน concurrency client, client ละ requests_per_client ครั้ง
+    แต่ละ request มี batch_size ภาพ (วนใช้ภาพจาก images)
+    latency และ throughput คิดเฉพาะ response 200; status อื่นนับใน "errors"
+    """
+    latencies = []
+    status_counts = {}
+    lock = threading.Lock()
+
+    def worker(worker_id):
+        for r in range(requests_per_client):
+            files = []
+            for k in range(batch_size):
+                data = images[(worker_id + r + k) % len(images)]
+                files.append(("files", (f"bench_{worker_id}_{r}_{k}.jpg", data, "image/jpeg")))
+            start = time.perf_counter()
+            resp = client.post(files)
+            elapsed = time.perf_counter() - start
+            with lock:
+                if resp.status_code == 200:
+                    latencies.append(elapsed)
+                status_counts[resp.status_code] = status_counts.get(resp.status_code, 0) + 1
+
+    with RssSampler(client) as rss:
+        wall_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(worker, range(concurrency)))
+        wall = time.perf_counter() - wall_start
+
+    n_requests = sum(status_counts.values())
+    n_ok = len(latencies)
+    return {
+        "requests": n_requests,
+        "ok_requests": n_ok,
+        "errors": n_requests - n_ok,
+        "images": n_ok * batch_size,
+        "wall_seconds": wall,
+        "requests_per_second": n_ok / wall if wall else 0.0,
+        "images_per_second": n_ok * batch_size / wall if wall else 0.0,
+        "latency_ms": {
+            "p50": _ms(percentile(latencies, 50)),
+            "p95": _ms(percentile(latencies, 95)),
+            "p99": _ms(percentile(latencies, 99)),
+            "max": _ms(max(latencies) if latencies else None),
+        },
+        "status_codes": {str(k): v for k, v in sorted(status_counts.items())},
+        "server_peak_rss_mb": rss.peak,
+    }
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    เทียบผลกับ baseline ตาม key (image_set, batch_size, concurrency)
+    คืนค่า list ข้อความของกรณีที่ p95 สูงขึ้นหรือ throughput ลดลงเกิน tolerance
+    """
+    def key(r):
+        return (r["image_set"], r["batch_size"], r["concurrency"])
+
+    old = {key(r): r for r in baseline.get("results", [])}
+    regressions = []
+    for r in results:
+        b = old.get(key(r))
+        if b is None:
+            continue
+        if r["latency_ms"]["p95"] is None:
+            regressions.append(f"{key(r)} ไม่มี response 200 (status {r['status_codes']})")
+            continue
+        if b["latency_ms"]["p95"] is not None and r["latency_ms"]["p95"] > b["latency_ms"]["p95"] * (1 + tolerance):
+            regressions.append(f"{key(r)} p95 {b['latency_ms']['p95']:.1f} -> {r['latency_ms']['p95']:.1f} ms")
+        if r["images_per_second"] < b["images_per_second"] * (1 - tolerance):
+            regressions.append(f"{key(r)} throughput {b['images_per_second']:.2f} -> {r['images_per_second']:.2f} img/s")
+    return regressions
+
+def _fmt(value, spec):
+    return format(value, spec) if value is not None else "-"
+
+def parse_int_list(text):
+    return [int(x) for x in text.split(",") if x.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /analyze (YOLO + TFLite age)")
+    parser.add_argument("--url", help="URL ของ server ที่รันอยู่แล้ว (ไม่ระบุ = รัน app ใน process นี้)")
+    parser.add_argument("--image-sets", default="none,single,many", help="ชุดภาพที่ใช้ (none,single,many)")
+    parser.add_argument("--batch-sizes", default="1,4,16", help="จำนวนภาพต่อ request")
+    parser.add_argument("--concurrency", default="1,4,8", help="จำนวน client พร้อมกัน")
+    parser.add_argument("--requests", type=int, default=10, help="จำนวน request ต่อ client ต่อการตั้งค่า")
+    parser.add_argument("--warmup", type=int, default=2, help="จำนวน request warm-up ก่อนวัด")
+    parser.add_argument("--image-size", default="1280x960", help="ขนาดภาพที่ส่ง (WxH)")
+    parser.add_argument("--ready-timeout", type=float, default=600.0)
+    parser.add_argument("--output", default="bench_results.json", help="ไฟล์ JSON ผลลัพธ์")
+    parser.add_argument("--baseline", help="ไฟล์ JSON ผลลัพธ์เดิมสำหรับเทียบ regression")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="สัดส่วนที่ยอมให้ช้าลงได้ (0.15 = 15%%)")
+    args = parser.parse_args()
+
+    w, h = (int(v) for v in args.image_size.lower().split("x"))
+    image_sets = build_image_sets((w, h))
+    wanted = [name for name in args.image_sets.split(",") if name in image_sets]
+
+    client = RemoteClient(args.url, args.ready_timeout) if args.url else InProcessClient(args.ready_timeout)
+    results = []
+    try:
+        server_cache = check_cache_disabled(client)
+        for name in wanted:
+            images = image_sets[name]
+            for _ in range(args.warmup):
+                client.post([("files", ("warmup.jpg", images[0], "image/jpeg"))])
+            for batch_size in parse_int_list(args.batch_sizes):
+                for concurrency in parse_int_list(args.concurrency):
+                    stats = run_level(client, images, batch_size, concurrency, args.requests)
+                    stats.update({"image_set": name, "batch_size": batch_size, "concurrency": concurrency})
+                    results.append(stats)
+                    latency = "  ".join(f"{q}={_fmt(stats['latency_ms'][q], '8.1f')} ms" for q in ("p50", "p95", "p99"))
+                    print(f"[{name:6s}] batch={batch_size:3d} conc={concurrency:3d} "
+                          f"{stats['images_per_second']:7.2f} img/s  {latency}  "
+                          f"errors={stats['errors']}  "
+                          f"server_rss={_fmt(stats['server_peak_rss_mb'], '.0f')} MB  status={stats['status_codes']}")
+        server_metrics = client.get("/queue").json()
+    finally:
+        client.close()
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "mode": "remote" if args.url else "in-process",
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "image_size": [w, h],
+        "env": {k: v for k, v in os.environ.items()
+                if k.startswith(("YOLO_", "AGE_", "MAX_ANIMALS_", "INFERENCE_", "MICROBATCH_", "RESULT_CACHE_"))},
+        "server": server_metrics,
+        "server_cache": server_cache,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nบันทึกผลที่ {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\nพบ regression:")
+            for line in regressions:
+                print("  -", line)
+            sys.exit(1)
+        print("ไม่พบ regression เมื่อเทียบกับ baseline")
+
+if __name__ == "__main__":
+    main()
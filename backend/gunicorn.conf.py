@@ -0,0 +1,35 @@
+"""
+ค่าของ gunicorn สำหรับรัน backend หลาย worker process โดยไม่โหลดโมเดลซ้ำทุก process
+
+รันจากโฟลเดอร์ backend:
+    gunicorn -c gunicorn.conf.py main:app
+    WEB_CONCURRENCY=8 gunicorn -c gunicorn.conf.py main:app
+
+- preload_app: master import main และโหลด YOLO + TFLite runtime ครั้งเดียว (PRELOAD_MODELS=1)
+  แล้ว fork worker; น้ำหนักของ YOLO และโค้ดของ torch/TensorFlow ถูกแชร์แบบ copy-on-write
+- TFLite interpreter สร้างใหม่ใน worker แต่ละตัวจากไฟล์ .tflite ที่ mmap (ใช้ page cache ร่วมกัน)
+- แต่ละ worker มี inference thread เดียวที่ใช้โมเดลหลักโดยตรง และแบ่ง core ให้ TFLite/torch เท่า ๆ กัน
+- master โหลดเฉพาะโมเดล: connection ของ SQLite (jobs.db, RESULT_CACHE_DB) เปิดใน worker แต่ละตัวเมื่อใช้ครั้งแรก
+  (connection ที่สร้างก่อน fork ห้ามใช้ข้าม process)
+"""
+import os
+import gc
+
+workers = int(os.environ.get("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+worker_class = "uvicorn.workers.UvicornWorker"
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+preload_app = True
+# โหลดโมเดล + warm-up ใน worker ใช้เวลานาน
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "300"))
+
+# ต้องตั้งก่อน gunicorn import main (และ torch) ใน master
+threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+os.environ.setdefault("PRELOAD_MODELS", "1")
+os.environ.setdefault("INFERENCE_WORKERS", "1")
+os.environ.setdefault("AGE_NUM_THREADS", str(threads_per_worker))
+os.environ.setdefault("OMP_NUM_THREADS", str(threads_per_worker))
+
+def when_ready(server):
+    # ย้าย object ที่มีอยู่ทั้งหมดไป generation ถาวร ไม่ให้ GC ของ worker เขียนทับ page ที่แชร์กับ master
+    gc.freeze()
+    server.log.info(f"preloaded models, forking {workers} workers ({threads_per_worker} threads each)")
@@ -1,13 +1,33 @@
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, Query, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-import shutil, uuid, os, cv2, numpy as np
-from ultralytics import YOLO
-import tensorflow as tf
-from tensorflow.keras.applications.mobilenet_v2 import preprocess_input
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from collections import OrderedDict
+import os, sys, cv2, time, uuid, asyncio, hashlib, sqlite3, threading, numpy as np
+import importlib
 import json
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    # โหลดโมเดลหลังจาก uvicorn เปิดรับ connection แล้ว (/healthz ตอบได้ทันที, /readyz รอจนโหลดเสร็จ)
+    startup_task = asyncio.create_task(startup_models())
+    yield
+    startup_task.cancel()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS
 app.add_middleware(
@@ -18,22 +38,488 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# โฟลเดอร์ชั่วคราว
-UPLOAD_FOLDER = "temp_images"
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# =========================
+# Metrics
+# =========================
+# ส่ง header Server-Timing (เวลาแต่ละขั้นตอน) กลับไปกับ /analyze
+METRICS_SERVER_TIMING = os.environ.get("METRICS_SERVER_TIMING", "0") == "1"
+
+class Counter:
+    """ตัวนับแบบ Prometheus (แยกตาม label ได้หนึ่งตัว)"""
+
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, label_value=None, amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_value, value in sorted(self.values.items(), key=lambda kv: str(kv[0])):
+                lines.append(f"{self.name}{_labels(self.label, label_value)} {value}")
+        return lines
+
+class Histogram:
+    """histogram แบบ Prometheus (bucket สะสม + sum + count, แยกตาม label ได้หนึ่งตัว)"""
+
+    def __init__(self, name, help_text, buckets, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = sorted(buckets)
+        self.label = label
+        self.lock = threading.Lock()
+        self.series = {}   # label_value -> [bucket_counts, sum, count]
+
+    def observe(self, value, label_value=None):
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_value, (counts, total, count) in sorted(self.series.items(), key=lambda kv: str(kv[0])):
+                for bound, c in zip(self.buckets, counts):
+                    le = _labels(self.label, label_value, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{le} {c}")
+                inf = _labels(self.label, label_value, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{inf} {count}")
+                lines.append(f"{self.name}_sum{_labels(self.label, label_value)} {total}")
+                lines.append(f"{self.name}_count{_labels(self.label, label_value)} {count}")
+        return lines
+
+def _labels(label, label_value, extra=None):
+    parts = []
+    if label is not None and label_value is not None:
+        parts.append(f'{label}="{label_value}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+stage_seconds = Histogram(
+    "petbreed_stage_seconds",
+    "Time spent in each /analyze pipeline stage",
+    STAGE_BUCKETS, label="stage")
+request_seconds = Histogram(
+    "petbreed_request_seconds",
+    "End-to-end /analyze latency",
+    STAGE_BUCKETS)
+detections_per_image = Histogram(
+    "petbreed_detections_per_image",
+    "Number of YOLO detections per analyzed image",
+    (0, 1, 2, 3, 5, 10, 20, 50))
+images_total = Counter(
+    "petbreed_images_total",
+    "Images received by /analyze")
+age_gate_total = Counter(
+    "petbreed_age_gate_total",
+    "Detections evaluated by the age model or skipped, by reason",
+    label="reason")
+errors_total = Counter(
+    "petbreed_errors_total",
+    "Errors by pipeline stage",
+    label="stage")
+
+@contextmanager
+def stage_timer(stage, timings=None):
+    """
+    จับเวลาขั้นตอนหนึ่งของ pipeline: บันทึกลง histogram และสะสมลง timings (ถ้าให้มา)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage)
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+def process_memory_bytes():
+    """
+    หน่วยความจำของ process นี้ (bytes): (RSS ปัจจุบัน, peak RSS ตลอดอายุ process)
+    ค่าที่อ่านไม่ได้บน OS นี้เป็น None
+    """
+    rss = peak = None
+    try:
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS รายงานเป็น bytes, Linux เป็น KB
+        peak = peak if sys.platform == "darwin" else peak * 1024
+    return rss, peak
+
+def server_timing_header(timings):
+    """แปลง timings (วินาที) เป็นค่า header Server-Timing (มิลลิวินาที)"""
+    return ", ".join(f"{stage};dur={seconds * 1000.0:.1f}" for stage, seconds in timings.items())
 
 # โหลดโมเดล YOLOv11 สำหรับการจำแนกสายพันธุ์ สุนัขและแมว
-yolo_model = YOLO("best.pt")
+# engine: pytorch (best.pt), onnx (best.onnx) หรือ openvino (best_openvino_model/)
+# ไฟล์ onnx/openvino ได้จาก model/yolov11/export.py; ถ้าไม่มีหรือโหลดไม่ได้จะใช้ best.pt แทน
+YOLO_ENGINE = os.environ.get("YOLO_ENGINE", "pytorch")
+YOLO_ARTIFACTS = {
+    "pytorch": "best.pt",
+    "onnx": "best.onnx",
+    "openvino": "best_openvino_model",
+}
+
+# เวลาที่ใช้ import/โหลด/warm-up แต่ละส่วน (วินาที) แสดงใน /readyz
+startup_timings = {}
+models_ready = False
+startup_error = None
+
+# YOLO class และโมเดลหลักถูกโหลดใน startup_models() (import ultralytics/torch ใช้เวลานาน)
+YOLO = None
+yolo_model_path, yolo_model = None, None
+
+def load_yolo_model():
+    """
+    โหลด YOLO ตาม YOLO_ENGINE (import ultralytics ครั้งแรกที่เรียก)
+    คืนค่า: (path ที่โหลดได้จริง, YOLO model)
+    """
+    global YOLO
+    if YOLO is None:
+        start = time.perf_counter()
+        from ultralytics import YOLO as _YOLO
+        YOLO = _YOLO
+        startup_timings["import_ultralytics"] = time.perf_counter() - start
+
+    path = YOLO_ARTIFACTS.get(YOLO_ENGINE, YOLO_ARTIFACTS["pytorch"])
+    if path != YOLO_ARTIFACTS["pytorch"]:
+        if os.path.exists(path):
+            try:
+                return path, YOLO(path, task="detect")
+            except Exception as e:
+                print(f"โหลด YOLO engine {YOLO_ENGINE} ไม่สำเร็จ ({e}) ใช้ best.pt แทน")
+        else:
+            print(f"ไม่พบ {path} สำหรับ YOLO engine {YOLO_ENGINE} ใช้ best.pt แทน")
+    path = YOLO_ARTIFACTS["pytorch"]
+    return path, YOLO(path)
+
+# ค่าการตรวจจับของ YOLO: confidence ขั้นต่ำ, IoU ของ NMS, จำนวนกล่องสูงสุด, NMS แบบไม่แยกคลาส
+YOLO_CONF = float(os.environ.get("YOLO_CONF", "0.25"))
+YOLO_IOU = float(os.environ.get("YOLO_IOU", "0.7"))
+YOLO_MAX_DET = int(os.environ.get("YOLO_MAX_DET", "300"))
+YOLO_AGNOSTIC_NMS = os.environ.get("YOLO_AGNOSTIC_NMS", "0") == "1"
+# IoU ของ NMS เพิ่มเติมรายคลาส เช่น "persian_cat:0.5,pug_dog:0.6" (ใช้ร่วมกับ YOLO_IOU)
+YOLO_CLASS_IOU = os.environ.get("YOLO_CLASS_IOU", "")
+# ขนาด input ของ YOLO (ด้านยาว): ส่งให้ YOLO และใช้เลือกระดับการถอดรหัสแบบย่อ (ภาพที่ย่อแล้วต้องไม่เล็กกว่านี้)
+# ไฟล์ onnx/openvino ที่ export แบบขนาดคงที่ (export.py ใช้ 640) ต้องตั้งให้ตรงกับตอน export
+YOLO_IMGSZ = int(os.environ.get("YOLO_IMGSZ", "640"))
+YOLO_PREDICT_ARGS = {
+    "imgsz": YOLO_IMGSZ,
+    "conf": YOLO_CONF,
+    "iou": YOLO_IOU,
+    "max_det": YOLO_MAX_DET,
+    "agnostic_nms": YOLO_AGNOSTIC_NMS,
+    "verbose": False,
+}
+# เงื่อนไขการประเมินอายุ: กล่องที่ไม่ผ่านจะรายงานโดยไม่มีอายุ (ไม่เสียเวลารันโมเดลอายุ)
+AGE_MIN_DET_CONFIDENCE = float(os.environ.get("AGE_MIN_DET_CONFIDENCE", "0"))
+AGE_MIN_CROP_AREA = int(os.environ.get("AGE_MIN_CROP_AREA", "0"))   # พื้นที่กล่อง (pixel ของภาพจริง)
+MAX_ANIMALS_PER_IMAGE = int(os.environ.get("MAX_ANIMALS_PER_IMAGE", "0"))   # 0 = ไม่จำกัด
+# จำนวนภาพสูงสุดต่อการเรียก YOLO หนึ่งครั้ง (ภาพหลายรูปใน request เดียวจะถูกรวมเป็น batch)
+YOLO_BATCH_SIZE = int(os.environ.get("YOLO_BATCH_SIZE", "16"))
 # โหลดโมเดล MobileNetV2 สำหรับการจำแนกอายุ
-age_model = "mobilenetv2.tflite"
+# (ไฟล์ float32/float16/int8 จาก model/mobilenetv2/แปลง.py ใช้ได้ทั้งหมด)
+age_model = os.environ.get("AGE_MODEL_PATH", "mobilenetv2.tflite")
+
+# runtime ของ TFLite: auto (litert -> tflite_runtime -> tensorflow), litert, tflite_runtime, tensorflow
+AGE_RUNTIME = os.environ.get("AGE_RUNTIME", "auto")
+# จำนวน thread ต่อ interpreter (0 = แบ่ง core ตามจำนวน inference worker)
+AGE_NUM_THREADS = int(os.environ.get("AGE_NUM_THREADS", "0"))
+# delegate: xnnpack (ค่าเริ่มต้นของ TFLite), none (ปิด delegate) หรือ path ของไฟล์ external delegate (.so)
+AGE_DELEGATE = os.environ.get("AGE_DELEGATE", "xnnpack")
+# วัดความเร็ว invoke ของแต่ละการตั้งค่าตอนเริ่ม server (log อย่างเดียว ไม่เปลี่ยนค่าที่ใช้)
+AGE_BENCHMARK = os.environ.get("AGE_BENCHMARK", "0") == "1"
+AGE_BENCHMARK_THREADS = os.environ.get("AGE_BENCHMARK_THREADS", "1,2,4")
+
+# module ของ interpreter แต่ละ runtime (ไม่ต้องติดตั้ง TensorFlow เต็มถ้ามี litert/tflite_runtime)
+_TFLITE_RUNTIMES = {
+    "litert": "ai_edge_litert.interpreter",
+    "tflite_runtime": "tflite_runtime.interpreter",
+    "tensorflow": "tensorflow.lite",
+}
+
+def _load_tflite_module(runtime):
+    """
+    import module ของ interpreter ตาม runtime ที่เลือก
+    คืนค่า: (ชื่อ runtime, module ที่มี Interpreter/load_delegate/OpResolverType)
+    """
+    names = list(_TFLITE_RUNTIMES) if runtime == "auto" else [runtime]
+    errors = []
+    for name in names:
+        try:
+            module = importlib.import_module(_TFLITE_RUNTIMES[name])
+        except (ImportError, KeyError) as e:
+            errors.append(f"{name}: {e}")
+            continue
+        if name == "tensorflow":
+            # tf.lite เก็บ load_delegate/OpResolverType ไว้ใน experimental
+            module.load_delegate = module.experimental.load_delegate
+            module.OpResolverType = module.experimental.OpResolverType
+        return name, module
+    raise ImportError("ไม่พบ TFLite runtime ที่ใช้ได้ (" + "; ".join(errors) + ")")
+
+# module ของ TFLite runtime ถูก import ใน load_main_age_interpreter()
+tflite_runtime_name, tflite = None, None
+
+def threads_per_worker():
+    """จำนวน thread ต่อโมเดลหนึ่งชุด: แบ่ง core ของเครื่องตามจำนวน inference worker"""
+    return max(1, (os.cpu_count() or 1) // INFERENCE_WORKERS)
+
+def create_age_interpreter(num_threads=None, delegate=None):
+    """
+    สร้าง TFLite interpreter ของโมเดลอายุตามการตั้งค่า thread/delegate
+    - num_threads: None = ใช้ AGE_NUM_THREADS
+    - delegate: None = ใช้ AGE_DELEGATE
+    """
+    if num_threads is None:
+        num_threads = AGE_NUM_THREADS or threads_per_worker()
+    if delegate is None:
+        delegate = AGE_DELEGATE
+
+    # model_path ทำให้ TFLite mmap ไฟล์ .tflite (ไม่คัดลอกลง heap) หลาย process จึงใช้ page เดียวกันใน page cache
+    kwargs = {"model_path": age_model, "num_threads": num_threads}
+    if delegate == "none":
+        # ปิด XNNPACK ที่ TFLite ใส่ให้อัตโนมัติ
+        kwargs["experimental_op_resolver_type"] = tflite.OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+    elif delegate != "xnnpack":
+        kwargs["experimental_delegates"] = [tflite.load_delegate(delegate)]
+    return tflite.Interpreter(**kwargs)
+
+def load_age_interpreter():
+    """
+    สร้าง TFLite interpreter ใหม่หนึ่งตัว พร้อมรายละเอียด input/output
+    คืนค่า: (interpreter, input_details, output_details)
+    """
+    interpreter = create_age_interpreter()
+    interpreter.allocate_tensors()
+    return interpreter, interpreter.get_input_details(), interpreter.get_output_details()
+
+def benchmark_age_interpreter(repeats=20):
+    """
+    วัดเวลา invoke (batch 1) ของแต่ละการตั้งค่า thread x delegate แล้ว log ออกมา
+    ใช้เลือกค่า AGE_NUM_THREADS / AGE_DELEGATE ที่เหมาะกับเครื่อง
+    """
+    thread_counts = [int(t) for t in AGE_BENCHMARK_THREADS.split(",") if t.strip()]
+    for delegate in ("xnnpack", "none"):
+        for num_threads in thread_counts:
+            try:
+                interpreter = create_age_interpreter(num_threads=num_threads, delegate=delegate)
+                interpreter.allocate_tensors()
+                detail = interpreter.get_input_details()[0]
+                dummy = np.zeros(detail['shape'], dtype=detail['dtype'])
+                interpreter.set_tensor(detail['index'], dummy)
+                interpreter.invoke()  # warm-up
+                timings = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    interpreter.set_tensor(detail['index'], dummy)
+                    interpreter.invoke()
+                    timings.append((time.perf_counter() - start) * 1000.0)
+                print(f"[age benchmark] runtime={tflite_runtime_name} delegate={delegate} "
+                      f"threads={num_threads}: median {np.median(timings):.2f} ms/invoke")
+            except Exception as e:
+                print(f"[age benchmark] delegate={delegate} threads={num_threads} failed:", e)
+
+# จำนวน crop สูงสุดต่อการ invoke TFLite หนึ่งครั้ง (ทุก crop ใน request ถูกรวมเป็น batch)
+AGE_BATCH_SIZE = int(os.environ.get("AGE_BATCH_SIZE", "32"))
+
+# =========================
+# Age head บน feature ของ YOLO (multi-task)
+# =========================
+# tflite: crop ภาพสัตว์แต่ละตัวแล้วส่งเข้า MobileNetV2 (ค่าเริ่มต้น)
+# yolo_head: ประเมินอายุจาก feature map ที่ YOLO คำนวณไว้แล้วในการตรวจจับครั้งเดียวกัน (ROI Align + head เล็ก ๆ)
+#            ไม่ต้องรันเครือข่ายที่สองต่อสัตว์หนึ่งตัว; ต้องใช้ YOLO_ENGINE=pytorch
+#            และ age_head.pt จาก model/yolov11/train_age_head.py
+AGE_ENGINE = os.environ.get("AGE_ENGINE", "tflite")
+AGE_HEAD_PATH = os.environ.get("AGE_HEAD_PATH", "age_head.pt")
+
+# age head (TorchScript) และ meta (age_labels, pool_size) ถูกโหลดใน load_main_age_head()
+age_head, age_head_meta = None, None
+
+def load_age_head():
+    """โหลด age head (TorchScript) คืนค่า: (module, meta dict)"""
+    import torch
+    extra_files = {"meta.json": ""}
+    head = torch.jit.load(AGE_HEAD_PATH, map_location="cpu", _extra_files=extra_files)
+    head.eval()
+    return head, json.loads(extra_files["meta.json"])
+
+def attach_feature_hooks(yolo):
+    """
+    ติด hook ให้ YOLO (PyTorch) เก็บขนาด input และ feature map ที่เข้า Detect head ของ forward ล่าสุด
+    คืนค่า: dict ที่ถูกเขียนทับทุก forward ("input_hw", "features")
+    """
+    net = yolo.model
+    if not hasattr(net, "model"):
+        raise RuntimeError("AGE_ENGINE=yolo_head ต้องใช้ YOLO_ENGINE=pytorch")
+    captured = {}
+
+    def on_input(module, args):
+        captured["input_hw"] = tuple(args[0].shape[-2:])
+
+    def on_detect(module, args):
+        # Detect แก้ list นี้ระหว่าง forward จึงเก็บสำเนาของ list ไว้
+        captured["features"] = list(args[0])
+
+    net.register_forward_pre_hook(on_input)
+    net.model[-1].register_forward_pre_hook(on_detect)
+    return captured
+
+def to_input_coords(box, image_hw, input_hw):
+    """
+    แปลงกล่อง (x1, y1, x2, y2) จากพิกัดภาพที่ส่งเข้า YOLO เป็นพิกัดของ input หลัง letterbox (ย่อ/ขยาย + pad กึ่งกลาง)
+    ต้องตรงกับ model/yolov11/train_age_head.py
+    """
+    h, w = image_hw
+    in_h, in_w = input_hw
+    r = min(in_h / h, in_w / w)
+    pad_x = (in_w - round(w * r)) / 2
+    pad_y = (in_h - round(h * r)) / 2
+    x1, y1, x2, y2 = box
+    return [x1 * r + pad_x, y1 * r + pad_y, x2 * r + pad_x, y2 * r + pad_y]
+
+def pool_roi_features(features, input_hw, boxes, pool_size):
+    """
+    ROI Align ของกล่องบนทุกระดับของ feature pyramid แล้วเฉลี่ยเป็น vector ต่อกัน
+    - features: list ของ tensor (1, C, H, W) ของภาพหนึ่งภาพ
+    - boxes: tensor (K, 4) ในพิกัดของ input หลัง letterbox
+    ต้องตรงกับ model/yolov11/train_age_head.py
+    คืนค่า: tensor (K, sum(C))
+    """
+    import torch
+    from torchvision.ops import roi_align
+    pooled = []
+    for feat in features:
+        scale = feat.shape[-1] / input_hw[1]
+        roi = roi_align(feat, [boxes.to(feat.dtype)], output_size=pool_size,
+                        spatial_scale=scale, sampling_ratio=2, aligned=True)
+        pooled.append(roi.mean(dim=(2, 3)))
+    return torch.cat(pooled, dim=1).float()
+
+# =========================
+# Inference worker pool
+# =========================
+# งาน inference (YOLO, OpenCV, TFLite) เป็นงาน blocking จึงรันใน thread pool แยกจาก event loop
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", "2"))
+# จำนวน request สูงสุดที่รับไว้พร้อมกัน (กำลังรัน + รอคิว) ถ้าเต็มจะตอบ 503
+INFERENCE_QUEUE_SIZE = int(os.environ.get("INFERENCE_QUEUE_SIZE", "8"))
+# ค่า Retry-After (วินาที) ที่ส่งกลับเมื่อคิวเต็ม
+INFERENCE_RETRY_AFTER = int(os.environ.get("INFERENCE_RETRY_AFTER", "2"))
+
+# YOLO และ TFLite interpreter ไม่ thread-safe จึงให้แต่ละ worker มีโมเดลของตัวเอง
+_worker_local = threading.local()
+# worker thread แรกที่ขอโมเดลใช้โมเดลหลัก (yolo_model / age_interpreter) เลย ไม่ต้องโหลดซ้ำ
+# (โหมด preload ใช้น้ำหนักร่วมกับ master แบบ copy-on-write) worker ที่เหลือโหลดชุดของตัวเอง
+_main_models_lock = threading.Lock()
+_main_models_claimed = False
+
+def _claim_main_models():
+    """True ถ้า thread ปัจจุบันได้สิทธิ์ใช้โมเดลหลักเป็นโมเดลของ worker (ให้ได้เพียง thread เดียว)"""
+    global _main_models_claimed
+    with _main_models_lock:
+        if _main_models_claimed or yolo_model is None:
+            return False
+        if AGE_ENGINE != "yolo_head" and age_interpreter is None:
+            return False
+        _main_models_claimed = True
+        return True
+
+def get_worker_models():
+    """
+    คืนโมเดลของ worker thread ปัจจุบัน (สร้างครั้งแรกที่เรียกใช้ใน thread นั้น)
+    คืนค่า: dict ที่มี "yolo", "age_interpreter", "age_input_details", "age_output_details"
+    """
+    models = getattr(_worker_local, "models", None)
+    if models is not None:
+        return models
+    use_main = _claim_main_models()
+    if AGE_ENGINE == "yolo_head":
+        # ไม่มี interpreter ของโมเดลอายุ: อายุคำนวณจาก feature ของ YOLO ตัวนี้
+        yolo = yolo_model if use_main else YOLO(yolo_model_path, task="detect")
+        models = {
+            "yolo": yolo,
+            "age_interpreter": None,
+            "age_input_details": None,
+            "age_output_details": None,
+            "yolo_features": attach_feature_hooks(yolo),
+        }
+    elif use_main:
+        models = {
+            "yolo": yolo_model,
+            "age_interpreter": age_interpreter,
+            "age_input_details": age_input_details,
+            "age_output_details": age_output_details,
+        }
+    else:
+        interpreter, input_details, output_details = load_age_interpreter()
+        models = {
+            "yolo": YOLO(yolo_model_path, task="detect"),
+            "age_interpreter": interpreter,
+            "age_input_details": input_details,
+            "age_output_details": output_details,
+        }
+    _worker_local.models = models
+    return models
+
+# TFLite interpreter ตัวหลัก (ตรวจสอบโมเดลตอนเริ่ม server แล้วเป็นของ worker แรก) ถูกโหลดใน startup_models()
+age_interpreter, age_input_details, age_output_details = None, None, None
+
+# ไม่ใช้ initializer: ถ้าโหลดโมเดลไม่สำเร็จครั้งเดียว pool จะเป็น BrokenThreadPool ถาวร
+# โมเดลของแต่ละ thread สร้างเมื่อเรียก get_worker_models() ครั้งแรกแทน
+inference_executor = ThreadPoolExecutor(
+    max_workers=INFERENCE_WORKERS,
+    thread_name_prefix="inference",
+)
+
+# ตัวนับ request ที่รับเข้าระบบแล้ว (กำลังรัน + รอคิว)
+_inflight_lock = threading.Lock()
+_inflight = 0
+_running = 0
 
-# โหลด TFLite interpreter
-age_interpreter = tf.lite.Interpreter(model_path=age_model)
-age_interpreter.allocate_tensors()
+def try_admit():
+    """จองที่ในคิว inference; คืน False ถ้าคิวเต็ม"""
+    global _inflight
+    with _inflight_lock:
+        if _inflight >= INFERENCE_QUEUE_SIZE:
+            return False
+        _inflight += 1
+        return True
 
-# เตรียมรายละเอียด input/output ของ TFLite
-age_input_details = age_interpreter.get_input_details()
-age_output_details = age_interpreter.get_output_details()
+def release():
+    """คืนที่ในคิว inference หลัง request เสร็จ"""
+    global _inflight
+    with _inflight_lock:
+        _inflight -= 1
+
+def queue_stats():
+    """สถานะคิว inference ปัจจุบัน"""
+    with _inflight_lock:
+        return {
+            "workers": INFERENCE_WORKERS,
+            "capacity": INFERENCE_QUEUE_SIZE,
+            "in_flight": _inflight,
+            "running": _running,
+            "queued": max(0, _inflight - _running),
+        }
 
 # ช่วงวัย (ตามที่โมเดลเทรนไว้)
 age_labels = ["cat_kitten","cat_young","cat_adult","cat_senior",
@@ -67,194 +553,1964 @@ def preprocess_for_age(crop_img):
     img = cv2.cvtColor(crop_img, cv2.COLOR_BGR2RGB)
     img = cv2.resize(img, (224,224))
     img = np.expand_dims(img, axis=0).astype(np.float32)  # (1,224,224,3)
-    # ใช้ preprocess_input ของ MobileNetV2 ซึ่งจะ scale เป็น [-1,1]
-    img = preprocess_input(img)
+    # scale เป็น [-1,1] แบบเดียวกับ preprocess_input ของ MobileNetV2 (ไม่ต้อง import TensorFlow)
+    img = img / 127.5 - 1.0
     return img
 
-def tflite_predict_age(interpreter, input_details, output_details, preprocessed_img):
+AGE_INPUT_SIZE = (224, 224)
+
+def _get_crop_buffer(name, n, dtype):
+    """
+    buffer (AGE_BATCH_SIZE,224,224,3) ที่ใช้ซ้ำได้ของ worker thread ปัจจุบัน คืนค่า view ขนาด n แถวแรก
+    ผู้เรียกแบ่ง crop เป็นก้อนละไม่เกิน AGE_BATCH_SIZE (predict_ages) buffer จึงไม่โตตามขนาด request
+    ถ้า n ใหญ่กว่านั้นจะได้ buffer ชั่วคราวที่ไม่ถูกเก็บไว้
+    """
+    if n > AGE_BATCH_SIZE:
+        return np.empty((n,) + AGE_INPUT_SIZE + (3,), dtype=dtype)
+    buffers = getattr(_worker_local, "crop_buffers", None)
+    if buffers is None:
+        buffers = _worker_local.crop_buffers = {}
+    buf = buffers.get(name)
+    if buf is None:
+        buf = buffers[name] = np.empty((AGE_BATCH_SIZE,) + AGE_INPUT_SIZE + (3,), dtype=dtype)
+    return buf[:n]
+
+def accepts_raw_pixels(input_detail):
+    """
+    True ถ้าโมเดล quantized รับ uint8 ที่ scale/zero-point เท่ากับ [-1,1] -> [0,255] พอดี
+    (scale = 1/127.5, zero_point = 128) ซึ่ง quantize([-1,1]) ของ pixel p ได้ p เอง จึงส่ง pixel ได้ตรงๆ
+    """
+    if input_detail['dtype'] != np.uint8:
+        return False
+    scale, zero_point = input_detail['quantization']
+    return bool(scale) and abs(scale * 127.5 - 1.0) < 1e-3 and zero_point == 128
+
+def preprocess_crops_batch(crops, input_detail):
+    """
+    preprocess ทุก crop ลง buffer (N,224,224,3) ที่ใช้ซ้ำ แทนการเรียก preprocess_for_age ทีละ crop
+    - crops: list ของ crop BGR uint8 (view ของภาพเต็ม ตามกล่องที่ clamp แล้ว ไม่ copy)
+    - resize ลง buffer โดยตรง, สลับ BGR -> RGB ด้วย cvtColor ครั้งเดียวทั้ง batch
+    - scale เป็น [-1,1] แบบ in-place หรือข้ามไปเลยถ้าโมเดล uint8 รับ pixel ได้ตรงๆ
+    คืนค่า: uint8 (N,224,224,3) สำหรับโมเดลที่รับ pixel ตรงๆ หรือ float32 (N,224,224,3) in [-1,1]
+    """
+    n = len(crops)
+    pixels = _get_crop_buffer("pixels", n, np.uint8)
+    for k, crop in enumerate(crops):
+        cv2.resize(crop, AGE_INPUT_SIZE, dst=pixels[k])
+    # มอง batch เป็นภาพเดียวขนาด (N*224, 224) เพื่อสลับสีในการเรียกครั้งเดียว
+    flat = pixels.reshape(-1, AGE_INPUT_SIZE[0], 3)
+    cv2.cvtColor(flat, cv2.COLOR_BGR2RGB, dst=flat)
+
+    if accepts_raw_pixels(input_detail):
+        return pixels
+
+    scaled = _get_crop_buffer("scaled", n, np.float32)
+    np.multiply(pixels, 1.0 / 127.5, out=scaled, casting="unsafe")
+    np.subtract(scaled, 1.0, out=scaled)
+    return scaled
+
+def quantize_tensor(values, detail):
+    """
+    แปลงค่า float เป็นชนิดของ tensor quantized ด้วย q = round(x / scale) + zero_point
+    - detail: รายละเอียด tensor จาก get_input_details() (ใช้ 'quantization' และ 'dtype')
+    """
+    dtype = detail['dtype']
+    scale, zero_point = detail['quantization']
+    if not scale:
+        # ไม่มีข้อมูล quantization (ไม่ควรเกิดกับโมเดลที่แปลงด้วย แปลง.py) -> ใช้การประมาณ [-1,1] -> [0,255]
+        return ((values + 1.0) * 127.5).astype(dtype)
+    info = np.iinfo(dtype)
+    q = np.round(values / scale) + zero_point
+    return np.clip(q, info.min, info.max).astype(dtype)
+
+def dequantize_tensor(values, detail):
+    """แปลงค่าจาก tensor quantized กลับเป็น float32: x = (q - zero_point) * scale"""
+    scale, zero_point = detail['quantization']
+    if not scale:
+        return values.astype(np.float32)
+    return (values.astype(np.float32) - zero_point) * scale
+
+def _set_age_batch_size(interpreter, input_details, batch_size):
     """
-    ทำ inference ด้วย tflite interpreter
-    - preprocessed_img: numpy array float32 shape (1,224,224,3) in [-1,1]
-    - จัดการกรณี input dtype เป็น uint8 (quantized) หรือ float32
-    คืนค่า: (age_idx, probs_array) หรือ (None, None) ถ้ามีปัญหา
+    ปรับขนาด batch ของ input tensor เป็น (batch_size,224,224,3)
+    จะ allocate ใหม่เฉพาะตอนที่ขนาดเปลี่ยนเท่านั้น
     """
-    if preprocessed_img is None:
-        return None, None
+    input_index = input_details[0]['index']
+    current = interpreter.get_input_details()[0]['shape']
+    if current[0] == batch_size:
+        return
+    interpreter.resize_tensor_input(input_index, [batch_size] + list(current[1:]))
+    interpreter.allocate_tensors()
+
+def tflite_predict_age_batch(interpreter, input_details, output_details, preprocessed_batch):
+    """
+    ทำ inference หลาย crop ในการ invoke ครั้งเดียว
+    - preprocessed_batch: numpy array float32 shape (N,224,224,3) in [-1,1]
+      หรือ uint8 pixel ถ้าโมเดลรับได้ตรงๆ (ดู accepts_raw_pixels)
+    - แบ่งเป็นก้อนละไม่เกิน AGE_BATCH_SIZE; ถ้าโมเดลไม่รองรับการ resize batch จะ invoke ทีละ crop
+    คืนค่า: array probs shape (N, num_classes) หรือ None ถ้ามีปัญหา
+    """
+    if preprocessed_batch is None or len(preprocessed_batch) == 0:
+        return None
 
     input_dtype = input_details[0]['dtype']
     input_index = input_details[0]['index']
     output_index = output_details[0]['index']
 
     # จัดเตรียม input ตาม dtype ของ interpreter
-    if input_dtype == np.uint8:
-        # ถ้าโมเดล quantized รับ uint8, แปลงจาก [-1,1] -> [0,255] (ประมาณ)
-        # วิธีแปลงนี้ขึ้นกับวิธีแปลงที่ใช้ตอน convert tflite; ปรับได้ถ้าต้องการ
-        input_data = ((preprocessed_img + 1.0) * 127.5).astype(np.uint8)
+    if preprocessed_batch.dtype == input_dtype:
+        # preprocess_crops_batch เตรียมไว้ตรงชนิดแล้ว (pixel uint8 หรือ float32 [-1,1]) ไม่ต้อง copy
+        input_data = preprocessed_batch
+    elif np.issubdtype(input_dtype, np.integer):
+        # โมเดล quantized (uint8/int8): ใช้ scale/zero-point จริงของ input tensor
+        input_data = quantize_tensor(preprocessed_batch, input_details[0])
     else:
-        # default float32
-        input_data = preprocessed_img.astype(np.float32)
+        input_data = preprocessed_batch.astype(np.float32)
 
+    chunk_size = AGE_BATCH_SIZE
+    outputs = []
+    start = 0
     try:
-        interpreter.set_tensor(input_index, input_data)
-        interpreter.invoke()
-        output_data = interpreter.get_tensor(output_index)  # shape (1, num_classes)
-        probs = np.squeeze(output_data)
-        # ถ้า output ยังไม่ normalized ให้ softmax
-        if probs.ndim == 1 and not (0.99 <= probs.sum() <= 1.01):
-            e = np.exp(probs - np.max(probs))
-            probs = e / e.sum()
-        age_idx = int(np.argmax(probs))
-        return age_idx, probs
+        while start < len(input_data):
+            chunk = input_data[start:start + chunk_size]
+            try:
+                _set_age_batch_size(interpreter, input_details, len(chunk))
+            except Exception as e:
+                if chunk_size == 1:
+                    raise
+                # โมเดลที่ batch คงที่ (1,...) resize ไม่ได้ -> ถอยไป invoke ทีละ crop
+                print("TFLite batch resize not supported, falling back to batch 1:", e)
+                chunk_size = 1
+                continue
+            interpreter.set_tensor(input_index, chunk)
+            interpreter.invoke()
+            outputs.append(np.array(interpreter.get_tensor(output_index)))  # shape (n, num_classes)
+            start += len(chunk)
     except Exception as e:
-        # ถ้าการ inference ผิดพลาด ให้คืน None
         print("TFLite inference error:", e)
-        return None, None
+        return None
+
+    probs = np.concatenate(outputs, axis=0)
+    if np.issubdtype(probs.dtype, np.integer):
+        # output quantized -> แปลงกลับเป็นค่าจริงด้วย scale/zero-point ของ output tensor
+        probs = dequantize_tensor(probs, output_details[0])
+    probs = probs.astype(np.float32)
+    # ถ้า output ยังไม่ normalized ให้ softmax รายแถว
+    sums = probs.sum(axis=1)
+    if not np.all((sums >= 0.99) & (sums <= 1.01)):
+        e = np.exp(probs - probs.max(axis=1, keepdims=True))
+        probs = e / e.sum(axis=1, keepdims=True)
+    return probs
+
+def decode_image_bytes(data):
+    """
+    ถอดรหัสภาพจาก bytes (เช่นเนื้อไฟล์ที่อัพโหลด) เป็น BGR uint8 ด้วย cv2.imdecode
+    คืนค่า None ถ้าข้อมูลว่างหรือไม่ใช่ภาพ
+    """
+    if not data:
+        return None
+    buf = np.frombuffer(data, dtype=np.uint8)
+    return cv2.imdecode(buf, cv2.IMREAD_COLOR)
+
+# ถอดรหัส JPEG ขนาดใหญ่แบบย่อ (DCT scaling 1/2, 1/4, 1/8) ให้เหลือแค่พอสำหรับ YOLO
+DECODE_DOWNSCALE = os.environ.get("DECODE_DOWNSCALE", "1") == "1"
+# crop สำหรับโมเดลอายุที่ด้านยาวเล็กกว่านี้ในภาพที่ย่อ จะ crop จากภาพความละเอียดเต็มแทน
+AGE_CROP_MIN_SIDE = int(os.environ.get("AGE_CROP_MIN_SIDE", "224"))
+
+_REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+# จำนวนไบต์แรกที่ read_image_size ใช้หา SOF ของ JPEG (EXIF/ICC ขนาดปกติอยู่ในช่วงนี้)
+JPEG_SCAN_BYTES = 64 * 1024
+
+def read_image_size(data):
+    """
+    อ่านขนาดภาพจาก header โดยไม่ถอดรหัสทั้งภาพ (JPEG SOF / PNG IHDR)
+    คืนค่า: (width, height, "jpeg" | "png") หรือ None ถ้าไม่รู้จักรูปแบบ
+    """
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big"), "png"
+    if data[:2] != b"\xff\xd8":
+        return None
+    # SOF มาก่อน SOS เสมอ และอยู่ในส่วนต้นของไฟล์: สแกนแค่ JPEG_SCAN_BYTES แรก
+    # ฟังก์ชันนี้ทำงานบน event loop ต้องไม่ไล่ทีละไบต์ทั้งไฟล์
+    end = min(len(data), JPEG_SCAN_BYTES)
+    i = 2
+    while i + 9 < end:
+        if data[i] != 0xFF:
+            i = data.find(b"\xff", i, end)
+            if i < 0:
+                return None
+            continue
+        marker = data[i + 1]
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+            i += 1 if marker == 0xFF else 2
+            continue
+        # SOS / EOI: ผ่านตำแหน่งที่ SOF ต้องอยู่มาแล้ว
+        if marker in (0xDA, 0xD9):
+            return None
+        length = int.from_bytes(data[i + 2:i + 4], "big")
+        # SOF0..SOF15 (ยกเว้น DHT 0xC4, JPG 0xC8, DAC 0xCC) มีขนาดภาพ
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = int.from_bytes(data[i + 5:i + 7], "big")
+            width = int.from_bytes(data[i + 7:i + 9], "big")
+            return width, height, "jpeg"
+        i += 2 + length
+    return None
+
+class DecodedImage:
+    """
+    ภาพที่ถอดรหัสแล้วสำหรับ pipeline
+    - image: ภาพที่ส่งเข้า YOLO (อาจถูกย่อตอนถอดรหัส)
+    - full_w, full_h: ขนาดจริงของภาพ (bbox ใน JSON อยู่ในพิกัดนี้เสมอ)
+    - full(): ภาพความละเอียดเต็ม ถอดรหัสเมื่อต้องใช้ครั้งแรกเท่านั้น (สำหรับ crop ของสัตว์ตัวเล็ก)
+    """
+
+    def __init__(self, image, data=None, full_size=None):
+        self.image = image
+        self.data = data
+        h, w = image.shape[:2]
+        self.full_w, self.full_h = full_size or (w, h)
+        self.scale_x = self.full_w / w
+        self.scale_y = self.full_h / h
+        self.reduced = (self.full_w, self.full_h) != (w, h)
+        self._full = None if self.reduced else image
+
+    def full(self):
+        if self._full is None:
+            full = decode_image_bytes(self.data) if self.data is not None else None
+            # ถ้าถอดรหัสเต็มไม่ได้ ใช้ภาพย่อขยายกลับแทน
+            self._full = full if full is not None else cv2.resize(self.image, (self.full_w, self.full_h))
+        return self._full
+
+    def crop(self, x1, y1, x2, y2):
+        """crop ตามกล่องในพิกัดภาพจริง: ใช้ภาพย่อถ้าละเอียดพอ ไม่เช่นนั้นใช้ภาพเต็ม"""
+        if self.reduced:
+            rx1, ry1 = int(x1 / self.scale_x), int(y1 / self.scale_y)
+            rx2, ry2 = int(x2 / self.scale_x), int(y2 / self.scale_y)
+            if max(rx2 - rx1, ry2 - ry1) >= AGE_CROP_MIN_SIDE:
+                return self.image[ry1:ry2, rx1:rx2]
+        return self.full()[y1:y2, x1:x2]
+
+def decode_for_detection(data):
+    """
+    ถอดรหัส bytes ของภาพสำหรับ pipeline
+    JPEG ที่ใหญ่กว่า YOLO_IMGSZ หลายเท่าจะถอดรหัสแบบย่อ (IMREAD_REDUCED_*) ซึ่งเร็วและใช้หน่วยความจำน้อยกว่ามาก
+    คืนค่า: DecodedImage หรือ None ถ้าไม่ใช่ภาพ
+    """
+    if not data:
+        return None
+    size = read_image_size(data) if DECODE_DOWNSCALE else None
+    flag, factor = cv2.IMREAD_COLOR, 1
+    if size is not None and size[2] == "jpeg":
+        for f, reduced_flag in _REDUCED_FLAGS:
+            if max(size[0], size[1]) / f >= YOLO_IMGSZ:
+                flag, factor = reduced_flag, f
+                break
+
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+    if img is None:
+        return None
+    if factor == 1:
+        return DecodedImage(img)
+
+    full_w, full_h = size[0], size[1]
+    h, w = img.shape[:2]
+    # imdecode หมุนภาพตาม EXIF orientation แต่ขนาดใน header เป็นก่อนหมุน
+    if (w > h) != (full_w > full_h):
+        full_w, full_h = full_h, full_w
+    return DecodedImage(img, data, (full_w, full_h))
 
 # =========================
-# Endpoint
+# Result cache
 # =========================
-@app.post("/analyze")
-async def analyze_images(files: list[UploadFile] = File(...)):
+# แคชผลลัพธ์ตาม hash ของภาพที่ถอดรหัสแล้ว + เวอร์ชันโมเดล (ภาพเดิมที่ส่งซ้ำไม่ต้องรันโมเดลใหม่)
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "1024"))   # 0 = ปิดแคช
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", "3600"))   # วินาที, 0 = ไม่หมดอายุ
+# ไฟล์ SQLite สำหรับแคชชั้นที่สองที่อยู่รอดหลัง restart (ว่าง = ไม่ใช้)
+RESULT_CACHE_DB = os.environ.get("RESULT_CACHE_DB", "")
+# จำนวนแถวสูงสุดของแคชบนดิสก์ (แถวที่เก่าที่สุดถูกลบหลังทุก put), 0 = ไม่จำกัด
+RESULT_CACHE_DB_MAX_ROWS = int(os.environ.get("RESULT_CACHE_DB_MAX_ROWS", "100000"))
+
+# ขนาด + เวลาแก้ไขของไฟล์โมเดลที่โหลดอยู่จริง (บันทึกตอนโหลด ไม่ใช่ไฟล์บนดิสก์ ณ ตอนนี้)
+loaded_model_files = {}
+
+def file_signature(path):
+    """ชื่อไฟล์ + ขนาด + เวลาแก้ไข ใช้เป็นเวอร์ชันของไฟล์โมเดล"""
+    try:
+        st = os.stat(path)
+        return f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}"
+    except OSError:
+        return f"{os.path.basename(path)}:missing"
+
+def model_version():
     """
-    รับไฟล์รูปหลายรูป, ทำการตรวจจับด้วย YOLO แล้วประเมินอายุด้วย TFLite model
-    คืน JSON ที่มี path ของรูปผลลัพธ์ในเซิร์ฟเวอร์ และรายละเอียด detections
+    เวอร์ชันของโมเดลทั้งสองที่โหลดไว้ (จาก loaded_model_files) + ค่าที่มีผลต่อผลลัพธ์
+    ถ้าเปลี่ยนไฟล์โมเดลระหว่างที่ server รันอยู่ เวอร์ชันจะยังเป็นของโมเดลในหน่วยความจำจนกว่าจะ restart
+    """
+    parts = [loaded_model_files.get("yolo", "yolo:unloaded"), loaded_model_files.get("age", "age:unloaded")]
+    # ค่าการตรวจจับ/เงื่อนไขอายุเปลี่ยนผลลัพธ์ได้ จึงรวมไว้ใน key ด้วย
+    parts.append(f"det:{YOLO_IMGSZ}:{YOLO_CONF}:{YOLO_IOU}:{YOLO_MAX_DET}:{int(YOLO_AGNOSTIC_NMS)}:{YOLO_CLASS_IOU}")
+    # AGE_CROP_MIN_SIDE เลือกว่า crop ของอายุมาจากภาพย่อหรือภาพเต็ม
+    parts.append(f"gate:{AGE_MIN_DET_CONFIDENCE}:{AGE_MIN_CROP_AREA}:{MAX_ANIMALS_PER_IMAGE}:{AGE_CROP_MIN_SIDE}")
+    return "|".join(parts)
+
+class ResultCache:
+    """
+    แคชผลลัพธ์ต่อภาพ: LRU ในหน่วยความจำ (จำกัดจำนวน + TTL) และ SQLite บนดิสก์ (ถ้าตั้งค่า)
+    ค่าที่เก็บคือ result dict ของ build_result โดยไม่รวม "original_file"
+    ใช้งานได้หลัง set_version() (เรียกครั้งเดียวหลังโหลดโมเดล) ก่อนหน้านั้น get/put ไม่ทำอะไร
+    """
+
+    def __init__(self, max_entries, ttl, db_path="", db_max_rows=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_max_rows = db_max_rows
+        self.lock = threading.Lock()      # LRU ในหน่วยความจำ + สถิติ
+        self.db_lock = threading.Lock()   # connection ของ SQLite (I/O ของดิสก์ไม่ถือ self.lock)
+        self.entries = OrderedDict()   # key -> (expires_at, result)
+        self.version = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db_path = db_path
+        self._db, self._db_pid = None, None
+
+    @property
+    def db(self):
+        """
+        connection ของ SQLite ของ process ปัจจุบัน (เปิดเมื่อใช้ครั้งแรก เรียกภายใต้ db_lock)
+        ไม่เปิดตอน import: connection ที่เปิดก่อน fork (gunicorn preload) ห้ามใช้ต่อใน process ลูก
+        """
+        if self._db is None or self._db_pid != os.getpid():
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+            db.executescript(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, version TEXT, expires_at REAL, result TEXT);"
+                "CREATE INDEX IF NOT EXISTS results_expires_at ON results (expires_at);"
+            )
+            db.commit()
+            self._db, self._db_pid = db, os.getpid()
+        return self._db
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def set_version(self, version):
+        """ตั้งเวอร์ชันของโมเดลที่โหลดอยู่ และล้างผลของเวอร์ชันอื่น (ทั้งในหน่วยความจำและบนดิสก์)"""
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+            self.version = version
+        if self.db_path:
+            with self.db_lock:
+                self.db.execute("DELETE FROM results WHERE version != ?", (version,))
+                self.db.commit()
+
+    def make_key(self, img):
+        """hash ของ pixel ของภาพที่ถอดรหัสแล้ว (รวม shape)"""
+        h = hashlib.blake2b(digest_size=20)
+        h.update(str(img.shape).encode())
+        h.update(np.ascontiguousarray(img).data)
+        return h.hexdigest()
+
+    def get(self, key):
+        if not self.enabled or self.version is None:
+            return None
+        now = time.time()
+        with self.lock:
+            version = self.version
+            item = self.entries.get(key)
+            if item is not None:
+                expires_at, result = item
+                if not self.ttl or expires_at > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return result
+                del self.entries[key]
+
+        if self.db_path:
+            with self.db_lock:
+                row = self.db.execute(
+                    "SELECT expires_at, result FROM results WHERE key = ? AND version = ?",
+                    (key, version),
+                ).fetchone()
+            if row is not None and (not self.ttl or row[0] > now):
+                result = json.loads(row[1])
+                with self.lock:
+                    if self.version == version:
+                        self._put_memory(key, row[0], result)
+                    self.disk_hits += 1
+                return result
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, result):
+        if not self.enabled or self.version is None:
+            return
+        expires_at = time.time() + self.ttl if self.ttl else 0.0
+        with self.lock:
+            version = self.version
+            self._put_memory(key, expires_at, result)
+        if self.db_path:
+            payload = json.dumps(result)
+            with self.db_lock:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO results (key, version, expires_at, result) VALUES (?, ?, ?, ?)",
+                    (key, version, expires_at, payload),
+                )
+                self._prune_db()
+                self.db.commit()
+
+    def _prune_db(self):
+        # ลบแถวที่หมดอายุ และแถวที่เก่ากว่า db_max_rows แถวล่าสุด (เรียกภายใต้ db_lock)
+        # INSERT OR REPLACE ได้ rowid ใหม่ที่มากกว่าเดิมเสมอ rowid จึงเรียงตามเวลาที่ put
+        if self.ttl:
+            self.db.execute("DELETE FROM results WHERE expires_at > 0 AND expires_at <= ?", (time.time(),))
+        if self.db_max_rows > 0:
+            self.db.execute(
+                "DELETE FROM results WHERE rowid <= (SELECT MAX(rowid) FROM results) - ?",
+                (self.db_max_rows,),
+            )
+
+    def _put_memory(self, key, expires_at, result):
+        self.entries[key] = (expires_at, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "version": self.version,
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "disk": bool(self.db_path),
+                "disk_max_rows": self.db_max_rows,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL, RESULT_CACHE_DB, RESULT_CACHE_DB_MAX_ROWS)
+
+# =========================
+# Detection (batch)
+# =========================
+def _shape_buckets(images):
     """
-    all_results = []
+    จัดกลุ่ม index ของภาพตามขนาด (h, w) แล้วแบ่งเป็นก้อนละไม่เกิน YOLO_BATCH_SIZE
+    ภาพขนาดเท่ากันใน batch เดียวกันทำให้ ultralytics letterbox แบบ rect ได้ (padding น้อยลง)
+    """
+    buckets = {}
+    for idx, img in enumerate(images):
+        buckets.setdefault(img.shape[:2], []).append(idx)
+
+    chunks = []
+    for indices in buckets.values():
+        for start in range(0, len(indices), YOLO_BATCH_SIZE):
+            chunks.append(indices[start:start + YOLO_BATCH_SIZE])
+    return chunks
 
-    for file in files:
-        # บันทึกไฟล์ที่อัพโหลด
-        file_id = str(uuid.uuid4())
-        filename = file.filename
-        file_path = os.path.join(UPLOAD_FOLDER, f"{file_id}_{filename}")
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+def _attach_roi_features(res, captured, j):
+    """เก็บ feature map ของภาพที่ j ใน batch ไว้กับ Results (AGE_ENGINE=yolo_head)"""
+    res.roi_features = [feat[j:j + 1] for feat in captured["features"]]
+    res.input_hw = captured["input_hw"]
 
-        # YOLO ตรวจจับ
+def yolo_detect_batch(images):
+    """
+    ตรวจจับด้วย YOLO ทีละ batch แทนการเรียก yolo_model() ทีละไฟล์
+    - images: list ของภาพ BGR uint8 (ndarray)
+    คืนค่า: list ยาวเท่า images, แต่ละช่องเป็น (Results, None) หรือ (None, error_message)
+    """
+    models = get_worker_models()
+    model = models["yolo"]
+    captured = models.get("yolo_features")
+    outputs = [None] * len(images)
+
+    for chunk in _shape_buckets(images):
+        batch = [images[i] for i in chunk]
         try:
-            yolo_out = yolo_model(file_path)[0]  # ผลของ ultralytics
+            results = model(batch, **YOLO_PREDICT_ARGS)
+            for j, (i, res) in enumerate(zip(chunk, results)):
+                if captured is not None:
+                    _attach_roi_features(res, captured, j)
+                outputs[i] = (res, None)
         except Exception as e:
-            # ถ้า YOLO ผิดพลาด
-            all_results.append({
-                "original_file": filename,
-                "error": f"YOLO inference error: {str(e)}"
-            })
+            # ถ้าทั้ง batch ผิดพลาด ลองทีละภาพเพื่อให้ error ผูกกับไฟล์ที่เป็นต้นเหตุ
+            print("YOLO batch inference error:", e)
+            for i in chunk:
+                try:
+                    res = model(images[i], **YOLO_PREDICT_ARGS)[0]
+                    if captured is not None:
+                        _attach_roi_features(res, captured, 0)
+                    outputs[i] = (res, None)
+                except Exception as e_single:
+                    outputs[i] = (None, f"YOLO inference error: {str(e_single)}")
+
+    return outputs
+
+def _parse_class_iou(text):
+    """แปลง "persian_cat:0.5,pug_dog:0.6" เป็น dict {label: iou}"""
+    thresholds = {}
+    for item in text.split(","):
+        if ":" in item:
+            label, iou = item.rsplit(":", 1)
+            thresholds[label.strip()] = float(iou)
+    return thresholds
+
+YOLO_CLASS_IOU_THRESHOLDS = _parse_class_iou(YOLO_CLASS_IOU)
+
+def apply_class_nms(raw_boxes):
+    """
+    NMS เพิ่มเติมเฉพาะคลาสที่กำหนด IoU ไว้ใน YOLO_CLASS_IOU (เข้มกว่า YOLO_IOU ของ YOLO)
+    - raw_boxes: list ของ (x1, y1, x2, y2, conf, label, track_id)
+    """
+    if not YOLO_CLASS_IOU_THRESHOLDS:
+        return raw_boxes
+    keep = []
+    by_label = {}
+    for box in raw_boxes:
+        by_label.setdefault(box[5], []).append(box)
+    for label, boxes in by_label.items():
+        iou = YOLO_CLASS_IOU_THRESHOLDS.get(label)
+        if iou is None or len(boxes) < 2:
+            keep.extend(boxes)
+            continue
+        rects = [[b[0], b[1], b[2] - b[0], b[3] - b[1]] for b in boxes]
+        scores = [b[4] for b in boxes]
+        indices = cv2.dnn.NMSBoxes(rects, scores, 0.0, iou)
+        keep.extend(boxes[int(k)] for k in np.array(indices).flatten())
+    # คงลำดับตามความมั่นใจแบบเดียวกับผลของ YOLO
+    return sorted(keep, key=lambda b: -b[4])
+
+def age_gate_reasons(raw_boxes):
+    """
+    เหตุผลที่ไม่ประเมินอายุของแต่ละกล่อง (None = ประเมินอายุ)
+    ตามค่า AGE_MIN_DET_CONFIDENCE, AGE_MIN_CROP_AREA และ MAX_ANIMALS_PER_IMAGE
+    """
+    reasons = [None] * len(raw_boxes)
+    for i, (x1, y1, x2, y2, conf, *_) in enumerate(raw_boxes):
+        if conf < AGE_MIN_DET_CONFIDENCE:
+            reasons[i] = "low_confidence"
+        elif (x2 - x1) * (y2 - y1) < AGE_MIN_CROP_AREA:
+            reasons[i] = "small_crop"
+    if MAX_ANIMALS_PER_IMAGE > 0:
+        # เก็บเฉพาะกล่องที่มั่นใจที่สุด N กล่อง (ในกลุ่มที่ผ่านเงื่อนไขอื่นแล้ว)
+        eligible = sorted((i for i, r in enumerate(reasons) if r is None), key=lambda i: -raw_boxes[i][4])
+        for i in eligible[MAX_ANIMALS_PER_IMAGE:]:
+            reasons[i] = "max_animals"
+    return reasons
+
+def parse_detections(decoded, yolo_out):
+    """
+    แปลงกล่องจาก YOLO ของภาพหนึ่งภาพเป็น list ของ detections + crop ของแต่ละกล่อง
+    - decoded: DecodedImage; กล่องจาก YOLO อยู่ในพิกัดของ decoded.image จึงต้อง scale กลับเป็นพิกัดภาพจริง
+    กล่องที่ไม่ผ่านเงื่อนไข (age_gate_reasons) ยังอยู่ใน detections แต่ไม่มี crop และมี "age_skipped"
+    คืนค่า: (detections, cropped_animals) ยาวเท่ากัน; crop เป็น None ถ้ากล่องไม่ถูกต้องหรือถูกข้าม
+    """
+    detections = []
+    cropped_animals = []
+    h_full, w_full = decoded.full_h, decoded.full_w
+
+    # loop boxes
+    raw_boxes = []
+    for det in yolo_out.boxes:
+        try:
+            x1, y1, x2, y2 = det.xyxy[0].tolist()
+            x1, x2 = x1 * decoded.scale_x, x2 * decoded.scale_x
+            y1, y2 = y1 * decoded.scale_y, y2 * decoded.scale_y
+            conf = float(det.conf[0])
+            cls = int(det.cls[0])
+            label = yolo_model.names[cls] if hasattr(yolo_model, "names") else str(cls)
+            # clamp coords
+            x1i, y1i = max(0, int(x1)), max(0, int(y1))
+            x2i, y2i = min(w_full-1, int(x2)), min(h_full-1, int(y2))
+            # track id มีเฉพาะผลจาก model.track() (live camera)
+            track_id = int(det.id[0]) if det.id is not None else None
+            raw_boxes.append((x1i, y1i, x2i, y2i, conf, label, track_id))
+        except Exception as e:
+            errors_total.inc("parse")
+            print("Error parsing detection:", e)
             continue
 
-        detections = []
-        cropped_animals = []
+    raw_boxes = apply_class_nms(raw_boxes)
+    reasons = age_gate_reasons(raw_boxes)
 
-        # อ่านภาพเพื่อ crop
-        img_cv_full = cv2.imread(file_path)
-        if img_cv_full is None:
-            all_results.append({
-                "original_file": filename,
-                "error": "ไม่สามารถอ่านไฟล์ภาพได้"
-            })
+    for (x1i, y1i, x2i, y2i, conf, label, track_id), reason in zip(raw_boxes, reasons):
+        detection = {
+            "label": label,
+            "confidence": conf,
+            "bbox": [x1i, y1i, x2i, y2i]
+        }
+        if track_id is not None:
+            detection["track_id"] = track_id
+        age_gate_total.inc(reason or "evaluated")
+
+        # crop image (ถ้าขนาดถูกต้องและผ่านเงื่อนไข)
+        if reason is not None:
+            detection["age_skipped"] = reason
+            crop_img = None
+        elif x2i > x1i and y2i > y1i and AGE_ENGINE == "yolo_head":
+            # ไม่ crop ภาพ: ส่ง feature ของภาพ + กล่องในพิกัด input ของ YOLO ให้ predict_ages แทน
+            box = (x1i / decoded.scale_x, y1i / decoded.scale_y, x2i / decoded.scale_x, y2i / decoded.scale_y)
+            crop_img = (yolo_out.roi_features, yolo_out.input_hw,
+                        to_input_coords(box, decoded.image.shape[:2], yolo_out.input_hw))
+        elif x2i > x1i and y2i > y1i:
+            crop_img = decoded.crop(x1i, y1i, x2i, y2i)
+        else:
+            crop_img = None
+        detections.append(detection)
+        cropped_animals.append(crop_img)
+
+    return detections, cropped_animals
+
+def predict_ages(crops, timings=None):
+    """
+    ประเมินอายุของทุก crop (จากทุกภาพใน request) ด้วย TFLite เป็น batch ละไม่เกิน AGE_BATCH_SIZE
+    - timings: dict ที่จะสะสมเวลาขั้นตอน preprocess และ age (ถ้าให้มา)
+    คืนค่า: list ยาวเท่า crops, แต่ละช่องเป็น {"age_range", "confidence"} หรือ None
+    """
+    if AGE_ENGINE == "yolo_head":
+        return predict_ages_from_rois(crops, timings)
+    age_results = [None] * len(crops)
+    valid = [i for i, crop in enumerate(crops) if crop is not None and crop.size > 0]
+    if not valid:
+        return age_results
+
+    models = get_worker_models()
+    # preprocess + invoke ทีละก้อน (AGE_BATCH_SIZE) buffer ของ crop จึงมีขนาดคงที่ไม่ว่า request จะมีกี่ crop
+    for start in range(0, len(valid), AGE_BATCH_SIZE):
+        chunk = valid[start:start + AGE_BATCH_SIZE]
+        with stage_timer("preprocess", timings):
+            batch = preprocess_crops_batch([crops[i] for i in chunk], models["age_input_details"][0])
+        with stage_timer("age", timings):
+            probs = tflite_predict_age_batch(
+                models["age_interpreter"],
+                models["age_input_details"],
+                models["age_output_details"],
+                batch
+            )
+        if probs is None:
+            errors_total.inc("age", len(chunk))
             continue
-        h_full, w_full = img_cv_full.shape[:2]
 
-        # loop boxes
-        for det in yolo_out.boxes:
-            try:
-                x1, y1, x2, y2 = det.xyxy[0].tolist()
-                conf = float(det.conf[0])
-                cls = int(det.cls[0])
-                label = yolo_model.names[cls] if hasattr(yolo_model, "names") else str(cls)
-                # clamp coords
-                x1i, y1i = max(0, int(x1)), max(0, int(y1))
-                x2i, y2i = min(w_full-1, int(x2)), min(h_full-1, int(y2))
-
-                detections.append({
-                    "label": label,
-                    "confidence": conf,
-                    "bbox": [x1i, y1i, x2i, y2i]
-                })
-
-                # crop image (ถ้าขนาดถูกต้อง)
-                if x2i > x1i and y2i > y1i:
-                    crop_img = img_cv_full[y1i:y2i, x1i:x2i]
+        for i, p in zip(chunk, probs):
+            age_idx = int(np.argmax(p))
+            age_results[i] = {
+                "age_range": age_labels[age_idx] if age_idx < len(age_labels) else f"idx_{age_idx}",
+                "confidence": float(p[age_idx]),
+            }
+    return age_results
+
+def predict_ages_from_rois(rois, timings=None):
+    """
+    ประเมินอายุด้วย age head จาก feature ของ YOLO (AGE_ENGINE=yolo_head)
+    - rois: list ของ (features, input_hw, box) จาก parse_detections หรือ None
+    คืนค่า: list ยาวเท่า rois ในรูปแบบเดียวกับ predict_ages
+    """
+    import torch
+    age_results = [None] * len(rois)
+    valid = [i for i, roi in enumerate(rois) if roi is not None]
+    if not valid:
+        return age_results
+
+    with stage_timer("age", timings):
+        try:
+            with torch.inference_mode():
+                pooled = torch.cat([
+                    pool_roi_features(rois[i][0], rois[i][1], torch.tensor([rois[i][2]]), age_head_meta["pool_size"])
+                    for i in valid
+                ])
+                probs = age_head(pooled).numpy()
+        except Exception as e:
+            errors_total.inc("age", len(valid))
+            print("Age head inference error:", e)
+            return age_results
+
+    labels = age_head_meta["age_labels"]
+    for i, p in zip(valid, probs):
+        age_idx = int(np.argmax(p))
+        age_results[i] = {
+            "age_range": labels[age_idx] if age_idx < len(labels) else f"idx_{age_idx}",
+            "confidence": float(p[age_idx]),
+        }
+    return age_results
+
+def build_result(filename, detections, age_results):
+    """
+    จัด JSON ผลลัพธ์ของภาพหนึ่งภาพ
+    โครงสร้างต้องตรงกับที่ analyzing_screen.dart อ่าน
+    """
+    if not detections:
+        return {
+            "original_file": filename,
+            "message": "ไม่พบสัตว์ในภาพ (หลัง parse)"
+        }
+
+    result = {
+        "original_file": filename,
+        "detections": []
+    }
+    for i, det in enumerate(detections):
+        entry = {
+            "label": det["label"],
+            "confidence": det["confidence"],
+            "bbox": det["bbox"]
+        }
+        if "track_id" in det:
+            entry["track_id"] = det["track_id"]
+        if i < len(age_results) and age_results[i] is not None:
+            predicted_age = age_results[i]["age_range"]
+            predicted_conf = age_results[i]["confidence"]
+
+            # ปรับอายุให้ตรงประเภทสัตว์จาก YOLO โดยใช้ mapping
+            if "dog" in det["label"].lower():
+                entry["animalType"] = "dog"
+                if predicted_age in age_mapping and predicted_age.startswith("cat_"):
+                    predicted_age = age_mapping[predicted_age]
+            elif "cat" in det["label"].lower():
+                entry["animalType"] = "cat"
+                if predicted_age in age_mapping and predicted_age.startswith("dog_"):
+                    predicted_age = age_mapping[predicted_age]
+
+            entry.update({
+                "age_range": predicted_age,
+                "age_confidence": predicted_conf,
+            })
+        else:
+            entry.update({
+                "age_range": None,
+                "age_confidence": None,
+            })
+            if "age_skipped" in det:
+                entry["age_skipped"] = det["age_skipped"]
+            if det["label"].endswith("_cat"):
+                entry["animalType"] = "cat"
+            elif det["label"].endswith("_dog"):
+                entry["animalType"] = "dog"
+
+        result["detections"].append(entry)
+
+    return result
+
+def run_inference(uploads, timings=None):
+    """
+    รัน pipeline ถอดรหัสภาพ + YOLO + อายุ (ทำงานใน inference worker thread)
+    - uploads: list ของ (index, filename, data) โดย data เป็น bytes, DecodedImage หรือภาพ BGR ที่ถอดรหัสแล้ว
+    - timings: dict ที่จะสะสมเวลาของแต่ละขั้นตอน (วินาที) ถ้าให้มา
+    คืนค่า: dict {index: result}
+    """
+    global _running
+    with _inflight_lock:
+        _running += 1
+    try:
+        results = {}
+        pending = []     # (index, filename, DecodedImage) ของไฟล์ที่อ่านภาพได้และไม่อยู่ในแคช
+        cache_keys = {}  # index -> key ของแคช
+
+        for idx, filename, data in uploads:
+            images_total.inc()
+            # ถอดรหัสครั้งเดียว ภาพเดียวกันใช้ทั้งสำหรับ YOLO และการ crop
+            with stage_timer("decode", timings):
+                if isinstance(data, DecodedImage):
+                    decoded = data
+                elif isinstance(data, np.ndarray):
+                    decoded = DecodedImage(data)
                 else:
-                    crop_img = None
-                cropped_animals.append(crop_img)
-            except Exception as e:
-                print("Error parsing detection:", e)
+                    decoded = decode_for_detection(data)
+            if decoded is None:
+                errors_total.inc("decode")
+                results[idx] = {
+                    "original_file": filename,
+                    "error": "ไม่สามารถอ่านไฟล์ภาพได้"
+                }
                 continue
 
-        if not detections:
-            all_results.append({
-                "original_file": filename,
-                "message": "ไม่พบสัตว์ในภาพ (หลัง parse)"
-            })
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            continue
+            # ภาพที่เคยวิเคราะห์แล้ว (กับโมเดลเวอร์ชันเดียวกัน) ใช้ผลจากแคช
+            if result_cache.enabled:
+                key = result_cache.make_key(decoded.image)
+                cached = result_cache.get(key)
+                if cached is not None:
+                    results[idx] = {"original_file": filename, **cached}
+                    continue
+                cache_keys[idx] = key
+            pending.append((idx, filename, decoded))
 
-        # ประเมินอายุแต่ละ crop ด้วย TFLite
-        age_results = []
-        for crop in cropped_animals:
-            if crop is None or crop.size == 0:
-                age_results.append(None)
+        # YOLO ตรวจจับทุกภาพใน request เป็น batch
+        with stage_timer("yolo", timings):
+            yolo_outputs = yolo_detect_batch([decoded.image for _, _, decoded in pending])
+
+        parsed = []      # (index, filename, detections, offset ของ crop แรกใน all_crops)
+        all_crops = []   # crop ของทุกภาพใน request รวมกันเพื่อประเมินอายุเป็น batch เดียว
+        for (idx, filename, decoded), (yolo_out, yolo_error) in zip(pending, yolo_outputs):
+            if yolo_error is not None:
+                # ถ้า YOLO ผิดพลาด
+                errors_total.inc("yolo")
+                results[idx] = {
+                    "original_file": filename,
+                    "error": yolo_error
+                }
                 continue
-            pre = preprocess_for_age(crop)  # float32 [-1,1]
-            age_idx, probs = tflite_predict_age(
-                age_interpreter,
-                age_input_details,
-                age_output_details,
-                pre
-            )
-            if age_idx is None or probs is None:
-                age_results.append(None)
-            else:
-                age_results.append({
-                    "age_range": age_labels[age_idx] if age_idx < len(age_labels) else f"idx_{age_idx}",
-                    "confidence": float(probs[age_idx]) if len(probs) > age_idx else float(np.max(probs)),
-                })
-
-        # จัด JSON ผลลัพธ์
-        result = {
-            "original_file": file.filename,
-            "detections": []
+            detections, cropped_animals = parse_detections(decoded, yolo_out)
+            detections_per_image.observe(len(detections))
+            parsed.append((idx, filename, detections, len(all_crops)))
+            all_crops.extend(cropped_animals)
+
+        # ประเมินอายุทุก crop ของ batch ด้วยกัน (invoke ละไม่เกิน AGE_BATCH_SIZE crop)
+        all_ages = predict_ages(all_crops, timings)
+
+        with stage_timer("json_build", timings):
+            for idx, filename, detections, offset in parsed:
+                age_results = all_ages[offset:offset + len(detections)]
+                results[idx] = build_result(filename, detections, age_results)
+                if idx in cache_keys:
+                    cached = {k: v for k, v in results[idx].items() if k != "original_file"}
+                    result_cache.put(cache_keys[idx], cached)
+
+        return results
+    finally:
+        with _inflight_lock:
+            _running -= 1
+
+# =========================
+# Startup
+# =========================
+def load_main_yolo():
+    """โหลด YOLO ตัวหลัก (ใช้อ่าน names, ตรวจว่าไฟล์โมเดลใช้ได้ และเป็นโมเดลของ worker แรก)"""
+    global yolo_model_path, yolo_model
+    if "OMP_NUM_THREADS" not in os.environ:
+        # thread ของ torch ใช้ร่วมกันทั้ง process: แบ่ง core แบบเดียวกับ TFLite
+        # ไม่เช่นนั้น YOLO แต่ละ worker ใช้ทุก core พร้อมกัน (OMP_NUM_THREADS ที่ตั้งไว้เองมีผลก่อน)
+        import torch
+        torch.set_num_threads(threads_per_worker())
+    start = time.perf_counter()
+    yolo_model_path, yolo_model = load_yolo_model()
+    loaded_model_files["yolo"] = file_signature(yolo_model_path)
+    startup_timings["load_yolo"] = time.perf_counter() - start
+    print(f"YOLO model: {yolo_model_path}")
+
+def load_main_age_interpreter():
+    """import TFLite runtime และโหลด interpreter ตัวหลัก"""
+    global tflite_runtime_name, tflite
+    global age_interpreter, age_input_details, age_output_details
+    if tflite is None:
+        start = time.perf_counter()
+        tflite_runtime_name, tflite = _load_tflite_module(AGE_RUNTIME)
+        startup_timings["import_tflite"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    loaded_model_files["age"] = file_signature(age_model)
+    age_interpreter, age_input_details, age_output_details = load_age_interpreter()
+    startup_timings["load_age"] = time.perf_counter() - start
+    print(f"Age model: {age_model} (runtime={tflite_runtime_name}, delegate={AGE_DELEGATE}, "
+          f"input={age_input_details[0]['dtype'].__name__})")
+    if AGE_BENCHMARK:
+        benchmark_age_interpreter()
+
+def load_main_age_head():
+    """โหลด age head บน feature ของ YOLO (AGE_ENGINE=yolo_head)"""
+    global age_head, age_head_meta
+    start = time.perf_counter()
+    loaded_model_files["age"] = file_signature(AGE_HEAD_PATH)
+    age_head, age_head_meta = load_age_head()
+    startup_timings["load_age"] = time.perf_counter() - start
+    print(f"Age head: {AGE_HEAD_PATH} (labels={age_head_meta['age_labels']})")
+
+def load_main_age_model():
+    """โหลดโมเดลอายุตาม AGE_ENGINE"""
+    if AGE_ENGINE == "yolo_head":
+        load_main_age_head()
+    else:
+        load_main_age_interpreter()
+
+def warm_up_worker(barrier):
+    """
+    สร้างโมเดลของ worker thread นี้แล้วรัน inference หนึ่งครั้งด้วยภาพสังเคราะห์
+    barrier ทำให้งาน warm-up แต่ละงานไปลงคนละ thread จนครบทุก worker
+    """
+    try:
+        barrier.wait(timeout=300)
+    except threading.BrokenBarrierError:
+        pass
+    models = get_worker_models()
+    dummy = np.zeros((640, 640, 3), dtype=np.uint8)
+    models["yolo"](dummy, **YOLO_PREDICT_ARGS)
+    if AGE_ENGINE == "yolo_head":
+        return
+    crop = np.zeros((224, 224, 3), dtype=np.uint8)
+    tflite_predict_age_batch(
+        models["age_interpreter"],
+        models["age_input_details"],
+        models["age_output_details"],
+        preprocess_for_age(crop)
+    )
+
+# โหลดโมเดลตั้งแต่ import main (ใช้กับ gunicorn --preload: master โหลดครั้งเดียวแล้ว fork worker)
+PRELOAD_MODELS = os.environ.get("PRELOAD_MODELS", "0") == "1"
+
+def preload_models():
+    """
+    โหลด YOLO และ import TFLite runtime ใน master process ก่อน fork
+    worker ทุกตัวจึงใช้น้ำหนักของ YOLO และโค้ดของ torch/TensorFlow ร่วมกันแบบ copy-on-write
+    TFLite interpreter (และ thread pool ของ XNNPACK) ยังสร้างใหม่ในแต่ละ worker หลัง fork
+    """
+    global tflite_runtime_name, tflite
+    load_main_yolo()
+    if yolo_model_path == YOLO_ARTIFACTS["pytorch"]:
+        # fuse Conv+BN ตอนนี้ ไม่เช่นนั้น predictor จะ fuse ใน worker แต่ละตัว (ได้น้ำหนักชุดใหม่ที่ไม่ได้แชร์)
+        yolo_model.fuse()
+    if AGE_ENGINE == "yolo_head":
+        load_main_age_head()
+        return
+    start = time.perf_counter()
+    tflite_runtime_name, tflite = _load_tflite_module(AGE_RUNTIME)
+    startup_timings["import_tflite"] = time.perf_counter() - start
+
+async def startup_models():
+    """
+    โหลด YOLO และ TFLite พร้อมกัน, warm-up ทุก inference worker แล้วจึงเปิดรับงาน (/readyz = 200)
+    ส่วนที่โหลดไว้แล้วด้วย preload_models() จะไม่ถูกโหลดซ้ำ
+    """
+    global models_ready, startup_error
+    loop = asyncio.get_running_loop()
+    total_start = time.perf_counter()
+    try:
+        loaders = [load_main_age_model] if age_head is None else []
+        if yolo_model is None:
+            loaders.append(load_main_yolo)
+        await asyncio.gather(*[loop.run_in_executor(None, loader) for loader in loaders])
+        # เวอร์ชันของแคชผลลัพธ์ผูกกับโมเดลที่เพิ่งโหลด (ไม่เปลี่ยนตามไฟล์บนดิสก์จนกว่าจะ restart)
+        await asyncio.to_thread(result_cache.set_version, model_version())
+
+        start = time.perf_counter()
+        barrier = threading.Barrier(INFERENCE_WORKERS)
+        await asyncio.gather(*[
+            loop.run_in_executor(inference_executor, warm_up_worker, barrier)
+            for _ in range(INFERENCE_WORKERS)
+        ])
+        startup_timings["warm_up"] = time.perf_counter() - start
+    except Exception as e:
+        startup_error = str(e)
+        print("Model startup failed:", e)
+        return
+
+    if MICROBATCH_ENABLED:
+        micro_batcher.start()
+    if JOBS_ENABLED:
+        asyncio.create_task(job_worker())
+    startup_timings["total"] = time.perf_counter() - total_start
+    models_ready = True
+    print("Models ready:", {k: round(v, 3) for k, v in startup_timings.items()})
+
+# =========================
+# Micro-batching
+# =========================
+# รวมภาพจากหลาย request ที่เข้ามาพร้อมกันเป็น batch เดียวก่อนส่งเข้า YOLO/TFLite
+MICROBATCH_ENABLED = os.environ.get("MICROBATCH_ENABLED", "1") == "1"
+# เวลารอสูงสุด (ms) เพื่อรวม request อื่นหลังจากได้ request แรกของ batch
+MICROBATCH_MAX_WAIT_MS = float(os.environ.get("MICROBATCH_MAX_WAIT_MS", "10"))
+# จำนวนภาพสูงสุดต่อ batch (request เดียวที่มีภาพมากกว่านี้จะไม่ถูกแบ่ง)
+MICROBATCH_MAX_IMAGES = int(os.environ.get("MICROBATCH_MAX_IMAGES", str(YOLO_BATCH_SIZE)))
+
+class MicroBatcher:
+    """
+    ตัวรวม request: รอ request แรก แล้วเก็บ request ถัดไปจนครบ max_images หรือหมดเวลา max_wait
+    จากนั้นรัน run_inference ครั้งเดียวใน worker pool และแจกผลกลับไปยัง future ของแต่ละ request
+    """
+
+    def __init__(self, max_wait_ms, max_images, max_concurrent_batches):
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_images = max_images
+        self.queue = None
+        self.task = None
+        self.slots = None
+        self.max_concurrent_batches = max_concurrent_batches
+        # สถิติขนาด batch ที่ทำได้จริง
+        self.batches = 0
+        self.images = 0
+        self.requests = 0
+        self.image_histogram = {}
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        # จำกัด batch ที่รันพร้อมกันเท่าจำนวน worker เพื่อให้ request ที่มาระหว่างรอ ถูกรวมเป็น batch ถัดไป
+        self.slots = asyncio.Semaphore(self.max_concurrent_batches)
+        self.task = asyncio.create_task(self._collect_loop())
+
+    async def submit(self, uploads):
+        """
+        ส่งภาพของ request หนึ่งเข้าคิว แล้วรอผลลัพธ์
+        คืนค่า: (dict {index: result}, timings ของ batch ที่ request นี้อยู่)
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((uploads, future))
+        return await future
+
+    async def _collect_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.slots.acquire()
+            batch = [await self.queue.get()]
+            n_images = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            while n_images < self.max_images:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                n_images += len(item[0])
+            asyncio.create_task(self._run_batch(batch, n_images))
+
+    async def _run_batch(self, batch, n_images):
+        try:
+            # key ของแต่ละภาพเป็น (ลำดับ request ใน batch, index ภายใน request)
+            merged = [((r, idx), filename, data)
+                      for r, (uploads, _) in enumerate(batch)
+                      for idx, filename, data in uploads]
+            self.batches += 1
+            self.images += n_images
+            self.requests += len(batch)
+            self.image_histogram[n_images] = self.image_histogram.get(n_images, 0) + 1
+
+            loop = asyncio.get_running_loop()
+            try:
+                timings = {}
+                results = await loop.run_in_executor(inference_executor, run_inference, merged, timings)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+
+            per_request = [{} for _ in batch]
+            for (r, idx), result in results.items():
+                per_request[r][idx] = result
+            for (_, future), res in zip(batch, per_request):
+                if not future.done():
+                    future.set_result((res, timings))
+        finally:
+            self.slots.release()
+
+    def stats(self):
+        return {
+            "enabled": MICROBATCH_ENABLED,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "max_images": self.max_images,
+            "batches": self.batches,
+            "images": self.images,
+            "requests": self.requests,
+            "avg_images_per_batch": self.images / self.batches if self.batches else 0.0,
+            "avg_requests_per_batch": self.requests / self.batches if self.batches else 0.0,
+            "pending_requests": self.queue.qsize() if self.queue is not None else 0,
+            "batch_size_histogram": {str(k): v for k, v in sorted(self.image_histogram.items())},
         }
-        for i, det in enumerate(detections):
-            entry = {
-                "label": det["label"],
-                "confidence": det["confidence"],
-                "bbox": det["bbox"]
+
+micro_batcher = MicroBatcher(MICROBATCH_MAX_WAIT_MS, MICROBATCH_MAX_IMAGES, INFERENCE_WORKERS)
+
+async def infer_uploads(uploads, timings=None):
+    """
+    รัน decode + inference ของ uploads ใน worker pool เพื่อไม่ให้ event loop ค้าง
+    ถ้าเปิด micro-batching จะรวมกับ request อื่นที่เข้ามาพร้อมกัน (timings เป็นของทั้ง batch)
+    คืนค่า: dict {index: result}
+    """
+    if MICROBATCH_ENABLED:
+        results, batch_timings = await micro_batcher.submit(uploads)
+        if timings is not None:
+            timings.update(batch_timings)
+        return results
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(inference_executor, run_inference, uploads, timings)
+
+def not_ready_response():
+    """คืน response 503 ถ้าโมเดลยังไม่พร้อม, คืน None ถ้าพร้อมรับงาน"""
+    if not models_ready:
+        return JSONResponse(
+            status_code=503,
+            content={"error": "เซิร์ฟเวอร์กำลังโหลดโมเดล กรุณาลองใหม่อีกครั้ง"},
+            headers={"Retry-After": str(INFERENCE_RETRY_AFTER)},
+        )
+    return None
+
+# =========================
+# Upload limits
+# =========================
+# ขีดจำกัดของไฟล์ที่อัพโหลด (ตรวจระหว่างอ่าน body ก่อนถอดรหัสภาพ)
+UPLOAD_MAX_FILES = int(os.environ.get("UPLOAD_MAX_FILES", "32"))
+UPLOAD_MAX_FILE_BYTES = int(os.environ.get("UPLOAD_MAX_FILE_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_MAX_REQUEST_BYTES = int(os.environ.get("UPLOAD_MAX_REQUEST_BYTES", str(100 * 1024 * 1024)))
+# bytes ของไฟล์อัพโหลดที่อยู่ในหน่วยความจำพร้อมกันได้ (รวมทุก request) ถ้าเต็มจะตอบ 503, 0 = ไม่จำกัด
+UPLOAD_INFLIGHT_BYTES = int(os.environ.get("UPLOAD_INFLIGHT_BYTES", str(512 * 1024 * 1024)))
+# ขนาดภาพสูงสุดจาก header (กันภาพที่ไฟล์เล็กแต่ถอดรหัสแล้วใหญ่มาก / decompression bomb)
+# ภาพรูปแบบอื่นนอกจาก JPEG/PNG ใช้ขีดจำกัดของ OpenCV เอง (OPENCV_IO_MAX_IMAGE_PIXELS)
+IMAGE_MAX_PIXELS = int(os.environ.get("IMAGE_MAX_PIXELS", str(50_000_000)))
+IMAGE_MAX_SIDE = int(os.environ.get("IMAGE_MAX_SIDE", "16384"))
+
+class UploadRejected(Exception):
+    """request ถูกปฏิเสธก่อนเข้าสู่ inference (ตอบกลับด้วย status_code และข้อความ error)"""
+
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+@app.exception_handler(UploadRejected)
+async def upload_rejected_handler(request, exc):
+    headers = {"Retry-After": str(INFERENCE_RETRY_AFTER)} if exc.status_code == 503 else None
+    return JSONResponse(status_code=exc.status_code, content={"error": exc.message}, headers=headers)
+
+def admit_inference():
+    """
+    จองที่ในคิว inference ตอนส่งงานเข้า worker pool (หลังอ่าน body แล้ว ไม่ใช่ตอนเริ่ม request)
+    upload ที่ช้าจึงไม่กินที่ในคิว; คิวเต็ม -> UploadRejected (503) ต้องเรียก release() เมื่องานเสร็จ
+    """
+    if not try_admit():
+        errors_total.inc("admission")
+        raise UploadRejected(503, "เซิร์ฟเวอร์ไม่ว่าง กรุณาลองใหม่อีกครั้ง")
+
+class ByteBudget:
+    """งบจำนวน bytes ที่จองได้พร้อมกัน (ใช้ร่วมกันทุก request)"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.used = 0
+        self.rejected = 0
+
+    def try_acquire(self, n):
+        with self.lock:
+            if self.capacity > 0 and self.used + n > self.capacity:
+                self.rejected += 1
+                return False
+            self.used += n
+            return True
+
+    def release(self, n):
+        with self.lock:
+            self.used -= n
+
+    def stats(self):
+        with self.lock:
+            return {"capacity": self.capacity, "in_flight_bytes": self.used, "rejected": self.rejected}
+
+upload_budget = ByteBudget(UPLOAD_INFLIGHT_BYTES)
+
+def check_image_size(data):
+    """ตรวจขนาดภาพจาก header โดยไม่ถอดรหัส คืนข้อความ error หรือ None ถ้าผ่าน (หรือไม่รู้จักรูปแบบ)"""
+    size = read_image_size(data)
+    if size is None:
+        return None
+    width, height, _ = size
+    if width > IMAGE_MAX_SIDE or height > IMAGE_MAX_SIDE or width * height > IMAGE_MAX_PIXELS:
+        return f"ภาพมีขนาดใหญ่เกินกำหนด ({width}x{height})"
+    return None
+
+class UploadReader:
+    """
+    อ่านไฟล์ที่อัพโหลด (multipart field "files") จาก body ทีละ chunk พร้อมบังคับขีดจำกัด
+    - ตรวจ Content-Type / Content-Length และจอง upload_budget ก่อนอ่าน body (ไม่ผ่าน -> UploadRejected)
+    - จำนวนไฟล์เกิน max_files หรือ bytes รวมเกิน max_request_bytes ระหว่างอ่าน -> UploadRejected (413)
+    - ไฟล์ที่ใหญ่เกิน UPLOAD_MAX_FILE_BYTES หรือขนาดภาพใน header เกินกำหนด ไม่ถูกเก็บ และได้ error เฉพาะไฟล์นั้น
+    - streaming=True: ผู้เรียกเก็บแต่ละไฟล์ออกไปทันทีที่ได้ (เช่นลง job store) จึงจองงบแค่ขนาดไฟล์เดียว
+      แทนทั้ง request
+    ต้องเรียก close() เมื่อไม่ใช้ bytes ของไฟล์แล้ว เพื่อคืน budget
+    """
+
+    def __init__(self, request, max_files=UPLOAD_MAX_FILES, max_request_bytes=UPLOAD_MAX_REQUEST_BYTES,
+                 streaming=False):
+        self.request = request
+        self.max_files = max_files
+        self.max_request_bytes = max_request_bytes
+        self.streaming = streaming
+        self.reserved = 0
+        _, params = parse_options_header(request.headers.get("content-type", ""))
+        self.boundary = params.get(b"boundary")
+        if not self.boundary:
+            raise UploadRejected(400, "ไม่พบ multipart boundary ใน Content-Type")
+
+        content_length = request.headers.get("content-length", "")
+        self.content_length = int(content_length) if content_length.isdigit() else None
+        if self.content_length is not None and self.content_length > max_request_bytes:
+            errors_total.inc("upload_limit")
+            raise UploadRejected(413, f"ขนาด request เกิน {max_request_bytes} bytes")
+        if streaming:
+            self._reserve(min(self.content_length or UPLOAD_MAX_FILE_BYTES, UPLOAD_MAX_FILE_BYTES))
+        elif self.content_length is not None:
+            self._reserve(self.content_length)
+
+    def _reserve(self, n):
+        if not upload_budget.try_acquire(n):
+            errors_total.inc("upload_budget")
+            raise UploadRejected(503, "เซิร์ฟเวอร์ไม่ว่าง กรุณาลองใหม่อีกครั้ง")
+        self.reserved += n
+
+    def close(self):
+        upload_budget.release(self.reserved)
+        self.reserved = 0
+
+    async def files(self):
+        """
+        yield (filename, bytes, error) ของแต่ละไฟล์ทันทีที่ part นั้นอ่านครบ โดยไม่ต้องรอทั้ง request
+        ไฟล์ที่ถูกปฏิเสธมี bytes เป็น None และ error เป็นข้อความ
+        """
+        part = {"headers": {}, "field": b"", "value": b"", "data": bytearray(),
+                "filename": None, "too_large": False}
+        state = {"files": 0, "too_many": False}
+        completed = []
+
+        def on_part_begin():
+            part["headers"] = {}
+            part["data"] = bytearray()
+            part["filename"] = None
+            part["too_large"] = False
+
+        def on_header_field(data, start, end):
+            part["field"] += data[start:end]
+
+        def on_header_value(data, start, end):
+            part["value"] += data[start:end]
+
+        def on_header_end():
+            part["headers"][part["field"].lower()] = part["value"]
+            part["field"], part["value"] = b"", b""
+
+        def on_headers_finished():
+            # นับไฟล์ตั้งแต่อ่าน header ของ part เสร็จ (ยังไม่ต้องอ่านเนื้อไฟล์)
+            _, options = parse_options_header(part["headers"].get(b"content-disposition", b""))
+            filename = options.get(b"filename")
+            if options.get(b"name") == b"files" and filename is not None:
+                part["filename"] = filename.decode("utf-8", "replace")
+                state["files"] += 1
+                if state["files"] > self.max_files:
+                    state["too_many"] = True
+
+        def on_part_data(data, start, end):
+            if part["filename"] is None or part["too_large"]:
+                return
+            if len(part["data"]) + (end - start) > UPLOAD_MAX_FILE_BYTES:
+                # ทิ้งเนื้อไฟล์ที่อ่านมาแล้ว และไม่เก็บส่วนที่เหลือ
+                part["too_large"] = True
+                part["data"] = bytearray()
+                return
+            part["data"] += data[start:end]
+
+        def on_part_end():
+            if part["filename"] is not None:
+                if part["too_large"]:
+                    error = f"ไฟล์มีขนาดเกิน {UPLOAD_MAX_FILE_BYTES} bytes"
+                else:
+                    error = check_image_size(part["data"])
+                if error is not None:
+                    errors_total.inc("upload_limit")
+                    completed.append((part["filename"], None, error))
+                else:
+                    completed.append((part["filename"], bytes(part["data"]), None))
+            part["data"] = bytearray()
+
+        parser = MultipartParser(self.boundary, {
+            "on_part_begin": on_part_begin,
+            "on_header_field": on_header_field,
+            "on_header_value": on_header_value,
+            "on_header_end": on_header_end,
+            "on_headers_finished": on_headers_finished,
+            "on_part_data": on_part_data,
+            "on_part_end": on_part_end,
+        })
+        total = 0
+        async for chunk in self.request.stream():
+            total += len(chunk)
+            # Content-Length อาจไม่มี (chunked) หรือไม่ตรงกับ body จริง จึงนับซ้ำระหว่างอ่าน
+            if total > self.max_request_bytes:
+                errors_total.inc("upload_limit")
+                raise UploadRejected(413, f"ขนาด request เกิน {self.max_request_bytes} bytes")
+            if self.content_length is None and not self.streaming:
+                self._reserve(len(chunk))
+            parser.write(chunk)
+            if state["too_many"]:
+                errors_total.inc("upload_limit")
+                raise UploadRejected(413, f"จำนวนไฟล์เกิน {self.max_files} ไฟล์ต่อ request")
+            while completed:
+                yield completed.pop(0)
+        parser.finalize()
+        while completed:
+            yield completed.pop(0)
+
+# =========================
+# Jobs (bulk analysis)
+# =========================
+# งานวิเคราะห์จำนวนมากแบบ asynchronous: POST /jobs แล้วตามผลด้วย GET /jobs/{id}
+JOBS_ENABLED = os.environ.get("JOBS_ENABLED", "1") == "1"
+# ไฟล์ SQLite ที่เก็บสถานะงาน + ภาพที่ยังไม่ได้วิเคราะห์ (อยู่รอดหลัง restart)
+JOBS_DB = os.environ.get("JOBS_DB", "jobs.db")
+# จำนวนภาพต่อรอบของ job worker = ระยะของ checkpoint (ผลถูก commit หลังจบแต่ละรอบ)
+# ถ้า process ตายกลางรอบ ภาพในรอบนั้น (ไม่เกิน JOBS_BATCH_SIZE ภาพ) จะถูกวิเคราะห์ใหม่หลัง restart
+# 1 = checkpoint ทุกภาพ (ไม่เสียงานเลย แต่ YOLO/อายุไม่ได้ batch ข้ามภาพ), ค่ามากขึ้น = throughput สูงขึ้น
+JOBS_BATCH_SIZE = int(os.environ.get("JOBS_BATCH_SIZE", "32"))
+# ขีดจำกัดการอัพโหลดของ POST /jobs (แยกจาก /analyze: งานหนึ่งอาจมีภาพหลายร้อยรูป)
+# แต่ละไฟล์ถูกเขียนลง job store ทันทีที่อ่านครบ ในหน่วยความจำจึงมีทีละไฟล์ (UPLOAD_MAX_FILE_BYTES ยังใช้ต่อไฟล์)
+JOBS_MAX_FILES = int(os.environ.get("JOBS_MAX_FILES", "10000"))
+JOBS_MAX_REQUEST_BYTES = int(os.environ.get("JOBS_MAX_REQUEST_BYTES", str(10 * 1024 * 1024 * 1024)))
+# งานที่ค้างสถานะ uploading (process ตายระหว่างรับไฟล์) นานเกินกี่วินาทีจะถูกลบ
+JOBS_UPLOAD_TIMEOUT = float(os.environ.get("JOBS_UPLOAD_TIMEOUT", "3600"))
+# เก็บงานที่เสร็จแล้ว (พร้อมผล) ไว้กี่วินาทีหลังเสร็จ ก่อนลบออกจาก JOBS_DB (0 = เก็บตลอด)
+JOBS_RETENTION = float(os.environ.get("JOBS_RETENTION", "604800"))
+
+class JobStore:
+    """
+    ที่เก็บงานใน SQLite
+    - jobs: สถานะของงาน (uploading / queued / running / done)
+    - job_images: ภาพของแต่ละงาน; เมื่อวิเคราะห์แล้วเก็บ result และลบ bytes ของภาพทิ้ง
+    ผลของภาพถูก commit พร้อมกันหลังจบแต่ละรอบ (JOBS_BATCH_SIZE ภาพ) งานที่ค้างตอน crash จึงทำต่อเฉพาะภาพที่ยังไม่มีผล
+    (ภาพของรอบที่ยังไม่ได้ commit ถูกวิเคราะห์ซ้ำ)
+    งานที่เสร็จเกิน JOBS_RETENTION วินาทีถูกลบใน next_batch(); ไฟล์ใช้ auto_vacuum แบบ incremental
+    จึงคืนพื้นที่ให้ระบบหลังลบได้โดยไม่ต้อง VACUUM ทั้งไฟล์
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.path = path
+        self._db, self._db_pid = None, None
+
+    @property
+    def db(self):
+        """
+        connection ของ SQLite ของ process ปัจจุบัน (เปิดเมื่อใช้ครั้งแรก เรียกภายใต้ self.lock)
+        ไม่เปิดตอน import: connection ที่เปิดก่อน fork (gunicorn preload) ห้ามใช้ต่อใน process ลูก
+        แต่ละ worker process จึงมี connection ของตัวเอง และใช้ lock ของไฟล์ SQLite ร่วมกันได้ถูกต้อง
+        """
+        if self._db is None or self._db_pid != os.getpid():
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                # ไฟล์ใหม่หรือไฟล์เดิมที่ยังไม่เปิด incremental: ต้อง VACUUM หนึ่งครั้งเพื่อเปลี่ยนโหมด
+                db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                db.execute("VACUUM")
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, status TEXT, total INTEGER, completed INTEGER,"
+                " created_at REAL, updated_at REAL);"
+                "CREATE TABLE IF NOT EXISTS job_images ("
+                " job_id TEXT, idx INTEGER, filename TEXT, data BLOB, result TEXT,"
+                " PRIMARY KEY (job_id, idx));"
+            )
+            db.commit()
+            self._db, self._db_pid = db, os.getpid()
+        return self._db
+
+    def begin(self):
+        """
+        สร้างงานใหม่ในสถานะ uploading (job worker ยังไม่หยิบไปทำ) คืนค่า job id
+        เพิ่มภาพด้วย add_image() ทีละไฟล์ แล้วเรียก finish_upload() เมื่อรับไฟล์ครบ
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO jobs (id, status, total, completed, created_at, updated_at) VALUES (?, 'uploading', 0, 0, ?, ?)",
+                (job_id, now, now),
+            )
+            self.db.commit()
+        return job_id
+
+    def add_image(self, job_id, idx, filename, data, error=None):
+        """
+        เพิ่มภาพหนึ่งไฟล์ (filename, bytes, error จาก UploadReader) ให้งานที่กำลังอัพโหลด
+        ไฟล์ที่ถูกปฏิเสธตอนอัพโหลด (error ไม่ใช่ None) ถูกบันทึกผลเป็น error ทันที
+        """
+        result = None
+        if error is not None:
+            result = json.dumps({"original_file": filename, "error": error}, ensure_ascii=False)
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO job_images (job_id, idx, filename, data, result) VALUES (?, ?, ?, ?, ?)",
+                (job_id, idx, filename, data, result),
+            )
+            self.db.execute(
+                "UPDATE jobs SET total = total + 1, completed = completed + ?, updated_at = ? WHERE id = ?",
+                (int(result is not None), time.time(), job_id),
+            )
+            self.db.commit()
+
+    def finish_upload(self, job_id):
+        """
+        รับไฟล์ครบแล้ว: เปิดให้ job worker ทำงาน (หรือปิดงานเลยถ้าทุกไฟล์ถูกปฏิเสธ)
+        คืนค่า: สถานะใหม่ของงาน ("queued" หรือ "done")
+        """
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET status = CASE WHEN completed >= total THEN 'done' ELSE 'queued' END,"
+                " updated_at = ? WHERE id = ?",
+                (time.time(), job_id),
+            )
+            self.db.commit()
+            return self.db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+
+    def delete(self, job_id):
+        """ลบงานและภาพทั้งหมดของงาน (เช่นการอัพโหลดที่ล้มเหลว)"""
+        with self.lock:
+            self.db.execute("DELETE FROM job_images WHERE job_id = ?", (job_id,))
+            self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            self.db.commit()
+
+    def _purge(self):
+        """
+        ลบงานที่อัพโหลดค้างจาก process ที่ตายไปแล้ว (ไม่มีใครทำต่อ) และงานที่เสร็จเกิน JOBS_RETENTION
+        แล้วคืนพื้นที่ของหน้าที่ว่างให้ระบบ (เรียกภายใต้ self.lock)
+        """
+        now = time.time()
+        expired = [r[0] for r in self.db.execute(
+            "SELECT id FROM jobs WHERE (status = 'uploading' AND updated_at < ?)"
+            " OR (status = 'done' AND ? > 0 AND updated_at < ?)",
+            (now - JOBS_UPLOAD_TIMEOUT, JOBS_RETENTION, now - JOBS_RETENTION),
+        ).fetchall()]
+        if not expired:
+            return
+        for job_id in expired:
+            self.db.execute("DELETE FROM job_images WHERE job_id = ?", (job_id,))
+            self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        self.db.commit()
+        # incremental_vacuum คืนหนึ่งหน้าต่อหนึ่ง step: execute() ของ sqlite3 step ครั้งเดียว จึงใช้ executescript()
+        self.db.executescript("PRAGMA incremental_vacuum")
+
+    def next_batch(self, limit):
+        """
+        ภาพที่ยังไม่มีผลของงานที่เก่าที่สุดที่ยังไม่เสร็จ (ลบงานที่หมดอายุก่อนทุกครั้ง)
+        คืนค่า: (job_id, [(idx, filename, bytes)]) หรือ (None, [])
+        """
+        with self.lock:
+            self._purge()
+
+            while True:
+                row = self.db.execute(
+                    "SELECT id FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    return None, []
+                job_id = row[0]
+                rows = self.db.execute(
+                    "SELECT idx, filename, data FROM job_images WHERE job_id = ? AND result IS NULL ORDER BY idx LIMIT ?",
+                    (job_id, limit),
+                ).fetchall()
+                if rows:
+                    break
+                # ทุกภาพมีผลแล้ว (เช่น crash หลังบันทึกผลรอบสุดท้าย) -> ปิดงานแล้วหางานถัดไป
+                self.db.execute("UPDATE jobs SET status = 'done', updated_at = ? WHERE id = ?", (time.time(), job_id))
+                self.db.commit()
+
+            self.db.execute("UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ?", (time.time(), job_id))
+            self.db.commit()
+            return job_id, [(idx, filename, bytes(data)) for idx, filename, data in rows]
+
+    def save_results(self, job_id, results):
+        """checkpoint: บันทึกผลของภาพในรอบนี้ (และลบ bytes ของภาพ) ใน transaction เดียว"""
+        with self.lock:
+            self.db.executemany(
+                "UPDATE job_images SET result = ?, data = NULL WHERE job_id = ? AND idx = ?",
+                [(json.dumps(result, ensure_ascii=False), job_id, idx) for idx, result in results.items()],
+            )
+            completed = self.db.execute(
+                "SELECT COUNT(*) FROM job_images WHERE job_id = ? AND result IS NOT NULL", (job_id,)
+            ).fetchone()[0]
+            total = self.db.execute("SELECT total FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+            status = "done" if completed >= total else "running"
+            self.db.execute(
+                "UPDATE jobs SET completed = ?, status = ?, updated_at = ? WHERE id = ?",
+                (completed, status, time.time(), job_id),
+            )
+            self.db.commit()
+
+    def get(self, job_id, include_results=True):
+        """สถานะ + ผลของงาน (เรียงตามลำดับไฟล์) หรือ None ถ้าไม่พบ"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT status, total, completed, created_at, updated_at FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            status, total, completed, created_at, updated_at = row
+            job = {
+                "job_id": job_id,
+                "status": status,
+                "total": total,
+                "completed": completed,
+                "progress": completed / total if total else 1.0,
+                "created_at": created_at,
+                "updated_at": updated_at,
             }
-            if i < len(age_results) and age_results[i] is not None:
-                predicted_age = age_results[i]["age_range"]
-                predicted_conf = age_results[i]["confidence"]
-
-                # ปรับอายุให้ตรงประเภทสัตว์จาก YOLO โดยใช้ mapping
-                if "dog" in det["label"].lower():
-                    entry["animalType"] = "dog"
-                    if predicted_age in age_mapping and predicted_age.startswith("cat_"):
-                        predicted_age = age_mapping[predicted_age]
-                elif "cat" in det["label"].lower():
-                    entry["animalType"] = "cat"
-                    if predicted_age in age_mapping and predicted_age.startswith("dog_"):
-                        predicted_age = age_mapping[predicted_age]
-
-                entry.update({
-                    "age_range": predicted_age,
-                    "age_confidence": predicted_conf,
-                })
-            else:
-                entry.update({
-                    "age_range": None,
-                    "age_confidence": None,
-                })
-                if det["label"].endswith("_cat"):
-                    entry["animalType"] = "cat"
-                elif det["label"].endswith("_dog"):
-                    entry["animalType"] = "dog"
-
-            result["detections"].append(entry)
-
-        all_results.append(result)
-
-        # ลบไฟล์ input ชั่วคราว
-        if os.path.exists(file_path):
-            os.remove(file_path)
-
-    return JSONResponse(content={"results": all_results})
\ No newline at end of file
+            if include_results:
+                rows = self.db.execute(
+                    "SELECT result FROM job_images WHERE job_id = ? AND result IS NOT NULL ORDER BY idx", (job_id,)
+                ).fetchall()
+                job["results"] = [json.loads(r[0]) for r in rows]
+            return job
+
+job_store = JobStore(JOBS_DB) if JOBS_ENABLED else None
+# ปลุก job worker เมื่อมีงานใหม่
+job_wakeup = asyncio.Event()
+
+_jobs_lock_file = None
+
+def acquire_jobs_lock():
+    """
+    ล็อกไฟล์ข้าง JOBS_DB ให้ job worker ทำงานเพียง process เดียว (เมื่อรันหลาย worker process)
+    ล็อกถูกปล่อยเองเมื่อ process จบ; คืน False ถ้า process อื่นถือล็อกอยู่
+    """
+    global _jobs_lock_file
+    if fcntl is None:
+        return True
+    f = open(JOBS_DB + ".lock", "w")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    _jobs_lock_file = f
+    return True
+
+async def job_worker():
+    """
+    ประมวลผลงานทีละรอบ (สูงสุด JOBS_BATCH_SIZE ภาพ) ผ่าน pipeline เดียวกับ /analyze
+    บันทึกผลหลังจบทุกรอบ (checkpoint ต่อรอบ ไม่ใช่ต่อภาพ เพื่อให้ YOLO/อายุรันเป็น batch ได้);
+    งานที่ค้างจาก restart ครั้งก่อนถูกทำต่ออัตโนมัติ
+    """
+    loop = asyncio.get_running_loop()
+    # หลาย worker process ใช้ jobs.db เดียวกัน: รอจนได้ล็อก (process ที่ถือล็อกตาย -> process อื่นทำต่อ)
+    while not acquire_jobs_lock():
+        await asyncio.sleep(5.0)
+    while True:
+        try:
+            job_id, batch = await asyncio.to_thread(job_store.next_batch, JOBS_BATCH_SIZE)
+            if job_id is None:
+                job_wakeup.clear()
+                try:
+                    await asyncio.wait_for(job_wakeup.wait(), timeout=5.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            results = await loop.run_in_executor(inference_executor, run_inference, batch)
+            await asyncio.to_thread(job_store.save_results, job_id, results)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            errors_total.inc("jobs")
+            print("Job worker error:", e)
+            await asyncio.sleep(1.0)
+
+# =========================
+# Live camera (WebSocket)
+# =========================
+# จำนวน WebSocket live camera ที่เปิดพร้อมกันได้ (แต่ละ session มี YOLO + tracker ของตัวเอง)
+LIVE_MAX_SESSIONS = int(os.environ.get("LIVE_MAX_SESSIONS", "2"))
+# tracker ของ ultralytics (bytetrack.yaml หรือ botsort.yaml)
+LIVE_TRACKER = os.environ.get("LIVE_TRACKER", "bytetrack.yaml")
+# ประเมินอายุของ track ใหม่ครั้งเดียว และประเมินซ้ำเมื่อคุณภาพ crop (พื้นที่ x confidence) ดีขึ้นเกินกี่เท่า
+LIVE_AGE_REFRESH_RATIO = float(os.environ.get("LIVE_AGE_REFRESH_RATIO", "1.5"))
+# ลบอายุที่ cache ไว้ของ track ที่ไม่เห็นมากี่เฟรม
+LIVE_TRACK_TTL_FRAMES = int(os.environ.get("LIVE_TRACK_TTL_FRAMES", "90"))
+
+_live_lock = threading.Lock()
+_live_sessions = 0
+
+def try_open_live_session():
+    global _live_sessions
+    with _live_lock:
+        if _live_sessions >= LIVE_MAX_SESSIONS:
+            return False
+        _live_sessions += 1
+        return True
+
+def close_live_session():
+    global _live_sessions
+    with _live_lock:
+        _live_sessions -= 1
+
+class LiveSession:
+    """
+    สถานะของ live camera หนึ่ง connection
+    - model: YOLO ของ session นี้ (tracker เก็บ track id ข้ามเฟรมไว้ใน predictor ของ model)
+    - ages: track_id -> {"age", "quality", "last_seen"} อายุที่ประเมินแล้วของแต่ละ track
+    ทุก connection โหลด weights ของ YOLO ใหม่ทั้งชุด (ใช้เวลาและหน่วยความจำเท่าโมเดลหนึ่งตัว)
+    เพราะ tracker ผูกกับ predictor ของ model จึงใช้โมเดลร่วมกับ session อื่นไม่ได้; จำกัดด้วย LIVE_MAX_SESSIONS
+    """
+
+    def __init__(self):
+        self.model = YOLO(yolo_model_path, task="detect")
+        self.features = attach_feature_hooks(self.model) if AGE_ENGINE == "yolo_head" else None
+        self.ages = {}
+        self.frame = 0
+
+def process_live_frame(session, data):
+    """
+    วิเคราะห์หนึ่งเฟรม (ทำงานใน inference worker thread): YOLO tracking แล้วประเมินอายุเฉพาะ track ใหม่
+    หรือ track ที่ crop มีคุณภาพดีขึ้นกว่าครั้งที่ประเมินไว้ (track อื่นใช้อายุจาก cache)
+    คืนค่า: result แบบเดียวกับ /analyze + "frame" และ "age_evaluated" (จำนวน crop ที่รันโมเดลอายุ)
+    """
+    timings = {}
+    filename = f"frame_{session.frame}"
+    with stage_timer("decode", timings):
+        decoded = decode_for_detection(data)
+    if decoded is None:
+        errors_total.inc("decode")
+        return {"original_file": filename, "error": "ไม่สามารถอ่านไฟล์ภาพได้"}
+
+    with stage_timer("yolo", timings):
+        yolo_out = session.model.track(decoded.image, persist=True, tracker=LIVE_TRACKER, **YOLO_PREDICT_ARGS)[0]
+        if session.features is not None:
+            _attach_roi_features(yolo_out, session.features, 0)
+    detections, crops = parse_detections(decoded, yolo_out)
+
+    # เลือกเฉพาะกล่องที่ต้องรันโมเดลอายุ
+    pending = []
+    for i, det in enumerate(detections):
+        if crops[i] is None:
+            continue
+        x1, y1, x2, y2 = det["bbox"]
+        quality = (x2 - x1) * (y2 - y1) * det["confidence"]
+        cached = session.ages.get(det.get("track_id"))
+        if cached is None or quality > cached["quality"] * LIVE_AGE_REFRESH_RATIO:
+            pending.append((i, quality))
+    new_ages = predict_ages([crops[i] for i, _ in pending], timings)
+
+    age_results = [None] * len(detections)
+    for (i, quality), age in zip(pending, new_ages):
+        age_results[i] = age
+        track_id = detections[i].get("track_id")
+        if age is not None and track_id is not None:
+            session.ages[track_id] = {"age": age, "quality": quality, "last_seen": session.frame}
+    for i, det in enumerate(detections):
+        cached = session.ages.get(det.get("track_id"))
+        if cached is not None:
+            cached["last_seen"] = session.frame
+            if age_results[i] is None:
+                age_results[i] = cached["age"]
+
+    # ลืม track ที่หายไปนานแล้ว
+    for track_id in [t for t, c in session.ages.items() if session.frame - c["last_seen"] > LIVE_TRACK_TTL_FRAMES]:
+        del session.ages[track_id]
+
+    result = build_result(filename, detections, age_results)
+    result["frame"] = session.frame
+    result["age_evaluated"] = len(pending)
+    if METRICS_SERVER_TIMING:
+        result["timings_ms"] = {k: round(v * 1000.0, 1) for k, v in timings.items()}
+    session.frame += 1
+    return result
+
+# =========================
+# Endpoint
+# =========================
+@app.post("/analyze")
+async def analyze_images(request: Request):
+    """
+    รับไฟล์รูปหลายรูป (multipart field "files"), ทำการตรวจจับด้วย YOLO แล้วประเมินอายุด้วย TFLite model
+    คืน JSON ที่มี path ของรูปผลลัพธ์ในเซิร์ฟเวอร์ และรายละเอียด detections
+    ไฟล์ที่เกินขีดจำกัด (UPLOAD_MAX_FILE_BYTES, IMAGE_MAX_*) ได้ error เฉพาะไฟล์นั้น
+    """
+    # ถ้าโมเดลยังโหลดไม่เสร็จ ให้ client ลองใหม่ภายหลัง
+    rejected = not_ready_response()
+    if rejected is not None:
+        return rejected
+
+    request_start = time.perf_counter()
+    reader = None
+    try:
+        # อ่าน bytes ของไฟล์ที่อัพโหลดในหน่วยความจำ (ไม่เขียนลงดิสก์) พร้อมตรวจขีดจำกัด
+        # ระหว่างอ่านยังไม่จองคิว inference (หน่วยความจำถูกจำกัดด้วย upload_budget แทน)
+        request_timings = {}
+        reader = UploadReader(request)
+        with stage_timer("upload_read", request_timings):
+            received = [item async for item in reader.files()]
+        if not received:
+            raise UploadRejected(400, 'ไม่พบไฟล์ที่อัพโหลด (field "files")')
+
+        uploads = [(idx, filename, data) for idx, (filename, data, error) in enumerate(received) if error is None]
+        results = {}
+        if uploads:
+            # คิว inference เต็ม -> 503 ให้ client ลองใหม่ภายหลัง
+            admit_inference()
+            try:
+                results = await infer_uploads(uploads, request_timings)
+            finally:
+                release()
+    finally:
+        if reader is not None:
+            reader.close()
+
+    for idx, (filename, _, error) in enumerate(received):
+        if error is not None:
+            results[idx] = {"original_file": filename, "error": error}
+
+    # ผลลัพธ์เรียงตามลำดับไฟล์ที่อัพโหลด
+    all_results = [results[idx] for idx in range(len(received))]
+
+    request_timings["total"] = time.perf_counter() - request_start
+    request_seconds.observe(request_timings["total"])
+    headers = {"Server-Timing": server_timing_header(request_timings)} if METRICS_SERVER_TIMING else None
+    return JSONResponse(content={"results": all_results}, headers=headers)
+
+@app.post("/analyze/stream")
+async def analyze_images_stream(request: Request, fmt: str = Query("ndjson", alias="format")):
+    """
+    เหมือน /analyze แต่ส่งผลของแต่ละไฟล์กลับทันทีที่วิเคราะห์เสร็จ (ไม่รอครบทุกไฟล์)
+    - format=ndjson (ค่าเริ่มต้น): หนึ่งบรรทัด JSON ต่อไฟล์
+    - format=sse: Server-Sent Events ("data: {...}")
+    แต่ละผลมี "index" (ลำดับไฟล์ใน request) เพิ่มจากโครงสร้างเดิมของ /analyze เพราะลำดับที่ส่งอาจไม่ตรงกับลำดับที่อัพโหลด
+    ไฟล์แต่ละไฟล์ถูกส่งเข้า inference ทันทีที่อ่าน part นั้นครบ (ระหว่างที่ยังอ่าน body ต่อ)
+    body ถูกอ่านจนจบก่อนเริ่มส่ง response: StreamingResponse ฟัง disconnect ด้วย receive() ระหว่างส่ง
+    (บาง version ของ Starlette/ASGI server) จึงอ่าน body จากใน generator ไม่ได้อย่างปลอดภัย
+    ขีดจำกัดการอัพโหลดที่เกินระหว่างอ่านจึงตอบเป็น status code (413/503) เหมือน /analyze
+    คิว inference ถูกจองเมื่อไฟล์แรกพร้อมเข้า inference (ไม่ใช่ตอนเริ่มอ่าน body)
+    """
+    rejected = not_ready_response()
+    if rejected is not None:
+        return rejected
+    queue = asyncio.Queue()
+    tasks = []
+    upload_reader = None
+    admitted = False
+
+    async def process(idx, filename, data, error):
+        if error is not None:
+            result = {"original_file": filename, "error": error}
+        else:
+            try:
+                result = (await infer_uploads([(0, filename, data)]))[0]
+            except Exception as e:
+                result = {"original_file": filename, "error": f"inference error: {str(e)}"}
+        await queue.put({"index": idx, **result})
+
+    try:
+        upload_reader = UploadReader(request)
+        async for filename, data, error in upload_reader.files():
+            if error is None and not admitted:
+                admit_inference()
+                admitted = True
+            tasks.append(asyncio.create_task(process(len(tasks), filename, data, error)))
+        if not tasks:
+            raise UploadRejected(400, 'ไม่พบไฟล์ที่อัพโหลด (field "files")')
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        if upload_reader is not None:
+            upload_reader.close()
+        if admitted:
+            release()
+        raise
+
+    def encode(item):
+        line = json.dumps(item, ensure_ascii=False)
+        return f"data: {line}\n\n" if fmt == "sse" else line + "\n"
+
+    async def body():
+        try:
+            for _ in range(len(tasks)):
+                yield encode(await queue.get())
+        finally:
+            for task in tasks:
+                task.cancel()
+            upload_reader.close()
+            if admitted:
+                release()
+
+    media_type = "text/event-stream" if fmt == "sse" else "application/x-ndjson"
+    return StreamingResponse(body(), media_type=media_type)
+
+@app.post("/jobs", status_code=202)
+async def create_job(request: Request):
+    """
+    สร้างงานวิเคราะห์ภาพจำนวนมาก (ไม่รอผล) คืน job id สำหรับตามผลที่ GET /jobs/{job_id}
+    ผลของแต่ละไฟล์มีโครงสร้างเดียวกับ /analyze
+    ขีดจำกัดจำนวนไฟล์/ขนาด request ใช้ JOBS_MAX_FILES / JOBS_MAX_REQUEST_BYTES (ขนาดต่อไฟล์ใช้เหมือน /analyze)
+    แต่ละไฟล์ถูกเขียนลง job store ทันทีที่อ่าน part นั้นครบ; ถ้าการอัพโหลดล้มเหลว งานทั้งงานถูกลบ
+    """
+    if not JOBS_ENABLED:
+        return JSONResponse(status_code=404, content={"error": "job API ถูกปิดอยู่"})
+    reader = UploadReader(request, JOBS_MAX_FILES, JOBS_MAX_REQUEST_BYTES, streaming=True)
+    job_id = None
+    total = 0
+    try:
+        job_id = await asyncio.to_thread(job_store.begin)
+        async for filename, data, error in reader.files():
+            await asyncio.to_thread(job_store.add_image, job_id, total, filename, data, error)
+            total += 1
+        if not total:
+            raise UploadRejected(400, 'ไม่พบไฟล์ที่อัพโหลด (field "files")')
+        status = await asyncio.to_thread(job_store.finish_upload, job_id)
+    except BaseException:
+        if job_id is not None:
+            # ไม่ทำ I/O ของ SQLite บน event loop; ถ้า request ถูกยกเลิกอีกรอบ thread ก็ยังลบจนเสร็จ
+            await asyncio.to_thread(job_store.delete, job_id)
+        raise
+    finally:
+        reader.close()
+    job_wakeup.set()
+    return {"job_id": job_id, "status": status, "total": total}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, include_results: bool = True):
+    """สถานะ, ความคืบหน้า และผลลัพธ์ (ของภาพที่เสร็จแล้ว) ของงาน"""
+    if not JOBS_ENABLED:
+        return JSONResponse(status_code=404, content={"error": "job API ถูกปิดอยู่"})
+    job = await asyncio.to_thread(job_store.get, job_id, include_results)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "ไม่พบงาน"})
+    return job
+
+@app.websocket("/ws/live")
+async def live_camera(websocket: WebSocket):
+    """
+    live camera: client ส่งเฟรม (JPEG/PNG เป็น binary message) ต่อเนื่อง server ตอบ JSON หนึ่งข้อความต่อเฟรมที่วิเคราะห์
+    - ผลมีโครงสร้างเดียวกับ /analyze และแต่ละ detection มี "track_id" ที่คงที่ข้ามเฟรม
+    - เฟรมที่มาระหว่างที่กำลังวิเคราะห์ (หรือคิว inference เต็ม) ถูกทิ้ง เหลือเฉพาะเฟรมล่าสุด;
+      "dropped" คือจำนวนเฟรมที่ถูกทิ้งสะสม
+    ปิดด้วย code 1013 (Try Again Later) ถ้าโมเดลยังไม่พร้อมหรือ session เต็ม
+    """
+    await websocket.accept()
+    if not models_ready or not try_open_live_session():
+        await websocket.close(code=1013)
+        return
+
+    loop = asyncio.get_running_loop()
+    state = {"latest": None, "dropped": 0, "closed": False}
+    frame_ready = asyncio.Event()
+
+    async def receiver():
+        # รับเฟรมตลอดเวลา แม้กำลังวิเคราะห์เฟรมก่อนหน้า (เก็บแค่เฟรมล่าสุด)
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                data = message.get("bytes")
+                if not data:
+                    continue
+                if state["latest"] is not None:
+                    state["dropped"] += 1
+                state["latest"] = data
+                frame_ready.set()
+        finally:
+            state["closed"] = True
+            frame_ready.set()
+
+    receiver_task = asyncio.create_task(receiver())
+    try:
+        session = await loop.run_in_executor(None, LiveSession)
+        while True:
+            await frame_ready.wait()
+            frame_ready.clear()
+            if state["closed"]:
+                break
+            data, state["latest"] = state["latest"], None
+            if data is None:
+                continue
+            error = f"ไฟล์มีขนาดเกิน {UPLOAD_MAX_FILE_BYTES} bytes" if len(data) > UPLOAD_MAX_FILE_BYTES \
+                else check_image_size(data)
+            if error is not None:
+                await websocket.send_json({"error": error, "dropped": state["dropped"]})
+                continue
+            if not try_admit():
+                state["dropped"] += 1
+                continue
+            try:
+                result = await loop.run_in_executor(inference_executor, process_live_frame, session, data)
+            except Exception as e:
+                errors_total.inc("live")
+                result = {"error": f"inference error: {str(e)}"}
+            finally:
+                release()
+            result["dropped"] = state["dropped"]
+            await websocket.send_json(result)
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        receiver_task.cancel()
+        close_live_session()
+
+@app.get("/queue")
+def get_queue_stats():
+    """สถานะคิว inference และ micro-batching (ใช้ monitor ความหนาแน่นของงาน)"""
+    stats = queue_stats()
+    stats["microbatch"] = micro_batcher.stats()
+    stats["upload"] = upload_budget.stats()
+    stats["live_sessions"] = _live_sessions
+    return stats
+
+@app.get("/cache")
+def get_cache_stats():
+    """สถิติแคชผลลัพธ์ (hit/miss)"""
+    return result_cache.stats()
+
+@app.get("/healthz")
+def healthz():
+    """liveness: process ยังทำงานอยู่ (ไม่รอโมเดล)"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+def readyz():
+    """readiness: โมเดลโหลดและ warm-up เสร็จแล้ว พร้อมรับ /analyze"""
+    content = {
+        "ready": models_ready,
+        "error": startup_error,
+        "timings": {k: round(v, 3) for k, v in startup_timings.items()},
+    }
+    return JSONResponse(status_code=200 if models_ready else 503, content=content)
+
+@app.get("/metrics")
+def metrics():
+    """metrics รูปแบบ Prometheus text: เวลาแต่ละขั้นตอน, detections, errors, แคช, คิว และหน่วยความจำ"""
+    lines = []
+    for metric in (request_seconds, stage_seconds, detections_per_image, images_total, age_gate_total, errors_total):
+        lines.extend(metric.render())
+
+    # ค่า gauge/counter จากสถิติของคิว, micro-batcher และแคช ณ เวลาที่ถูก scrape
+    # ค่าที่เพิ่มขึ้นอย่างเดียวเป็น counter (_total) เพื่อให้ rate() และการ reset ของ Prometheus ถูกต้อง
+    counters = {}
+    q_stats = queue_stats()
+    gauges = {
+        "petbreed_queue_in_flight": q_stats["in_flight"],
+        "petbreed_queue_running": q_stats["running"],
+        "petbreed_queue_queued": q_stats["queued"],
+        "petbreed_queue_capacity": INFERENCE_QUEUE_SIZE,
+        "petbreed_models_ready": int(models_ready),
+    }
+    batch_stats = micro_batcher.stats()
+    counters["petbreed_microbatch_batches_total"] = batch_stats["batches"]
+    gauges["petbreed_microbatch_avg_images_per_batch"] = batch_stats["avg_images_per_batch"]
+    upload_stats = upload_budget.stats()
+    gauges["petbreed_upload_in_flight_bytes"] = upload_stats["in_flight_bytes"]
+    gauges["petbreed_upload_budget_bytes"] = upload_stats["capacity"]
+    gauges["petbreed_live_sessions"] = _live_sessions
+    rss, peak_rss = process_memory_bytes()
+    if rss is not None:
+        gauges["petbreed_process_resident_memory_bytes"] = rss
+    if peak_rss is not None:
+        gauges["petbreed_process_peak_resident_memory_bytes"] = peak_rss
+    cache_stats = result_cache.stats()
+    gauges["petbreed_cache_entries"] = cache_stats["entries"]
+    counters["petbreed_cache_hits_total"] = cache_stats["hits"] + cache_stats["disk_hits"]
+    counters["petbreed_cache_misses_total"] = cache_stats["misses"]
+    for name, value in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    for name, value in counters.items():
+        lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name} {value}")
+
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+if PRELOAD_MODELS:
+    preload_models()
@@ -1,3 +1,7 @@
 #!/bin/bash
 # ใช้ uvicorn bind port จาก environment variable $PORT
+# WEB_CONCURRENCY > 1: รันหลาย worker ด้วย gunicorn (โหลดโมเดลครั้งเดียวแล้ว fork, ดู gunicorn.conf.py)
+if [ "${WEB_CONCURRENCY:-1}" -gt 1 ]; then
+    exec python -m gunicorn -c gunicorn.conf.py main:app
+fi
 exec python -m uvicorn main:app --host 0.0.0.0 --port ${PORT:-8000}
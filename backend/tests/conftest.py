@@ -0,0 +1,8 @@
+import os
+import sys
+
+# import main โดยไม่สร้าง jobs.db / แคชบนดิสก์ และไม่โหลดโมเดล
+os.environ["JOBS_ENABLED"] = "0"
+os.environ["RESULT_CACHE_DB"] = ""
+os.environ["PRELOAD_MODELS"] = "0"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
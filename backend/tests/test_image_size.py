@@ -0,0 +1,57 @@
+import struct
+import time
+
+import cv2
+import numpy as np
+
+import main
+
+def png_header(width, height):
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + struct.pack(">I", len(ihdr)) + b"IHDR" + ihdr + b"\x00" * 4
+
+def jpeg_header(width, height, sof_marker=0xC0):
+    # SOI, APP0 (ข้ามได้), DHT (0xC4 ไม่ใช่ SOF), SOF ที่มีขนาดภาพ
+    app0 = b"\xff\xe0" + struct.pack(">H", 16) + b"JFIF\x00" + b"\x00" * 9
+    dht = b"\xff\xc4" + struct.pack(">H", 5) + b"\x00\x00\x00"
+    sof = bytes([0xFF, sof_marker]) + struct.pack(">HBHHB", 11, 8, height, width, 1) + b"\x01\x11\x00"
+    return b"\xff\xd8" + app0 + dht + sof + b"\x00" * 16
+
+def test_png_size():
+    assert main.read_image_size(png_header(640, 480)) == (640, 480, "png")
+
+def test_jpeg_size_from_sof():
+    assert main.read_image_size(jpeg_header(1920, 1080)) == (1920, 1080, "jpeg")
+    # progressive (SOF2)
+    assert main.read_image_size(jpeg_header(300, 200, 0xC2)) == (300, 200, "jpeg")
+
+def test_jpeg_size_matches_encoded_image():
+    img = np.zeros((123, 321, 3), dtype=np.uint8)
+    ok, buf = cv2.imencode(".jpg", img)
+    assert ok
+    assert main.read_image_size(buf.tobytes()) == (321, 123, "jpeg")
+
+def test_unknown_or_truncated():
+    assert main.read_image_size(b"GIF89a" + b"\x00" * 32) is None
+    assert main.read_image_size(b"") is None
+    assert main.read_image_size(jpeg_header(100, 100)[:10]) is None
+
+def test_check_image_size_limits(monkeypatch):
+    monkeypatch.setattr(main, "IMAGE_MAX_SIDE", 1000)
+    monkeypatch.setattr(main, "IMAGE_MAX_PIXELS", 500_000)
+    assert main.check_image_size(png_header(800, 600)) is None
+    assert main.check_image_size(png_header(1001, 10)) is not None
+    assert main.check_image_size(png_header(900, 900)) is not None
+    assert main.check_image_size(b"not an image") is None
+
+def test_jpeg_without_sof_returns_quickly():
+    # SOI ตามด้วยศูนย์ 20 MB: ต้องไม่ไล่ทีละไบต์ทั้งไฟล์บน event loop
+    data = b"\xff\xd8" + bytes(20 * 1024 * 1024)
+    start = time.perf_counter()
+    assert main.read_image_size(data) is None
+    assert time.perf_counter() - start < 0.1
+
+def test_jpeg_stops_at_sos():
+    sos = b"\xff\xda" + struct.pack(">H", 8) + b"\x00" * 6
+    sof_after_scan = b"\xff\xc0" + struct.pack(">HBHHB", 11, 8, 100, 100, 1) + b"\x01\x11\x00"
+    assert main.read_image_size(b"\xff\xd8" + sos + b"\x00" * 32 + sof_after_scan + b"\x00" * 16) is None
@@ -0,0 +1,47 @@
+import main
+
+def make_job(store, n=2):
+    job_id = store.begin()
+    for i in range(n):
+        store.add_image(job_id, i, f"{i}.jpg", b"x" * 1000)
+    store.finish_upload(job_id)
+    return job_id
+
+def test_finished_jobs_purged_after_retention(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+    monkeypatch.setattr(main, "JOBS_RETENTION", 60)
+    store = main.JobStore(str(tmp_path / "jobs.db"))
+    job_id = make_job(store)
+    batch_job, batch = store.next_batch(10)
+    store.save_results(batch_job, {idx: {"ok": True} for idx, _, _ in batch})
+    assert store.get(job_id)["status"] == "done"
+
+    now[0] += 30
+    store.next_batch(10)
+    assert store.get(job_id) is not None
+    now[0] += 31
+    store.next_batch(10)
+    assert store.get(job_id) is None
+    assert store.db.execute("SELECT COUNT(*) FROM job_images").fetchone()[0] == 0
+
+def test_retention_zero_keeps_jobs(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+    monkeypatch.setattr(main, "JOBS_RETENTION", 0)
+    store = main.JobStore(str(tmp_path / "jobs.db"))
+    job_id = make_job(store)
+    batch_job, batch = store.next_batch(10)
+    store.save_results(batch_job, {idx: {"ok": True} for idx, _, _ in batch})
+    now[0] += 10 ** 9
+    store.next_batch(10)
+    assert store.get(job_id)["status"] == "done"
+
+def test_unfinished_jobs_are_not_purged(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+    monkeypatch.setattr(main, "JOBS_RETENTION", 60)
+    store = main.JobStore(str(tmp_path / "jobs.db"))
+    job_id = make_job(store)
+    now[0] += 3600 * 24
+    assert store.next_batch(10)[0] == job_id
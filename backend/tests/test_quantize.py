@@ -0,0 +1,27 @@
+import numpy as np
+
+import main
+
+def test_uint8_round_trip():
+    detail = {"dtype": np.uint8, "quantization": (1 / 127.5, 128)}
+    values = np.linspace(-1.0, 1.0, 101, dtype=np.float32)
+    q = main.quantize_tensor(values, detail)
+    assert q.dtype == np.uint8
+    back = main.dequantize_tensor(q, detail)
+    assert np.max(np.abs(back - values)) <= detail["quantization"][0] / 2 + 1e-6
+
+def test_int8_round_trip():
+    detail = {"dtype": np.int8, "quantization": (0.0078125, -1)}
+    values = np.linspace(-0.99, 0.99, 57, dtype=np.float32)
+    back = main.dequantize_tensor(main.quantize_tensor(values, detail), detail)
+    assert np.max(np.abs(back - values)) <= detail["quantization"][0] / 2 + 1e-6
+
+def test_quantize_clips_to_dtype_range():
+    detail = {"dtype": np.uint8, "quantization": (1 / 127.5, 128)}
+    q = main.quantize_tensor(np.array([-5.0, 5.0], dtype=np.float32), detail)
+    assert q.tolist() == [0, 255]
+
+def test_accepts_raw_pixels():
+    assert main.accepts_raw_pixels({"dtype": np.uint8, "quantization": (1 / 127.5, 128)})
+    assert not main.accepts_raw_pixels({"dtype": np.uint8, "quantization": (0.02, 128)})
+    assert not main.accepts_raw_pixels({"dtype": np.float32, "quantization": (0.0, 0)})
@@ -0,0 +1,62 @@
+import numpy as np
+
+import main
+
+def make_cache(max_entries=2, ttl=0, db_path="", db_max_rows=0):
+    cache = main.ResultCache(max_entries, ttl, db_path, db_max_rows)
+    cache.set_version("v1")
+    return cache
+
+def test_unused_before_version_is_set():
+    cache = main.ResultCache(2, 0)
+    cache.put("a", {"n": 1})
+    assert cache.get("a") is None
+
+def test_lru_eviction():
+    cache = make_cache(max_entries=2)
+    cache.put("a", {"n": 1})
+    cache.put("b", {"n": 2})
+    assert cache.get("a") == {"n": 1}   # a ใช้ล่าสุด -> b ถูกตัดก่อน
+    cache.put("c", {"n": 3})
+    assert cache.get("b") is None
+    assert cache.get("a") == {"n": 1}
+    assert cache.get("c") == {"n": 3}
+    assert cache.stats()["entries"] == 2
+
+def test_ttl_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+    cache = make_cache(ttl=10)
+    cache.put("a", {"n": 1})
+    now[0] += 5
+    assert cache.get("a") == {"n": 1}
+    now[0] += 10
+    assert cache.get("a") is None
+
+def test_version_change_clears_entries():
+    cache = make_cache()
+    cache.put("a", {"n": 1})
+    cache.set_version("v2")
+    assert cache.get("a") is None
+
+def test_disk_tier_survives_restart_and_is_bounded(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+    cache = make_cache(max_entries=1, db_path=db_path, db_max_rows=3)
+    for i in range(5):
+        cache.put(f"k{i}", {"n": i})
+    rows = cache.db.execute("SELECT key FROM results ORDER BY rowid").fetchall()
+    assert [r[0] for r in rows] == ["k2", "k3", "k4"]
+
+    reopened = make_cache(max_entries=1, db_path=db_path, db_max_rows=3)
+    assert reopened.get("k3") == {"n": 3}
+    assert reopened.get("k0") is None
+    assert reopened.stats()["disk_hits"] == 1
+
+def test_make_key_depends_on_pixels_and_shape():
+    cache = make_cache()
+    img = np.zeros((4, 4, 3), dtype=np.uint8)
+    other = img.copy()
+    other[0, 0, 0] = 1
+    assert cache.make_key(img) == cache.make_key(img.copy())
+    assert cache.make_key(img) != cache.make_key(other)
+    assert cache.make_key(img) != cache.make_key(img.reshape(2, 8, 3))
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+from starlette.requests import Request
+
+import main
+
+BOUNDARY = b"testboundary"
+
+def multipart_body(files, field="files"):
+    body = b""
+    for filename, data in files:
+        body += (b"--" + BOUNDARY + b"\r\n"
+                 b'Content-Disposition: form-data; name="' + field.encode() + b'"; filename="'
+                 + filename.encode() + b'"\r\n'
+                 b"Content-Type: application/octet-stream\r\n\r\n" + data + b"\r\n")
+    return body + b"--" + BOUNDARY + b"--\r\n"
+
+def make_request(body, chunk_size=7, content_length=True):
+    headers = [(b"content-type", b"multipart/form-data; boundary=" + BOUNDARY)]
+    if content_length:
+        headers.append((b"content-length", str(len(body)).encode()))
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+    messages = [{"type": "http.request", "body": c, "more_body": i < len(chunks) - 1}
+                for i, c in enumerate(chunks)]
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    scope = {"type": "http", "method": "POST", "path": "/analyze", "headers": headers, "query_string": b""}
+    return Request(scope, receive)
+
+def read_all(reader):
+    async def collect():
+        return [item async for item in reader.files()]
+    return asyncio.run(collect())
+
+def test_reads_files_in_order():
+    files = [("a.jpg", b"aaaa"), ("b.jpg", b"b" * 50)]
+    reader = main.UploadReader(make_request(multipart_body(files)))
+    try:
+        assert read_all(reader) == [("a.jpg", b"aaaa", None), ("b.jpg", b"b" * 50, None)]
+    finally:
+        reader.close()
+
+def test_too_many_files():
+    files = [(f"{i}.jpg", b"x") for i in range(3)]
+    reader = main.UploadReader(make_request(multipart_body(files)), max_files=2)
+    try:
+        with pytest.raises(main.UploadRejected) as exc:
+            read_all(reader)
+        assert exc.value.status_code == 413
+    finally:
+        reader.close()
+
+def test_content_length_over_limit_rejected_before_reading():
+    body = multipart_body([("a.jpg", b"x" * 100)])
+    with pytest.raises(main.UploadRejected) as exc:
+        main.UploadReader(make_request(body), max_request_bytes=50)
+    assert exc.value.status_code == 413
+
+def test_body_over_limit_without_content_length():
+    body = multipart_body([("a.jpg", b"x" * 100)])
+    reader = main.UploadReader(make_request(body, content_length=False), max_request_bytes=50)
+    try:
+        with pytest.raises(main.UploadRejected) as exc:
+            read_all(reader)
+        assert exc.value.status_code == 413
+    finally:
+        reader.close()
+
+def test_file_over_limit_only_fails_that_file(monkeypatch):
+    monkeypatch.setattr(main, "UPLOAD_MAX_FILE_BYTES", 10)
+    files = [("big.jpg", b"x" * 11), ("small.jpg", b"y" * 10)]
+    reader = main.UploadReader(make_request(multipart_body(files)))
+    try:
+        (big_name, big_data, big_error), small = read_all(reader)
+    finally:
+        reader.close()
+    assert big_name == "big.jpg" and big_data is None and big_error is not None
+    assert small == ("small.jpg", b"y" * 10, None)
+
+def test_budget_reserved_and_released(monkeypatch):
+    budget = main.ByteBudget(10_000)
+    monkeypatch.setattr(main, "upload_budget", budget)
+    body = multipart_body([("a.jpg", b"x" * 100)])
+    reader = main.UploadReader(make_request(body))
+    assert budget.stats()["in_flight_bytes"] == len(body)
+    read_all(reader)
+    reader.close()
+    assert budget.stats()["in_flight_bytes"] == 0
+
+def test_budget_full_rejects_with_503(monkeypatch):
+    monkeypatch.setattr(main, "upload_budget", main.ByteBudget(10))
+    with pytest.raises(main.UploadRejected) as exc:
+        main.UploadReader(make_request(multipart_body([("a.jpg", b"x" * 100)])))
+    assert exc.value.status_code == 503
+
+def test_streaming_reserves_one_file(monkeypatch):
+    budget = main.ByteBudget(0)
+    monkeypatch.setattr(main, "upload_budget", budget)
+    monkeypatch.setattr(main, "UPLOAD_MAX_FILE_BYTES", 64)
+    files = [(f"{i}.jpg", b"x" * 32) for i in range(10)]
+    reader = main.UploadReader(make_request(multipart_body(files)), streaming=True)
+    assert budget.stats()["in_flight_bytes"] == 64
+    assert len(read_all(reader)) == 10
+    reader.close()
+    assert budget.stats()["in_flight_bytes"] == 0
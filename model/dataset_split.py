@@ -0,0 +1,209 @@
+"""
+แบ่ง dataset เป็น train/valid/test โดยไม่คัดลอกภาพ (ใช้ร่วมกันโดย แบ่งdataset.py ของ yolov11 และ mobilenetv2)
+
+- scan + hash ไฟล์แบบขนาน (thread pool)
+- ลบภาพซ้ำ: เนื้อไฟล์เหมือนกัน (sha1) หรือภาพเหมือนกันแต่ encode ต่างกัน (dHash 64 บิต, ระยะ Hamming <= max_distance)
+  ภาพซ้ำที่ label ไม่ตรงกันไม่ถูกเลือกข้างใด: ตัดออกทั้งกลุ่มและรายงานแยก (conflicts.txt)
+- แบ่งตามสัดส่วนแยกตามกลุ่ม (stratify) ด้วย seed คงที่ และทุกภาพอยู่ใน split เดียวเท่านั้น
+- เขียน manifest <split>.txt (path ของภาพต้นฉบับ) และสร้างโครงสร้างโฟลเดอร์ด้วย hardlink / symlink
+  (ไม่ใช้พื้นที่ดิสก์เพิ่ม) หรือคัดลอกแบบเดิม ตาม mode
+"""
+import os
+import shutil
+import random
+import hashlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:  # ไม่มี Pillow: ลบเฉพาะไฟล์ที่เหมือนกันทุก byte
+    Image = None
+
+SPLITS = ['train', 'valid', 'test']
+# mode ของการสร้างโฟลเดอร์ปลายทาง
+#   manifest: เขียนเฉพาะ <split>.txt
+#   hardlink: hardlink (ถ้าทำไม่ได้ เช่นคนละไดรฟ์ ใช้ symlink แล้วจึงคัดลอก)
+#   symlink:  symlink (ถ้าทำไม่ได้ คัดลอก)
+#   copy:     คัดลอกแบบเดิม
+MODES = ('manifest', 'hardlink', 'symlink', 'copy')
+
+def dhash(path):
+    """perceptual hash (dHash 64 บิต) ของภาพ หรือ None ถ้าอ่านภาพไม่ได้"""
+    try:
+        with Image.open(path) as img:
+            img.draft('L', (64, 64))  # JPEG: ถอดรหัสแบบย่อ (เร็วกว่าถอดรหัสเต็ม)
+            pixels = list(img.convert('L').resize((9, 8), Image.BILINEAR).getdata())
+    except Exception:
+        return None
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+def hash_file(path, perceptual=True):
+    """(sha1 ของเนื้อไฟล์, dHash หรือ None)"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest(), dhash(path) if perceptual and Image is not None else None
+
+def scan(items, workers=None, perceptual=True):
+    """
+    hash ภาพของทุก item แบบขนาน (เพิ่ม "sha1" และ "dhash" ใน dict ของแต่ละ item)
+    - items: list ของ dict ที่มีอย่างน้อย "image" (path ของภาพ)
+    """
+    workers = workers or min(32, (os.cpu_count() or 1) * 2)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        hashes = pool.map(lambda item: hash_file(item['image'], perceptual), items)
+        for item, (sha1, phash) in zip(items, hashes):
+            item['sha1'] = sha1
+            item['dhash'] = phash
+    return items
+
+def find_duplicates(items, max_distance=0, label_key=None):
+    """
+    หากลุ่มภาพซ้ำ (sha1 เท่ากัน หรือ dHash ต่างกันไม่เกิน max_distance บิต)
+    - label_key(item): label ของภาพ (เช่นคลาสของโฟลเดอร์) กลุ่มภาพซ้ำที่ label ไม่ตรงกันถือว่าขัดแย้ง
+      ไม่เลือกว่า label ไหนถูก: ตัดทุกภาพในกลุ่มออกจนกว่าจะมีคนแก้ข้อมูล
+    คืนค่า: (items ที่เก็บไว้, list ของ (item ที่ถูกตัด, item ที่เก็บไว้แทน), list ของกลุ่มที่ขัดแย้ง)
+    ภาพที่เก็บไว้ของแต่ละกลุ่มคือภาพที่ path มาก่อน (ผลเหมือนเดิมทุกครั้ง)
+    """
+    items = sorted(items, key=lambda item: item['image'])
+    parent = list(range(len(items)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+
+    by_sha1 = {}
+    for i, item in enumerate(items):
+        if item['sha1'] in by_sha1:
+            union(by_sha1[item['sha1']], i)
+        else:
+            by_sha1[item['sha1']] = i
+
+    # ภาพที่ต่างกันไม่เกิน max_distance บิต ต้องมีอย่างน้อยหนึ่งช่วง (จาก max_distance + 1 ช่วง) ที่ตรงกันทุกบิต
+    # จึงเทียบเฉพาะภาพที่อยู่ใน bucket เดียวกัน (pigeonhole) แทนการเทียบทุกคู่
+    n_bands = max_distance + 1
+    band_bits = 64 // n_bands
+    buckets = defaultdict(list)
+    for i, item in enumerate(items):
+        if item['dhash'] is None:
+            continue
+        for band in range(n_bands):
+            shift = band * band_bits
+            bits = 64 - shift if band == n_bands - 1 else band_bits
+            key = (band, (item['dhash'] >> shift) & ((1 << bits) - 1))
+            for j in buckets[key]:
+                if bin(items[j]['dhash'] ^ item['dhash']).count('1') <= max_distance:
+                    union(j, i)
+            buckets[key].append(i)
+
+    groups = defaultdict(list)
+    for i in range(len(items)):
+        groups[find(i)].append(i)
+
+    kept, dropped, conflicts = [], [], []
+    for root, members in sorted(groups.items()):
+        if label_key is not None and len({label_key(items[i]) for i in members}) > 1:
+            conflicts.append([items[i] for i in members])
+            continue
+        kept.append(items[root])
+        dropped.extend((items[i], items[root]) for i in members if i != root)
+    kept.sort(key=lambda item: item['image'])
+    return kept, dropped, conflicts
+
+def assign_splits(items, ratios, seed=42, group_key=None):
+    """
+    แบ่ง items ตามสัดส่วน ratios แยกตามกลุ่ม (group_key(item)) ด้วย seed คงที่
+    จำนวนของ train/valid ปัดลง ส่วนที่เหลือเป็น test (เหมือนสคริปต์เดิม)
+    คืนค่า: dict {split: [items]} โดยแต่ละ item อยู่ใน split เดียว
+    """
+    groups = defaultdict(list)
+    for item in items:
+        groups[group_key(item) if group_key else None].append(item)
+
+    result = {split: [] for split in SPLITS}
+    for key in sorted(groups, key=str):
+        group = sorted(groups[key], key=lambda item: item['image'])
+        random.Random(f"{seed}:{key}").shuffle(group)
+        total = len(group)
+        train_count = int(total * ratios['train'])
+        val_count = int(total * ratios['valid'])
+        result['train'].extend(group[:train_count])
+        result['valid'].extend(group[train_count:train_count + val_count])
+        result['test'].extend(group[train_count + val_count:])
+    return result
+
+def _link(src, dst, mode):
+    if mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    if mode in ('hardlink', 'symlink'):
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+def write_splits(output_base, splits, files_for, mode='hardlink', workers=None):
+    """
+    เขียนผลการแบ่ง
+    - splits: dict {split: [items]} จาก assign_splits
+    - files_for(item): list ของ (path ต้นทาง, path ปลายทางแบบ relative กับ output_base/<split>)
+    เขียน <split>.txt (path ภาพต้นฉบับ หนึ่งบรรทัดต่อภาพ) ทุก mode
+    mode อื่นนอกจาก manifest จะลบโฟลเดอร์ <split> เดิมแล้วสร้างใหม่ (ลบแค่ link/สำเนา ไม่กระทบไฟล์ต้นฉบับ)
+    """
+    if mode not in MODES:
+        raise ValueError(f"mode ต้องเป็นหนึ่งใน {MODES} (ได้ {mode})")
+    os.makedirs(output_base, exist_ok=True)
+    for split, items in splits.items():
+        with open(os.path.join(output_base, f"{split}.txt"), 'w', encoding='utf-8') as f:
+            for item in items:
+                f.write(os.path.abspath(item['image']) + '\n')
+
+    if mode == 'manifest':
+        return
+    tasks = []
+    for split, items in splits.items():
+        split_dir = os.path.join(output_base, split)
+        if os.path.isdir(split_dir):
+            shutil.rmtree(split_dir)
+        for item in items:
+            for src, dst_rel in files_for(item):
+                tasks.append((src, os.path.join(split_dir, dst_rel)))
+    for dst_dir in {os.path.dirname(dst) for _, dst in tasks}:
+        os.makedirs(dst_dir, exist_ok=True)
+    workers = workers or min(32, (os.cpu_count() or 1) * 2)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda task: _link(task[0], task[1], mode), tasks))
+
+def write_duplicates_report(output_base, dropped):
+    """บันทึกรายการภาพซ้ำที่ถูกตัด (ภาพที่ถูกตัด <tab> ภาพที่เก็บไว้แทน)"""
+    os.makedirs(output_base, exist_ok=True)
+    with open(os.path.join(output_base, "duplicates.txt"), 'w', encoding='utf-8') as f:
+        for item, kept in dropped:
+            f.write(f"{item['image']}\t{kept['image']}\n")
+
+def write_conflicts_report(output_base, conflicts, label_key):
+    """บันทึกกลุ่มภาพซ้ำที่ label ไม่ตรงกัน (ภาพ <tab> label หนึ่งบรรทัดต่อภาพ, บรรทัดว่างคั่นแต่ละกลุ่ม)"""
+    os.makedirs(output_base, exist_ok=True)
+    with open(os.path.join(output_base, "conflicts.txt"), 'w', encoding='utf-8') as f:
+        for group in conflicts:
+            for item in group:
+                f.write(f"{item['image']}\t{label_key(item)}\n")
+            f.write("\n")
@@ -1,4 +1,5 @@
 import os
+import json
 import tensorflow as tf
 from tensorflow.keras.preprocessing import image_dataset_from_directory
 from tensorflow.keras.applications import MobileNetV2
@@ -18,51 +19,172 @@ BATCH_SIZE = 32
 IMG_SIZE = (224, 224)
 EPOCHS = 100
 
+# --- Data pipeline ---
+# "cache": ถอดรหัส + resize ทุกภาพครั้งเดียวเก็บเป็น TFRecord หลาย shard ใน CACHE_DIR แล้วทุก epoch อ่านจาก cache
+#          แบบขนาน (ไม่ต้องถอดรหัส JPEG ซ้ำทุก epoch); cache ถูกสร้างใหม่เองเมื่อรายการไฟล์/ขนาดภาพเปลี่ยน
+# "directory": image_dataset_from_directory แบบเดิม
+DATA_PIPELINE = "cache"
+CACHE_DIR = DATASET_DIR + "_cache"
+CACHE_SHARDS = 16
+SHUFFLE_BUFFER = 2048
+# augmentation ระหว่างเทรน (ทำหลังอ่านจาก cache ทุก epoch ไม่ถูกเก็บใน cache)
+AUGMENT = False
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')
+AUTOTUNE = tf.data.AUTOTUNE
+
+def list_split(split):
+    """
+    path และ index คลาสของทุกภาพใน split (ลำดับคลาสตามชื่อโฟลเดอร์ เหมือน image_dataset_from_directory)
+    คืนค่า: (paths, labels, class_names)
+    """
+    split_dir = os.path.join(DATASET_DIR, split)
+    class_names = sorted(d for d in os.listdir(split_dir) if os.path.isdir(os.path.join(split_dir, d)))
+    paths, labels = [], []
+    for label, class_name in enumerate(class_names):
+        class_dir = os.path.join(split_dir, class_name)
+        for file in sorted(os.listdir(class_dir)):
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(class_dir, file))
+                labels.append(label)
+    return paths, labels, class_names
+
+def decode_and_resize(path, label):
+    """อ่าน + ถอดรหัส + resize (bilinear แบบเดียวกับ image_dataset_from_directory) เก็บเป็น uint8"""
+    img = tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+    img = tf.image.resize(img, IMG_SIZE)
+    return tf.cast(tf.clip_by_value(tf.round(img), 0, 255), tf.uint8), label
+
+def build_cache(split):
+    """
+    สร้าง cache ของ split (ถ้ายังไม่มีหรือไม่ตรงกับรายการไฟล์ปัจจุบัน)
+    ถอดรหัสภาพแบบขนานแล้วเขียนเป็น TFRecord CACHE_SHARDS ไฟล์ + meta.json (เขียนท้ายสุด = cache สมบูรณ์)
+    คืนค่า: (list ของไฟล์ shard, class_names, จำนวนภาพ)
+    """
+    paths, labels, class_names = list_split(split)
+    split_dir = os.path.join(CACHE_DIR, split)
+    meta_path = os.path.join(split_dir, "meta.json")
+    meta = {
+        "img_size": list(IMG_SIZE),
+        "class_names": class_names,
+        "num_examples": len(paths),
+        "files": [[os.path.relpath(p, DATASET_DIR), os.path.getsize(p)] for p in paths],
+    }
+    shard_files = [os.path.join(split_dir, f"{split}-{i:03d}-of-{CACHE_SHARDS:03d}.tfrecord")
+                   for i in range(CACHE_SHARDS)]
+    if os.path.exists(meta_path):
+        with open(meta_path, encoding="utf-8") as f:
+            if json.load(f) == meta:
+                return shard_files, class_names, len(paths)
+
+    print(f"สร้าง cache ของ {split} ({len(paths)} ภาพ) ที่ {split_dir}")
+    os.makedirs(split_dir, exist_ok=True)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    ds = tf.data.Dataset.from_tensor_slices((paths, labels))
+    ds = ds.map(decode_and_resize, num_parallel_calls=AUTOTUNE).prefetch(AUTOTUNE)
+    writers = [tf.io.TFRecordWriter(path) for path in shard_files]
+    for i, (img, label) in enumerate(ds):
+        example = tf.train.Example(features=tf.train.Features(feature={
+            "image": tf.train.Feature(bytes_list=tf.train.BytesList(value=[img.numpy().tobytes()])),
+            "label": tf.train.Feature(int64_list=tf.train.Int64List(value=[int(label)])),
+        }))
+        writers[i % CACHE_SHARDS].write(example.SerializeToString())
+    for writer in writers:
+        writer.close()
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    return shard_files, class_names, len(paths)
+
+def parse_cached(record, num_classes):
+    features = tf.io.parse_single_example(record, {
+        "image": tf.io.FixedLenFeature([], tf.string),
+        "label": tf.io.FixedLenFeature([], tf.int64),
+    })
+    img = tf.reshape(tf.io.decode_raw(features["image"], tf.uint8), IMG_SIZE + (3,))
+    return tf.cast(img, tf.float32), tf.one_hot(features["label"], num_classes)
+
+augmentation = tf.keras.Sequential([
+    layers.RandomFlip("horizontal"),
+    layers.RandomRotation(0.05),
+    layers.RandomZoom(0.1),
+    layers.RandomContrast(0.1),
+], name="augmentation")
+
+def cached_dataset(split, training):
+    """
+    dataset ของ split จาก cache: อ่าน shard แบบ interleave + parse แบบขนาน, shuffle/augment เฉพาะชุด train
+    ชุดที่ไม่ใช่ train อ่านตามลำดับคงที่ (ผลของ predict ต้องตรงกับลำดับ label ตอนวัดผล)
+    คืนค่า: (dataset, class_names)
+    """
+    shard_files, class_names, _ = build_cache(split)
+    num_classes = len(class_names)
+    files = tf.data.Dataset.from_tensor_slices(shard_files)
+    if training:
+        files = files.shuffle(len(shard_files), reshuffle_each_iteration=True)
+    ds = files.interleave(tf.data.TFRecordDataset, cycle_length=min(8, len(shard_files)),
+                          num_parallel_calls=AUTOTUNE, deterministic=not training)
+    ds = ds.map(lambda r: parse_cached(r, num_classes), num_parallel_calls=AUTOTUNE, deterministic=not training)
+    if training:
+        ds = ds.shuffle(SHUFFLE_BUFFER, reshuffle_each_iteration=True)
+    ds = ds.batch(BATCH_SIZE)
+    if training and AUGMENT:
+        ds = ds.map(lambda x, y: (augmentation(x, training=True), y), num_parallel_calls=AUTOTUNE)
+    ds = ds.map(lambda x, y: (preprocess_input(x), y), num_parallel_calls=AUTOTUNE)
+    return ds.prefetch(AUTOTUNE), class_names
+
+def directory_dataset(split, training):
+    """dataset ของ split ด้วย image_dataset_from_directory (ถอดรหัสใหม่ทุก epoch)"""
+    ds = image_dataset_from_directory(
+        os.path.join(DATASET_DIR, split),
+        label_mode='categorical',
+        image_size=IMG_SIZE,
+        batch_size=BATCH_SIZE,
+        shuffle=training
+    )
+    class_names = ds.class_names
+    if training and AUGMENT:
+        ds = ds.map(lambda x, y: (augmentation(x, training=True), y), num_parallel_calls=AUTOTUNE)
+    ds = ds.map(lambda x, y: (preprocess_input(x), y), num_parallel_calls=AUTOTUNE)
+    return ds.prefetch(AUTOTUNE), class_names
+
 # --- โหลด dataset ---
-train_ds = image_dataset_from_directory(
-    os.path.join(DATASET_DIR, 'train'),
-    label_mode='categorical',
-    image_size=IMG_SIZE,
-    batch_size=BATCH_SIZE,
-    shuffle=True
-)
-val_ds = image_dataset_from_directory(
-    os.path.join(DATASET_DIR, 'valid'),
-    label_mode='categorical',
-    image_size=IMG_SIZE,
-    batch_size=BATCH_SIZE
-)
-test_ds = image_dataset_from_directory(
-    os.path.join(DATASET_DIR, 'test'),
-    label_mode='categorical',
-    image_size=IMG_SIZE,
-    batch_size=BATCH_SIZE,
-    shuffle=False
-)
+load_dataset = cached_dataset if DATA_PIPELINE == "cache" else directory_dataset
+train_ds, class_names = load_dataset('train', training=True)
+val_ds, _ = load_dataset('valid', training=False)
+test_ds, _ = load_dataset('test', training=False)
 
 # --- จำนวนคลาส ---
-num_classes = len(train_ds.class_names)
-class_names = train_ds.class_names
+num_classes = len(class_names)
 print("Classes:", class_names)
 
-# --- Preprocessing ---
-AUTOTUNE = tf.data.AUTOTUNE
-train_ds = train_ds.map(lambda x, y: (preprocess_input(x), y)).prefetch(AUTOTUNE)
-val_ds = val_ds.map(lambda x, y: (preprocess_input(x), y)).prefetch(AUTOTUNE)
-test_ds = test_ds.map(lambda x, y: (preprocess_input(x), y)).prefetch(AUTOTUNE)
+# --- โหมดการเทรน ---
+# "embeddings": base_model ถูก freeze จึงคำนวณ embedding 1280 มิติ (หลัง GlobalAveragePooling2D) ของทุกภาพ
+#               ครั้งเดียวเก็บเป็น .npy ใน EMBEDDING_DIR แล้วเทรนเฉพาะ head บน embedding (เร็วกว่ามาก)
+#               จากนั้นประกอบกลับเป็นโมเดลเต็ม (.keras โครงสร้างเดิม) ให้ แปลง.py ใช้ได้เหมือนเดิม
+#               (ไม่มี augmentation ในขั้นนี้ เพราะ embedding ถูกคำนวณครั้งเดียว)
+# "end_to_end": ส่งภาพผ่าน MobileNetV2 ทุก epoch แบบเดิม
+TRAIN_MODE = "embeddings"
+EMBEDDING_DIR = os.path.join(SAVE_DIR, "embeddings")
+# fine-tune หลังเทรน head: ปลด freeze layer ท้าย ๆ ของ MobileNetV2 จำนวนนี้ (0 = ไม่ fine-tune)
+FINE_TUNE_LAYERS = 0
+FINE_TUNE_EPOCHS = 20
+FINE_TUNE_LR = 1e-5
 
 # --- MobileNetV2 base ---
 base_model = MobileNetV2(input_shape=IMG_SIZE + (3,), include_top=False, weights='imagenet')
 base_model.trainable = False
 
 # --- สร้างโมเดล ---
-model = models.Sequential([
-    base_model,
-    layers.GlobalAveragePooling2D(),
+# layer ของ head ใช้ร่วมกันระหว่างโมเดลเต็มและโมเดลที่เทรนบน embedding (weight ชุดเดียวกัน)
+head_layers = [
     layers.Dense(128, activation='relu'),
     layers.Dropout(0.3),
     layers.Dense(num_classes, activation='softmax')
-])
+]
+model = models.Sequential([
+    base_model,
+    layers.GlobalAveragePooling2D(),
+] + head_layers)
 
 model.compile(
     optimizer=tf.keras.optimizers.Adam(learning_rate=0.0001),
@@ -79,13 +201,111 @@ callbacks = [
     tf.keras.callbacks.ModelCheckpoint(MODEL_PATH, monitor='val_loss', save_best_only=True, verbose=1)
 ]
 
+def compute_embeddings(split):
+    """
+    embedding (N, 1280) และ label one-hot (N, num_classes) ของ split เก็บเป็น .npy (memory-mapped)
+    คำนวณครั้งเดียว; ถ้ามีไฟล์ของรายการภาพชุดเดียวกันอยู่แล้วจะใช้ซ้ำ
+    คืนค่า: (x, y) เป็น np.memmap แบบอ่านอย่างเดียว
+    """
+    paths, _, _ = list_split(split)
+    x_path = os.path.join(EMBEDDING_DIR, f"{split}_x.npy")
+    y_path = os.path.join(EMBEDDING_DIR, f"{split}_y.npy")
+    meta_path = os.path.join(EMBEDDING_DIR, f"{split}_meta.json")
+    meta = {
+        "img_size": list(IMG_SIZE),
+        "class_names": class_names,
+        "files": [os.path.relpath(p, DATASET_DIR) for p in paths],
+    }
+    if os.path.exists(meta_path):
+        with open(meta_path, encoding="utf-8") as f:
+            if json.load(f) == meta:
+                return np.load(x_path, mmap_mode="r"), np.load(y_path, mmap_mode="r")
+
+    print(f"คำนวณ embedding ของ {split} ({len(paths)} ภาพ)")
+    os.makedirs(EMBEDDING_DIR, exist_ok=True)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    extractor = models.Sequential([base_model, layers.GlobalAveragePooling2D()])
+    # ใช้ dataset แบบลำดับคงที่ ไม่ shuffle/augment
+    ds, _ = load_dataset(split, training=False)
+    x = np.lib.format.open_memmap(x_path, mode="w+", dtype=np.float32,
+                                  shape=(len(paths), base_model.output_shape[-1]))
+    y = np.lib.format.open_memmap(y_path, mode="w+", dtype=np.float32, shape=(len(paths), num_classes))
+    offset = 0
+    for images, labels in ds:
+        n = int(labels.shape[0])
+        x[offset:offset + n] = extractor(images, training=False).numpy()
+        y[offset:offset + n] = labels.numpy()
+        offset += n
+    x.flush()
+    y.flush()
+    del x, y
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    return np.load(x_path, mmap_mode="r"), np.load(y_path, mmap_mode="r")
+
 # --- เทรน ---
-history = model.fit(
-    train_ds,
-    validation_data=val_ds,
-    epochs=EPOCHS,
-    callbacks=callbacks
-)
+if TRAIN_MODE == "embeddings":
+    # ขั้นที่ 1: embedding ของ train/valid (คำนวณครั้งเดียว)
+    train_x, train_y = compute_embeddings('train')
+    val_x, val_y = compute_embeddings('valid')
+
+    # ขั้นที่ 2: เทรน head บน embedding
+    head = models.Sequential([layers.Input(shape=(train_x.shape[1],))] + head_layers)
+    head.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate=0.0001),
+        loss='categorical_crossentropy',
+        metrics=['accuracy']
+    )
+    history = head.fit(
+        train_x, train_y,
+        validation_data=(val_x, val_y),
+        batch_size=BATCH_SIZE,
+        shuffle=True,
+        epochs=EPOCHS,
+        callbacks=callbacks[:2]
+    )
+    # head_layers เป็น layer เดียวกับใน model จึงได้ weight ที่ดีที่สุด (restore_best_weights) แล้ว
+    model.save(MODEL_PATH)
+else:
+    history = model.fit(
+        train_ds,
+        validation_data=val_ds,
+        epochs=EPOCHS,
+        callbacks=callbacks
+    )
+
+# --- Fine-tune (ถ้าเปิด) ---
+if FINE_TUNE_LAYERS > 0:
+    model = tf.keras.models.load_model(MODEL_PATH)
+    base_model = model.layers[0]
+    base_model.trainable = True
+    for layer in base_model.layers[:-FINE_TUNE_LAYERS]:
+        layer.trainable = False
+    # BatchNormalization คงสถิติเดิม (ชุดข้อมูลเล็ก)
+    for layer in base_model.layers:
+        if isinstance(layer, layers.BatchNormalization):
+            layer.trainable = False
+    model.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate=FINE_TUNE_LR),
+        loss='categorical_crossentropy',
+        metrics=['accuracy']
+    )
+    best_val_loss = min(history.history['val_loss'])
+    fine_callbacks = [
+        tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=5, restore_best_weights=True),
+        tf.keras.callbacks.ModelCheckpoint(MODEL_PATH, monitor='val_loss', save_best_only=True,
+                                           initial_value_threshold=best_val_loss, verbose=1)
+    ]
+    fine_history = model.fit(
+        train_ds,
+        validation_data=val_ds,
+        epochs=FINE_TUNE_EPOCHS,
+        callbacks=fine_callbacks
+    )
+    # ต่อกราฟของ fine-tune ท้ายกราฟเดิม
+    for key in history.history:
+        history.history[key] += fine_history.history.get(key, [])
 
 print(f"โมเดล val_loss ดีที่สุดถูกบันทึกไว้ที่: {MODEL_PATH}")
 
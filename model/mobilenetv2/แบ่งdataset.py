@@ -1,52 +1,58 @@
 import os
-import shutil
-import random
-from collections import defaultdict
+import sys
+
+# engine สำหรับแบ่ง dataset อยู่ที่ model/dataset_split.py (ใช้ร่วมกับ yolov11)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import dataset_split
 
 # พาธ dataset ที่มีโฟลเดอร์ย่อยตาม class
 dataset_dir = 'C:/Users/Acer/Desktop/Project/mobilenetv2/datasets'
 
 # พาธปลายทาง
 output_base = 'C:/Users/Acer/Desktop/Project/mobilenetv2/datasets_age'
-splits = ['train', 'valid', 'test']
 split_ratio = {'train': 0.8, 'valid': 0.15, 'test': 0.05}
+SEED = 42
+# hardlink: สร้าง train/valid/test/<class>/ แบบไม่ใช้พื้นที่เพิ่ม (train.py อ่านจากโฟลเดอร์)
+# อื่น ๆ: manifest / symlink / copy (ดู dataset_split.MODES)
+MODE = 'hardlink'
+# ภาพที่ dHash ต่างกันไม่เกินกี่บิตถือว่าซ้ำ (0 = ต้องเหมือนกันทุกบิต)
+MAX_HASH_DISTANCE = 0
 
 # Step 1: รวมไฟล์ .jpg จากแต่ละคลาส
-class_to_files = defaultdict(list)
-
-for class_folder in os.listdir(dataset_dir):
+items = []
+for class_folder in sorted(os.listdir(dataset_dir)):
     class_path = os.path.join(dataset_dir, class_folder)
     if not os.path.isdir(class_path):
         continue
 
     for file in os.listdir(class_path):
         if file.endswith('.jpg'):
-            image_path = os.path.join(class_path, file)
-            class_to_files[class_folder].append(image_path)
-
-# Step 2: สร้างโฟลเดอร์ปลายทาง
-for split in splits:
-    for class_name in class_to_files.keys():
-        os.makedirs(os.path.join(output_base, split, class_name), exist_ok=True)
-
-# Step 3: แบ่งข้อมูลและคัดลอก
-def copy_images(split, image_paths, class_name):
-    for image_path in image_paths:
-        file_name = os.path.basename(image_path)
-        dst = os.path.join(output_base, split, class_name, file_name)
-        shutil.copy2(image_path, dst)
-
-for class_name, image_list in class_to_files.items():
-    random.shuffle(image_list)
-    total = len(image_list)
-    train_count = int(total * split_ratio['train'])
-    val_count = int(total * split_ratio['valid'])
-    test_count = total - train_count - val_count
-
-    copy_images('train', image_list[:train_count], class_name)
-    copy_images('valid', image_list[train_count:train_count + val_count], class_name)
-    copy_images('test', image_list[train_count + val_count:], class_name)
-
-    print(f"{class_name} → train: {train_count}, valid: {val_count}, test: {test_count}")
-
-print("✅ Dataset split and ready for MobileNetV2 training.")
\ No newline at end of file
+            items.append({'image': os.path.join(class_path, file), 'class': class_folder})
+
+# Step 2: hash แบบขนาน แล้วตัดภาพซ้ำ
+# ภาพเดียวกันที่อยู่คนละคลาส (label อายุขัดกัน) ถูกตัดออกทุกภาพ และบันทึกใน conflicts.txt ให้แก้เอง
+def class_of(item):
+    return item['class']
+
+dataset_split.scan(items)
+items, dropped, conflicts = dataset_split.find_duplicates(items, MAX_HASH_DISTANCE, label_key=class_of)
+dataset_split.write_duplicates_report(output_base, dropped)
+dataset_split.write_conflicts_report(output_base, conflicts, class_of)
+print(f"พบภาพซ้ำ {len(dropped)} ภาพ (ดู duplicates.txt)")
+if conflicts:
+    print(f"⚠️ พบภาพซ้ำที่อยู่คนละคลาส {len(conflicts)} กลุ่ม ({sum(len(g) for g in conflicts)} ภาพ) "
+          f"ไม่ถูกใช้จนกว่าจะแก้ (ดู conflicts.txt)")
+
+# Step 3: แบ่งข้อมูลแยกตามคลาส (seed คงที่)
+splits = dataset_split.assign_splits(items, split_ratio, seed=SEED, group_key=lambda item: item['class'])
+
+def files_for(item):
+    return [(item['image'], os.path.join(item['class'], os.path.basename(item['image'])))]
+
+dataset_split.write_splits(output_base, splits, files_for, mode=MODE)
+
+for class_name in sorted({item['class'] for item in items}):
+    counts = {split: sum(1 for item in splits[split] if item['class'] == class_name) for split in splits}
+    print(f"{class_name} → train: {counts['train']}, valid: {counts['valid']}, test: {counts['test']}")
+
+print("✅ Dataset split and ready for MobileNetV2 training.")
@@ -1,16 +1,73 @@
+import os
+import sys
+import random
+import numpy as np
 import tensorflow as tf
 
+# โหมดการแปลง: "float32" (เดิม), "float16" หรือ "int8" (full-integer, input/output เป็น uint8)
+# ระบุผ่าน argument ได้ เช่น: python แปลง.py int8
+MODE = sys.argv[1] if len(sys.argv) > 1 else "float32"
+
+# dataset สำหรับ representative dataset ของโหมด int8 (ใช้ชุด train ชุดเดียวกับตอนเทรน)
+DATASET_DIR = "C:/Users/Acer/Desktop/Project/mobilenetv2/datasets_age/train"
+NUM_CALIBRATION_IMAGES = 300
+IMG_SIZE = (224, 224)
+
+# ชื่อไฟล์ผลลัพธ์ตามโหมด (backend เลือกไฟล์ผ่าน AGE_MODEL_PATH)
+OUTPUT_FILES = {
+    "float32": "mobilenetv2.tflite",
+    "float16": "mobilenetv2_fp16.tflite",
+    "int8": "mobilenetv2_int8.tflite",
+}
+if MODE not in OUTPUT_FILES:
+    raise ValueError(f"MODE ต้องเป็นหนึ่งใน {list(OUTPUT_FILES)} (ได้ {MODE})")
+
+def representative_dataset():
+    """
+    สุ่มภาพจาก DATASET_DIR มา NUM_CALIBRATION_IMAGES รูป แล้ว preprocess แบบเดียวกับตอนเทรน ([-1,1])
+    ใช้สำหรับคำนวณช่วงค่า (scale/zero-point) ของ tensor ในโหมด int8
+    """
+    paths = []
+    for class_name in sorted(os.listdir(DATASET_DIR)):
+        class_path = os.path.join(DATASET_DIR, class_name)
+        if not os.path.isdir(class_path):
+            continue
+        for file in os.listdir(class_path):
+            if file.lower().endswith(('.jpg', '.jpeg', '.png')):
+                paths.append(os.path.join(class_path, file))
+
+    random.Random(0).shuffle(paths)
+    for path in paths[:NUM_CALIBRATION_IMAGES]:
+        img = tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+        img = tf.image.resize(img, IMG_SIZE)
+        img = tf.keras.applications.mobilenet_v2.preprocess_input(img)
+        yield [np.expand_dims(img.numpy().astype(np.float32), axis=0)]
+
 # โหลดโมเดล Keras
 model = tf.keras.models.load_model('C:/Users/Acer/Desktop/Project/mobilenetv2/ผลลัพธ์/train3/mobilenetv2_age_classifier_best.keras')
 
 # สร้างตัวแปลง TFLite
 converter = tf.lite.TFLiteConverter.from_keras_model(model)
 
+if MODE == "float16":
+    # น้ำหนักเป็น float16 (ขนาดไฟล์ ~ครึ่งหนึ่ง), คำนวณเป็น float32 บน CPU
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_types = [tf.float16]
+elif MODE == "int8":
+    # full-integer: น้ำหนักและ activation เป็น int8, input/output เป็น uint8 (ขนาดไฟล์ ~1/4)
+    # backend อ่าน scale/zero-point จริงของ input/output จาก tensor เอง
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.uint8
+    converter.inference_output_type = tf.uint8
+
 # แปลงเป็น TFLite
 tflite_model = converter.convert()
 
 # บันทึกไฟล์
-with open('mobilenetv2.tflite', 'wb') as f:
+output_file = OUTPUT_FILES[MODE]
+with open(output_file, 'wb') as f:
     f.write(tflite_model)
 
-print("MobileNetV2 TFLite conversion done!")
\ No newline at end of file
+print(f"MobileNetV2 TFLite conversion done! ({MODE}, {len(tflite_model) / 1e6:.1f} MB -> {output_file})")
@@ -0,0 +1,73 @@
+import dataset_split
+
+def item(image, sha1=None, dhash=None, **extra):
+    return {"image": image, "sha1": sha1 or image, "dhash": dhash, **extra}
+
+def images(items):
+    return [i["image"] for i in items]
+
+def test_exact_duplicates_keep_first_path():
+    items = [item("b.jpg", sha1="x"), item("a.jpg", sha1="x"), item("c.jpg", sha1="y")]
+    kept, dropped, conflicts = dataset_split.find_duplicates(items)
+    assert images(kept) == ["a.jpg", "c.jpg"]
+    assert [(d["image"], k["image"]) for d, k in dropped] == [("b.jpg", "a.jpg")]
+    assert conflicts == []
+
+def test_dhash_distance_within_threshold():
+    base = 0x0123456789ABCDEF
+    items = [
+        item("a.jpg", dhash=base),
+        item("b.jpg", dhash=base ^ 0b111),                   # ต่าง 3 บิต
+        item("c.jpg", dhash=base ^ (0b1111 << 8)),           # ต่าง 4 บิตจาก a, 7 บิตจาก b
+        item("d.jpg", dhash=base ^ (1 << 63) ^ (1 << 0)),    # ต่าง 2 บิต คนละ band
+    ]
+    kept, dropped, _ = dataset_split.find_duplicates(items, max_distance=3)
+    assert images(kept) == ["a.jpg", "c.jpg"]
+    assert sorted((d["image"], k["image"]) for d, k in dropped) == [("b.jpg", "a.jpg"), ("d.jpg", "a.jpg")]
+
+def test_dhash_exact_match_only_by_default():
+    items = [item("a.jpg", dhash=42), item("b.jpg", dhash=42), item("c.jpg", dhash=43)]
+    kept, dropped, _ = dataset_split.find_duplicates(items)
+    assert images(kept) == ["a.jpg", "c.jpg"]
+    assert len(dropped) == 1
+
+def test_missing_dhash_only_matches_by_sha1():
+    items = [item("a.jpg", sha1="x"), item("b.jpg", sha1="x", dhash=5), item("c.jpg", dhash=5)]
+    kept, _, _ = dataset_split.find_duplicates(items)
+    # a-b ตรงกันด้วย sha1, b-c ด้วย dHash -> กลุ่มเดียวกัน
+    assert images(kept) == ["a.jpg"]
+
+def test_cross_label_duplicates_are_conflicts():
+    items = [
+        item("kitten/1.jpg", sha1="x", cls="kitten"),
+        item("adult/1.jpg", sha1="x", cls="adult"),
+        item("adult/2.jpg", sha1="y", cls="adult"),
+        item("adult/3.jpg", sha1="y", cls="adult"),
+    ]
+    kept, dropped, conflicts = dataset_split.find_duplicates(items, label_key=lambda i: i["cls"])
+    assert images(kept) == ["adult/2.jpg"]
+    assert [(d["image"], k["image"]) for d, k in dropped] == [("adult/3.jpg", "adult/2.jpg")]
+    assert [images(group) for group in conflicts] == [["adult/1.jpg", "kitten/1.jpg"]]
+
+def make_items(n, classes=("a", "b")):
+    return [{"image": f"{cls}/{i:03d}.jpg", "class": cls} for cls in classes for i in range(n)]
+
+RATIOS = {"train": 0.8, "valid": 0.15, "test": 0.05}
+
+def test_assign_splits_deterministic_under_seed():
+    first = dataset_split.assign_splits(make_items(40), RATIOS, seed=7, group_key=lambda i: i["class"])
+    # ลำดับของ input ไม่มีผล
+    second = dataset_split.assign_splits(make_items(40)[::-1], RATIOS, seed=7, group_key=lambda i: i["class"])
+    assert {s: images(v) for s, v in first.items()} == {s: images(v) for s, v in second.items()}
+    other = dataset_split.assign_splits(make_items(40), RATIOS, seed=8, group_key=lambda i: i["class"])
+    assert images(other["train"]) != images(first["train"])
+
+def test_assign_splits_each_item_in_exactly_one_split():
+    items = make_items(37)
+    splits = dataset_split.assign_splits(items, RATIOS, seed=42, group_key=lambda i: i["class"])
+    assigned = [image for split in dataset_split.SPLITS for image in images(splits[split])]
+    assert sorted(assigned) == sorted(images(items))
+    # แยกตามคลาส: train/valid ปัดลง ส่วนที่เหลือเป็น test
+    for cls in ("a", "b"):
+        counts = {s: sum(1 for i in splits[s] if i["class"] == cls) for s in dataset_split.SPLITS}
+        assert counts == {"train": 29, "valid": 5, "test": 3}
@@ -0,0 +1,27 @@
+from ultralytics import YOLO
+
+# โหลดโมเดลที่เทรนแล้ว
+model = YOLO('C:/Users/Acer/Desktop/Project/yolov11/runs/detect/train/weights/best.pt')
+
+# Export เป็น ONNX (ใช้กับ onnxruntime บน CPU)
+# dynamic=True ให้ batch/ขนาดภาพเปลี่ยนได้ เพื่อให้ backend ส่งหลายภาพใน batch เดียวได้
+onnx_path = model.export(
+    format="onnx",
+    imgsz=640,      # ขนาดภาพเดียวกับตอนเทรน
+    dynamic=True,   # batch และขนาด input แบบ dynamic
+    simplify=True,  # ลดรูป graph ด้วย onnxslim
+    opset=17,
+)
+
+# Export เป็น OpenVINO (เร็วที่สุดบน CPU Intel)
+openvino_path = model.export(
+    format="openvino",
+    imgsz=640,
+    dynamic=True,
+    half=False,     # CPU ใช้ FP32
+)
+
+# วางไฟล์ best.onnx หรือโฟลเดอร์ best_openvino_model/ ไว้ข้าง backend/main.py
+# แล้วตั้ง YOLO_ENGINE=onnx หรือ YOLO_ENGINE=openvino
+print(f"ONNX: {onnx_path}")
+print(f"OpenVINO: {openvino_path}")
@@ -0,0 +1,189 @@
+"""
+เทรน age head บน feature ของ YOLOv11 (multi-task: อายุออกมาจาก inference ครั้งเดียวกับสายพันธุ์และ bbox)
+
+- ใช้ YOLO ที่เทรนแล้ว (train.py) แบบ freeze: ส่งภาพใน dataset อายุ (datasets_age/<split>/<age_class>/)
+  ผ่าน YOLO แล้ว ROI Align feature map ที่เข้า Detect head ในกรอบของสัตว์ (กล่องที่มั่นใจที่สุด
+  หรือทั้งภาพถ้าไม่พบ) ได้ vector ต่อภาพ เก็บเป็น .npy ครั้งเดียว
+- เทรน head เล็ก ๆ (LayerNorm -> Linear -> ReLU -> Dropout -> Linear) บน vector เหล่านั้น
+- บันทึกเป็น TorchScript (age_head.pt) พร้อม meta (age_labels, pool_size)
+  คัดลอกไปไว้ที่ backend แล้วรัน server ด้วย AGE_ENGINE=yolo_head
+
+หมายเหตุ: dataset อายุเป็นภาพที่ crop สัตว์มาแล้ว ส่วน backend ใช้กรอบของสัตว์ในภาพเต็ม
+feature ของ ROI จึงต่างกันเล็กน้อย ควรวัดผลกับภาพจริงก่อนเปลี่ยน backend
+"""
+import os
+import json
+import numpy as np
+import torch
+from torch import nn
+from torchvision.ops import roi_align
+from ultralytics import YOLO
+
+# --- ตั้งค่า path ---
+YOLO_WEIGHTS = 'C:/Users/Acer/Desktop/Project/yolov11/runs/detect/train/weights/best.pt'
+AGE_DATASET_DIR = 'C:/Users/Acer/Desktop/Project/mobilenetv2/datasets_age'
+SAVE_DIR = 'C:/Users/Acer/Desktop/Project/yolov11/runs/age_head'
+OUTPUT_PATH = os.path.join(SAVE_DIR, 'age_head.pt')
+os.makedirs(SAVE_DIR, exist_ok=True)
+
+POOL_SIZE = 3       # ขนาดกริดของ ROI Align ก่อนเฉลี่ย (ต้องตรงกับ meta ที่ backend อ่าน)
+HIDDEN = 256
+DROPOUT = 0.3
+EPOCHS = 200
+BATCH_SIZE = 64
+LR = 1e-3
+PATIENCE = 20       # early stopping ตาม val_loss
+SEED = 0
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+torch.manual_seed(SEED)
+
+# --- YOLO + hook เก็บ feature ---
+model = YOLO(YOLO_WEIGHTS)
+captured = {}
+
+def on_input(module, args):
+    captured["input_hw"] = tuple(args[0].shape[-2:])
+
+def on_detect(module, args):
+    captured["features"] = list(args[0])
+
+model.model.register_forward_pre_hook(on_input)
+model.model.model[-1].register_forward_pre_hook(on_detect)
+
+def to_input_coords(box, image_hw, input_hw):
+    """เหมือน backend/main.py: พิกัดภาพ -> พิกัด input หลัง letterbox"""
+    h, w = image_hw
+    in_h, in_w = input_hw
+    r = min(in_h / h, in_w / w)
+    pad_x = (in_w - round(w * r)) / 2
+    pad_y = (in_h - round(h * r)) / 2
+    x1, y1, x2, y2 = box
+    return [x1 * r + pad_x, y1 * r + pad_y, x2 * r + pad_x, y2 * r + pad_y]
+
+def pool_roi_features(features, input_hw, boxes, pool_size):
+    """เหมือน backend/main.py: ROI Align ทุกระดับของ feature pyramid แล้วเฉลี่ยเป็น vector ต่อกัน"""
+    pooled = []
+    for feat in features:
+        scale = feat.shape[-1] / input_hw[1]
+        roi = roi_align(feat, [boxes.to(feat.dtype)], output_size=pool_size,
+                        spatial_scale=scale, sampling_ratio=2, aligned=True)
+        pooled.append(roi.mean(dim=(2, 3)))
+    return torch.cat(pooled, dim=1).float()
+
+def list_split(split):
+    split_dir = os.path.join(AGE_DATASET_DIR, split)
+    class_names = sorted(d for d in os.listdir(split_dir) if os.path.isdir(os.path.join(split_dir, d)))
+    paths, labels = [], []
+    for label, class_name in enumerate(class_names):
+        class_dir = os.path.join(split_dir, class_name)
+        for file in sorted(os.listdir(class_dir)):
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(class_dir, file))
+                labels.append(label)
+    return paths, labels, class_names
+
+def extract_features(split):
+    """
+    vector ของ ROI ต่อภาพ (ใช้ซ้ำถ้าเคยคำนวณกับรายการภาพชุดเดียวกันแล้ว)
+    คืนค่า: (x (N, D) float32, y (N,) int64, class_names)
+    """
+    paths, labels, class_names = list_split(split)
+    x_path = os.path.join(SAVE_DIR, f"{split}_x.npy")
+    meta_path = os.path.join(SAVE_DIR, f"{split}_meta.json")
+    meta = {"weights": YOLO_WEIGHTS, "pool_size": POOL_SIZE,
+            "files": [os.path.relpath(p, AGE_DATASET_DIR) for p in paths]}
+    if os.path.exists(meta_path):
+        with open(meta_path, encoding="utf-8") as f:
+            if json.load(f) == meta:
+                return np.load(x_path), np.array(labels, dtype=np.int64), class_names
+
+    print(f"คำนวณ feature ของ {split} ({len(paths)} ภาพ)")
+    vectors = []
+    with torch.inference_mode():
+        for n, path in enumerate(paths):
+            res = model(path, verbose=False)[0]
+            h, w = res.orig_shape
+            # กล่องที่มั่นใจที่สุด (ผลของ YOLO เรียงตามความมั่นใจ) หรือทั้งภาพถ้าไม่พบสัตว์
+            box = res.boxes.xyxy[0].tolist() if len(res.boxes) else [0, 0, w, h]
+            boxes = torch.tensor([to_input_coords(box, (h, w), captured["input_hw"])])
+            vectors.append(pool_roi_features(captured["features"], captured["input_hw"], boxes, POOL_SIZE)[0].numpy())
+            if (n + 1) % 500 == 0:
+                print(f"  {n + 1}/{len(paths)}")
+    x = np.stack(vectors).astype(np.float32)
+    np.save(x_path, x)
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    return x, np.array(labels, dtype=np.int64), class_names
+
+class AgeHead(nn.Module):
+    """head จำแนกช่วงอายุจาก vector ของ ROI (forward คืน softmax เหมือน output ของโมเดล TFLite)"""
+
+    def __init__(self, in_features, num_classes):
+        super().__init__()
+        self.net = nn.Sequential(
+            nn.LayerNorm(in_features),
+            nn.Linear(in_features, HIDDEN),
+            nn.ReLU(),
+            nn.Dropout(DROPOUT),
+            nn.Linear(HIDDEN, num_classes),
+        )
+
+    def forward(self, x):
+        return torch.softmax(self.net(x), dim=1)
+
+# --- Feature ---
+train_x, train_y, class_names = extract_features('train')
+val_x, val_y, _ = extract_features('valid')
+test_x, test_y, _ = extract_features('test')
+print("Classes:", class_names, "feature dim:", train_x.shape[1])
+
+# --- เทรน head ---
+head = AgeHead(train_x.shape[1], len(class_names))
+optimizer = torch.optim.Adam(head.parameters(), lr=LR)
+loss_fn = nn.CrossEntropyLoss()
+train_x_t, train_y_t = torch.from_numpy(train_x), torch.from_numpy(train_y)
+val_x_t, val_y_t = torch.from_numpy(val_x), torch.from_numpy(val_y)
+
+best_loss, best_state, bad_epochs = float("inf"), None, 0
+for epoch in range(EPOCHS):
+    head.train()
+    order = torch.randperm(len(train_x_t))
+    for start in range(0, len(order), BATCH_SIZE):
+        idx = order[start:start + BATCH_SIZE]
+        optimizer.zero_grad()
+        loss = loss_fn(head.net(train_x_t[idx]), train_y_t[idx])
+        loss.backward()
+        optimizer.step()
+
+    head.eval()
+    with torch.no_grad():
+        logits = head.net(val_x_t)
+        val_loss = loss_fn(logits, val_y_t).item()
+        val_acc = (logits.argmax(dim=1) == val_y_t).float().mean().item()
+    print(f"epoch {epoch + 1}: val_loss {val_loss:.4f} val_acc {val_acc:.4f}")
+    if val_loss < best_loss:
+        best_loss, bad_epochs = val_loss, 0
+        best_state = {k: v.clone() for k, v in head.state_dict().items()}
+    else:
+        bad_epochs += 1
+        if bad_epochs >= PATIENCE:
+            break
+
+head.load_state_dict(best_state)
+head.eval()
+
+# --- Evaluate on test set ---
+with torch.no_grad():
+    pred = head(torch.from_numpy(test_x)).argmax(dim=1).numpy()
+print(f"\nTest Accuracy: {(pred == test_y).mean():.4f}")
+for i, class_name in enumerate(class_names):
+    mask = test_y == i
+    if mask.any():
+        print(f"  {class_name}: {(pred[mask] == i).mean():.4f} ({mask.sum()} ภาพ)")
+
+# --- บันทึก TorchScript + meta สำหรับ backend ---
+meta = {"age_labels": class_names, "pool_size": POOL_SIZE, "in_features": int(train_x.shape[1]),
+        "yolo_weights": os.path.basename(YOLO_WEIGHTS)}
+torch.jit.save(torch.jit.script(head), OUTPUT_PATH, _extra_files={"meta.json": json.dumps(meta)})
+print(f"✅ บันทึก age head ที่ {OUTPUT_PATH} (คัดลอกไปไว้ที่ backend แล้วตั้ง AGE_ENGINE=yolo_head)")
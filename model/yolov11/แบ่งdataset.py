@@ -1,7 +1,10 @@
 import os
-import shutil
-import random
-from collections import defaultdict
+import sys
+from collections import Counter
+
+# engine สำหรับแบ่ง dataset อยู่ที่ model/dataset_split.py (ใช้ร่วมกับ mobilenetv2)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import dataset_split
 
 # พาธต้นทาง
 image_dir = 'C:/Users/Acer/Desktop/Project/yolov11/datasets/train/images'
@@ -9,62 +12,61 @@ label_dir = 'C:/Users/Acer/Desktop/Project/yolov11/datasets/train/labels'
 
 # พาธปลายทาง
 output_base = 'C:/Users/Acer/Desktop/Project/yolov11/datasets_breeds'
-splits = ['train', 'valid', 'test']
 split_ratio = {'train': 0.8, 'valid': 0.15, 'test': 0.05}
+SEED = 42
+# hardlink: สร้าง <split>/images และ <split>/labels แบบไม่ใช้พื้นที่เพิ่ม (data.yaml เดิมใช้ได้)
+# manifest: เขียนแค่ train.txt / valid.txt / test.txt ให้ data.yaml ชี้ไปที่ไฟล์เหล่านี้แทนโฟลเดอร์
+#           (ultralytics หา label จาก path ของภาพ: .../images/x.jpg -> .../labels/x.txt)
+MODE = 'hardlink'
+# ภาพที่ dHash ต่างกันไม่เกินกี่บิตถือว่าซ้ำ (0 = ต้องเหมือนกันทุกบิต)
+MAX_HASH_DISTANCE = 0
 
-# สร้างโฟลเดอร์สำหรับชุดข้อมูลที่แบ่งแล้ว
-for split in splits:
-    os.makedirs(os.path.join(output_base, split, 'images'), exist_ok=True)
-    os.makedirs(os.path.join(output_base, split, 'labels'), exist_ok=True)
-
-# Step 1: จัดกลุ่มภาพตามคลาส
-class_to_files = defaultdict(list)
-
-for label_file in os.listdir(label_dir):
+# Step 1: รวมภาพที่มี label พร้อมคลาสในภาพ
+items = []
+for label_file in sorted(os.listdir(label_dir)):
     if not label_file.endswith('.txt'):
         continue
-    path = os.path.join(label_dir, label_file)
-    with open(path, 'r') as f:
-        lines = f.readlines()
-        classes_in_file = set(int(line.split()[0]) for line in lines if len(line.split()) >= 5)
-        for cls in classes_in_file:
-            image_filename = os.path.splitext(label_file)[0] + '.jpg'
-            class_to_files[cls].append(image_filename)
-
-# Step 2: แบ่งข้อมูลโดยให้คลาสมีสัดส่วนใกล้เคียงกัน
-final_split_files = {'train': set(), 'valid': set(), 'test': set()}
+    image_path = os.path.join(image_dir, os.path.splitext(label_file)[0] + '.jpg')
+    if not os.path.exists(image_path):
+        continue
+    with open(os.path.join(label_dir, label_file), 'r') as f:
+        classes_in_file = set(int(line.split()[0]) for line in f if len(line.split()) >= 5)
+    if classes_in_file:
+        items.append({'image': image_path, 'label': os.path.join(label_dir, label_file),
+                      'classes': classes_in_file})
 
-for cls, files in class_to_files.items():
-    unique_files = list(set(files))  # ป้องกันซ้ำ
-    random.shuffle(unique_files)
-    total = len(unique_files)
+# Step 2: hash แบบขนาน แล้วตัดภาพซ้ำ
+# ภาพเดียวกันที่มีชุดคลาสใน label ไม่ตรงกัน ถูกตัดออกทุกภาพ และบันทึกใน conflicts.txt ให้แก้เอง
+def classes_of(item):
+    return tuple(sorted(item['classes']))
 
-    train_count = int(total * split_ratio['train'])
-    val_count = int(total * split_ratio['valid'])
-    test_count = total - train_count - val_count  # ส่วนที่เหลือ
+dataset_split.scan(items)
+items, dropped, conflicts = dataset_split.find_duplicates(items, MAX_HASH_DISTANCE, label_key=classes_of)
+dataset_split.write_duplicates_report(output_base, dropped)
+dataset_split.write_conflicts_report(output_base, conflicts, classes_of)
+print(f"พบภาพซ้ำ {len(dropped)} ภาพ (ดู duplicates.txt)")
+if conflicts:
+    print(f"⚠️ พบภาพซ้ำที่ label ไม่ตรงกัน {len(conflicts)} กลุ่ม ({sum(len(g) for g in conflicts)} ภาพ) "
+          f"ไม่ถูกใช้จนกว่าจะแก้ (ดู conflicts.txt)")
 
-    final_split_files['train'].update(unique_files[:train_count])
-    final_split_files['valid'].update(unique_files[train_count:train_count + val_count])
-    final_split_files['test'].update(unique_files[train_count + val_count:])
+# Step 3: แบ่งข้อมูลโดยให้คลาสมีสัดส่วนใกล้เคียงกัน
+# ภาพที่มีหลายคลาสถูกจัดกลุ่มตามคลาสที่มีภาพน้อยที่สุดในภาพนั้น จึงอยู่ใน split เดียวเสมอ
+class_counts = Counter(cls for item in items for cls in item['classes'])
 
-# Step 3: คัดลอกไฟล์รูปและ label ไปยังโฟลเดอร์ปลายทาง
-def copy_files(split, filenames):
-    for img_file in filenames:
-        label_file = os.path.splitext(img_file)[0] + '.txt'
+def rarest_class(item):
+    return min(item['classes'], key=lambda cls: (class_counts[cls], cls))
 
-        src_img = os.path.join(image_dir, img_file)
-        src_lbl = os.path.join(label_dir, label_file)
+splits = dataset_split.assign_splits(items, split_ratio, seed=SEED, group_key=rarest_class)
 
-        dst_img = os.path.join(output_base, split, 'images', img_file)
-        dst_lbl = os.path.join(output_base, split, 'labels', label_file)
+def files_for(item):
+    return [
+        (item['image'], os.path.join('images', os.path.basename(item['image']))),
+        (item['label'], os.path.join('labels', os.path.basename(item['label']))),
+    ]
 
-        if os.path.exists(src_img) and os.path.exists(src_lbl):
-            shutil.copy2(src_img, dst_img)
-            shutil.copy2(src_lbl, dst_lbl)
+dataset_split.write_splits(output_base, splits, files_for, mode=MODE)
 
-# คัดลอกแต่ละชุด
-for split in splits:
-    copy_files(split, final_split_files[split])
-    print(f"{split}: {len(final_split_files[split])} files copied.")
+for split in dataset_split.SPLITS:
+    print(f"{split}: {len(splits[split])} files.")
 
-print("✅ Dataset split completed.")
\ No newline at end of file
+print("✅ Dataset split completed.")